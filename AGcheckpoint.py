@@ -0,0 +1,51 @@
+# Scheduler and sensor cache checkpoint for AutoGro
+# V23
+#
+# A small json file with the time left on each timer and the cached pH, so a
+# restart (crash, parm change, reboot) picks the schedule up where it left off
+# instead of starting cold with a water refresh and every timer reset.
+#
+# Timers are monotonic deadlines, which mean nothing after a restart, so they
+# are saved as seconds left at the wall clock save time.  On load the time the
+# program was down is taken off.  The file is written to a temp file, fsynced
+# and renamed over the old one, a crash part way leaves the old checkpoint.
+
+import json
+import os
+import AGhal
+
+VERSION = 1
+
+# Atomically replace the checkpoint at path with jobs (name -> seconds left) and the cached pH
+def save(path, jobs, pH, pH_age):
+   state = {"version": VERSION, "saved": AGhal.clock.time(), "jobs": jobs, "pH": pH, "pH_age": pH_age}
+   tmp = path + ".tmp"
+   with open(tmp, "w") as file:
+      json.dump(state, file)
+      file.flush()
+      os.fsync(file.fileno())
+   os.replace(tmp, path)
+   dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+   try:
+      os.fsync(dir_fd) # Make the rename itself survive a power cut
+   finally:
+      os.close(dir_fd)
+
+# Read a checkpoint no older than max_age seconds, returns None if there is no usable one
+# Job times and pH age in the result are adjusted for the time since the save
+def load(path, max_age):
+   try:
+      with open(path, "r") as file:
+         state = json.load(file)
+   except Exception:
+      return None
+   if (type(state) != dict or state.get("version") != VERSION):
+      return None
+   down = AGhal.clock.time() - state["saved"]
+   if (down < 0 or down > max_age): # Clock went back or checkpoint is stale
+      return None
+   state["down"] = down
+   state["jobs"] = {name: max(0, left - down) for name, left in state["jobs"].items()}
+   if (state["pH_age"] is not None):
+      state["pH_age"] = state["pH_age"] + down
+   return state
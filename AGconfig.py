@@ -1,20 +1,33 @@
 # AG config and support functions
 # V23
 
+import os
 import time
 from datetime import datetime
-import sys
 import csv
-import serial
 import json
 import copy
-import requests
-from urllib.request import urlopen
+import AGhal
+import AGlogger
+import AGseries
+import AGuploader
+import AGoutbox
+import AGmetrics
+import AGsnapshot
 
 ################### Constants NON remote config  #################################################################
 VERSION = 22                           # Version of this code
 MAX_WATER_VALVES = 5                   # Max number of system water valves, used for pump API call
 FLOW_PIN_INPUT = 25                    # Pin that flow meter is attached
+FLOW_BOUNCE_TIME = 1                   # Flow pin debounce in ms, meter pulses every 4.4 ms at 30 l/min so 5 lost pulses
+FLOW_RING_SIZE = 4096                  # Flow pulse time stamps kept, see AGflow.py
+FLOW_LITRES_PER_PULSE = 1 / 450        # Flow meter calibration, YF-S201 is about 450 pulses per litre
+FLOW_RATE_WINDOW = 5                   # Seconds of pulses used for the logged flow rate
+FLOW_INSTANT_MAX_AGE = 2               # Seconds since the last pulse before the instant flow rate reads 0
+FLOW_SETTLE_TIME = 10                  # Seconds after the pump stops before flow counts as a leak
+FLOW_LEAK_INTERVAL = 60                # Time in seconds between leak checks, also the leak check window
+FLOW_LEAK_PULSES = 20                  # Flow pulses in one leak window with the pump off that are logged as a leak
+SOIL_MAX_AGE = 30                      # Seconds a soil reading decides for a soil triggered valve, older and the valve waters on its timer
 PUMP_DELAY = 1                         # Time between stopping and starting pump to avoid back pressure
 PRINT_TO_CONSOLE = 1                   # Print to console as well as log (1 is true 0 is false)
 PH_DOWN_RELAY = 7                      # Relay that controls pH down fluid
@@ -26,19 +39,95 @@ SYS = "AGsys.log"                      # AG system log name
 PUMP = "AGpump.log"                    # AG pump log name
 SENSORS = "AGsensors.log"              # AG sensor log name
 ERROR = "AGerror.log"                  # Log for system errors
-SENSOR_JSON_FILE = "sensor_json.log"   # Log file that records the sensor json data passed to the web api
-PUMP_JSON_FILE = "pump_json.log"       # Log file that records the pump json data passed to the web api
+SERIES_DIR = "history"                 # Directory for binary sensor and pump history, see AGseries.py
+SERIES_ROLLUP_INTERVAL = 3600          # Time in seconds between hourly / daily history rollups
+SERIES_RAW_DAYS = 30                   # Days of raw sensor and pump history kept after rollup
+SERIES_HOURLY_DAYS = 365               # Days of hourly rollups kept, daily rollups are kept forever
+SERIES_FIELDS = {                      # Fields stored per sample in each history series
+   "sensor" : ["soil_1_wet","soil_2_wet","soil_3_wet","soil_4_wet","soil_5_wet","tds","ph"],
+   "pump" : ["pump_status","flow_meter_rotations","valve_1","valve_2","valve_3","valve_4","valve_5"] }
 PH_JSON_FILE = "ph_json.log"           # Log file that records the pH json data passed to the web api
 FILE_PARMS = "AG_Parms.txt"            # Parms config file, updated from remote API call
 REMOTE_PARMS = 0                       # Get remote parms from web api (1 is true 0 is false)
 REFLECT_PARMS = 0                      # Reflect back running parms to web api (1 is true 0 is false)
+RESTART_PARMS = ()                     # run_parms keys that need a program restart to take effect, the rest are applied live
 REMOTE_PARM_INTERVAL = 30              # Time between getting remote parms in seconds
+REMOTE_PARM_JITTER = .1                # Remote parm poll interval is randomly +/- this fraction
+REMOTE_PARM_TIMEOUT = 5                # Timeout in seconds for the remote parm web call
+REMOTE_PARM_MAX_BACKOFF = 1800         # Longest time in seconds between remote parm polls after failures
                                        # Remote config URL
 REMOTE_PARM_URL = "https://autogro.pythonanywhere.com/autogro_app_api/XXXXXXX"
                                        # URL will running parms will be pushed
 REFLECT_PARM_URL = "https://autogro.pythonanywhere.com/autogro_app_api/XXXXXXXX"
-                                       # Location of USB reset command for pH USB bug
-USB_RESET = "/home/pi/bin/AutoGro/usb_reset/fix_usb"
+USB_RESET_DEVICE = "2109:3431"         # vendor:product reset for the pH USB bug (VIA Labs hub), "" resets the probe's own device
+USB_SYSFS_ROOT = "/sys"                # sysfs, the USB reset finds devices and watches the probe tty here
+USB_DEV_ROOT = "/dev"                  # Device nodes, the USB reset opens bus/usb/<bus>/<device> under it
+USB_DETACH_TIME = 1                    # Max seconds to wait for the probe tty to go away after a USB reset
+USB_SETTLE_TIMEOUT = 15                # Max seconds from a USB reset to the probe tty being back
+USB_POLL_INTERVAL = .1                 # Seconds between sysfs checks while waiting on the probe tty
+USB_RESET_MIN_INTERVAL = 150           # Seconds before a second USB reset, doubles with each reset
+USB_RESET_MAX_INTERVAL = 1200          # Max seconds between USB resets, back off restarts when pH reads again
+METRICS_PORT = 9470                    # Port for the Prometheus /metrics endpoint, 0 turns it off
+METRICS_HOST = "127.0.0.1"             # Address /metrics binds to, "" for every interface to scrape from the LAN
+GATEWAY_PORT = 8470                    # Port AGgateway.py listens on for node payloads and parm requests
+GATEWAY_LOG = "AGgateway.log"          # Gateway log
+GATEWAY_OUTBOX_FILE = "AGgateway.db"   # Gateway outbox of payloads waiting to go upstream
+GATEWAY_OUTBOX_MAX_ROWS = 500000       # Max payloads held by the gateway outbox
+GATEWAY_BULK_URL = ""                  # Upstream url taking a gzipped json list of payloads, "" sends each to its run_parms url
+GATEWAY_BATCH_WINDOW = 10              # Seconds the gateway gathers payloads before sending a batch upstream
+GATEWAY_BATCH_SIZE = 200               # Most payloads in one upstream batch
+GATEWAY_DEDUPE_SIZE = 100000           # Recent payloads remembered to drop repeats from node replays
+CHECKPOINT_FILE = "AGstate.json"       # Timer and pH cache checkpoint used for a warm restart, see AGcheckpoint.py
+CHECKPOINT_INTERVAL = 60               # Time in seconds between checkpoints
+CHECKPOINT_MAX_AGE = 3600              # A checkpoint older than this at startup is ignored and the start is cold
+ADC_CHANNELS = 8                       # MCP3008 inputs read on every sensor scan, soil sensors start at 0
+ADC_TDS_CHANNEL = 7                    # TDS sensor is on the last MCP3008 input
+ADC_OVERSAMPLE = 4                     # Min samples per channel per scan, TDS averages only the first tds_samples
+ADC_MAX_OVERSAMPLE = 20                # Scan buffer size in samples per channel, matches tds_samples limit
+PH_WINDOW = 60                         # Number of recent pH probe readings kept, probe sends one a second
+PH_MAX_AGE = 10                        # Newest pH reading must be this many seconds old or less to be used
+PH_EMA_ALPHA = .2                      # Weight of each new reading in the pH moving average
+PH_OUTLIER_SIGMA = 4                   # pH readings this many std devs from the average are outliers
+PH_OUTLIER_FLOOR = .15                 # pH readings within this of the average are never outliers
+PH_OUTLIER_RESET = 5                   # Outliers in a row that mean pH really changed, estimate restarts
+PH_MAX_STD = .1                        # pH estimate with a larger std dev is not used
+PH_RESET_AFTER = 40                    # Seconds with no pH readings before the USB bus is reset
+PH_REOPEN_DELAY = 5                    # Seconds between attempts to open the pH probe port
+PH_WARN_INTERVAL = 60                  # Min seconds between repeats of the same pH warning in the error log
+PH_WORKER_INTERVAL = 3                 # Seconds between pH worker reads
+PH_WORKER_DEADLINE = 60                # Seconds a pH read may block (USB reset) before the pH worker is stuck
+ADC_WORKER_INTERVAL = 3                # Seconds between soil / TDS burst scans
+ADC_WORKER_DEADLINE = 10               # Seconds a burst scan may take before the ADC worker is stuck
+REPORT_WORKER_INTERVAL = 0             # Report worker waits in the report itself until one is due, see AGsensors.report
+REPORT_WORKER_WAIT = 30                # Most seconds one report call waits for a due report and new readings
+REPORT_WORKER_DEADLINE = 90            # Seconds a report call may take, its wait included, before the report worker is stuck
+WORKER_CHECK_INTERVAL = 2              # Seconds between sensor worker supervisor checks
+WORKER_RESTART_DELAY = 5               # First delay before restarting a failed or stuck sensor worker, doubles each time
+WORKER_MAX_RESTART_DELAY = 300         # Max delay before restarting a sensor worker
+LOG_FLUSH_BYTES = 16384                # Log writer flushes when this many bytes are waiting
+LOG_FLUSH_INTERVAL = 5                 # Log writer flushes at least this often in seconds
+LOG_MAX_BYTES = 5000000                # Logs rotate past this size, and on the first write of a new day
+LOG_GENERATIONS = 4                    # Rotated logs kept, AGsys.log1 to AGsys.log4
+LOG_MAX_PENDING = 1000000              # Max bytes waiting for the log writer, lines dropped past this
+OUTBOX_FILE = "AGoutbox.db"            # SQLite store and forward file for web API payloads
+OUTBOX_MAX_ROWS = 50000                # Max web API payloads kept waiting for the network, oldest evicted
+OUTBOX_MAX_BYTES = 20000000            # Max outbox size on disk in bytes, oldest evicted
+UPLOAD_BATCH_WINDOW = 2                # Seconds the uploader waits to gather payloads into one batch
+UPLOAD_BATCH_SIZE = 20                 # Max payloads sent per batch
+UPLOAD_TIMEOUT = 5                     # Timeout in seconds for each web API call
+BREAKER_FAILURES = 3                   # Consecutive web API failures before the circuit breaker opens
+BREAKER_COOLDOWN = 30                  # Seconds the circuit breaker first stays open before trying again
+BREAKER_MAX_COOLDOWN = 1800            # Cool down doubles each time breaker reopens, up to this many seconds
+RELAY_PINS = [5,6,13,16,19,20,21,26]  # GPIO pins for the eight relay Pi hat, pump is first
+                                       # Hardware backend, "pi" for wired Pi, "sim" for simulated hardware or "replay" for recorded logs
+HAL_BACKEND = os.environ.get("AG_HAL","pi")
+SIM_SPEED = float(os.environ.get("AG_SIM_SPEED","1"))        # Sim clock speed, 1 is real time, 3600 runs an hour per second
+SIM_RUN_TIME = float(os.environ.get("AG_SIM_RUN_TIME","0"))  # Simulated seconds to run before exit, 0 is run forever
+REPLAY_DIR = os.environ.get("AG_REPLAY_DIR","Example_Logs")  # Recorded logs AG_HAL=replay runs from, see AGreplay.py
+SIM_WEB_API = os.environ.get("AG_SIM_WEB_API","0") == "1"    # Sim and replay runs make no web API calls unless this is 1
+REPLAY_INTERVAL = 10                   # Seconds between applying recorded parm changes during a replay
+                                       # Parms a replay leaves to the local parm file, it must not post to the node's urls
+REPLAY_LOCAL_PARMS = ("enable_web_api","pump_url","sensor_url","ph_url","ph_sensor_port")
 ##################################################################################################################
 
 ############### Default runtime parms, override via file config or remote API #####################
@@ -47,25 +136,48 @@ run_parms = {
 "valve1_active" : 1,                 # Valve 1 enabled - (0/1 disabled/enabled)
 "valve1_time" : 600,                 # Valve 1 time between water cycles in seconds
 "valve1_duration" : 10,              # Valve 1 duration that valve is running / watering
+"valve1_soil_sensor" : -1,           # Soil sensor that waters valve 1 when dry, -1 waters on the timer only
+"valve1_soil_low" : 30,              # Valve 1 waters when its soil sensor is at or below this % wet
+"valve1_soil_high" : 45,             # Valve 1 can water again once its soil sensor is back up to this % wet
+"valve1_soil_spacing" : 1800,        # Least time in seconds between soil triggered waterings of valve 1
 #
 "valve2_active" : 1,                 # Valve 2 enabled - (0/1 disabled/enabled)
 "valve2_time" : 600,                 # Valve 2 time between water cycles in seconds
 "valve2_duration" : 10,              # Valve 2 duration that valve is running / watering
+"valve2_soil_sensor" : -1,           # Soil sensor that waters valve 2 when dry, -1 waters on the timer only
+"valve2_soil_low" : 30,              # Valve 2 waters when its soil sensor is at or below this % wet
+"valve2_soil_high" : 45,             # Valve 2 can water again once its soil sensor is back up to this % wet
+"valve2_soil_spacing" : 1800,        # Least time in seconds between soil triggered waterings of valve 2
 #
 "valve3_active" : 1,                 # Valve 3 enabled - (0/1 disabled/enabled)
 "valve3_time" : 600,                 # Valve 3 time between water cycles in seconds
 "valve3_duration" : 10,              # Valve 3 duration that valve is running / watering
+"valve3_soil_sensor" : -1,           # Soil sensor that waters valve 3 when dry, -1 waters on the timer only
+"valve3_soil_low" : 30,              # Valve 3 waters when its soil sensor is at or below this % wet
+"valve3_soil_high" : 45,             # Valve 3 can water again once its soil sensor is back up to this % wet
+"valve3_soil_spacing" : 1800,        # Least time in seconds between soil triggered waterings of valve 3
 #
 "valve4_active" : 1,                 # Valve 4 enabled - (0/1 disabled/enabled)
 "valve4_time" : 600,                 # Valve 4 time between water cycles in seconds
 "valve4_duration" : 10,              # Valve 4 duration that valve is running / watering
+"valve4_soil_sensor" : -1,           # Soil sensor that waters valve 4 when dry, -1 waters on the timer only
+"valve4_soil_low" : 30,              # Valve 4 waters when its soil sensor is at or below this % wet
+"valve4_soil_high" : 45,             # Valve 4 can water again once its soil sensor is back up to this % wet
+"valve4_soil_spacing" : 1800,        # Least time in seconds between soil triggered waterings of valve 4
 #
 "valve5_active" : 0,                 # Valve 5 enabled - (0/1 disabled/enabled)
 "valve5_time" : 600,                 # Valve 5 time between water cycles in seconds
 "valve5_duration" : 10,              # Valve 5 duration that valve is running / watering
+"valve5_soil_sensor" : -1,           # Soil sensor that waters valve 5 when dry, -1 waters on the timer only
+"valve5_soil_low" : 30,              # Valve 5 waters when its soil sensor is at or below this % wet
+"valve5_soil_high" : 45,             # Valve 5 can water again once its soil sensor is back up to this % wet
+"valve5_soil_spacing" : 1800,        # Least time in seconds between soil triggered waterings of valve 5
 #
 "water_refresh_cycle" : 900,         # Time in seconds between water refresh cycles, run pump with no valves open
 "water_refresh_cycle_length" : 10,   # Time in seconds for water refresh cycle duration
+"refresh_credit" : 1,                # Skip a water refresh if the pump ran at least refresh length since the last one (0/1)
+"valve_batch_window" : 0,            # Valves due within this many seconds share one pump run, 0 runs each valve on its own
+"pump_max_valves" : 2,               # Most valves open at once on one pump run when batching
 
 # pH Routine parms ############
 "ph_sensor_enabled" : 1,             # Is pH sensor enabled? (0/1 disabled/enabled)
@@ -98,8 +210,146 @@ run_parms = {
 }
 ###################################################################################################3
 
-# Global variables used across files
-global_pH = -1  # Global pH value
+# Validation rules for run_parms, one entry per key, compiled once by compile_parm_schema
+#   ("bool",)                                  - int 0 or 1
+#   ("int", min, max) / ("float", min, max)    - number in range, float also takes int
+#   ("str", min length, must contain, case sensitive)
+#   ("url", min length, schemes)               - string starting with one of the schemes, any case
+PARM_SCHEMA = {
+"valve1_active" : ("bool",),
+"valve2_active" : ("bool",),
+"valve3_active" : ("bool",),
+"valve4_active" : ("bool",),
+"valve5_active" : ("bool",),
+"valve1_time" : ("float",.1,500000),
+"valve2_time" : ("float",.1,500000),
+"valve3_time" : ("float",.1,500000),
+"valve4_time" : ("float",.1,500000),
+"valve5_time" : ("float",.1,500000),
+"valve1_duration" : ("float",.1,3600),
+"valve2_duration" : ("float",.1,3600),
+"valve3_duration" : ("float",.1,3600),
+"valve4_duration" : ("float",.1,3600),
+"valve5_duration" : ("float",.1,3600),
+"valve1_soil_sensor" : ("int",-1,4),
+"valve1_soil_low" : ("float",0,100),
+"valve1_soil_high" : ("float",0,100),
+"valve1_soil_spacing" : ("float",0,300000),
+"valve2_soil_sensor" : ("int",-1,4),
+"valve2_soil_low" : ("float",0,100),
+"valve2_soil_high" : ("float",0,100),
+"valve2_soil_spacing" : ("float",0,300000),
+"valve3_soil_sensor" : ("int",-1,4),
+"valve3_soil_low" : ("float",0,100),
+"valve3_soil_high" : ("float",0,100),
+"valve3_soil_spacing" : ("float",0,300000),
+"valve4_soil_sensor" : ("int",-1,4),
+"valve4_soil_low" : ("float",0,100),
+"valve4_soil_high" : ("float",0,100),
+"valve4_soil_spacing" : ("float",0,300000),
+"valve5_soil_sensor" : ("int",-1,4),
+"valve5_soil_low" : ("float",0,100),
+"valve5_soil_high" : ("float",0,100),
+"valve5_soil_spacing" : ("float",0,300000),
+"water_refresh_cycle" : ("float",.1,300000),
+"water_refresh_cycle_length" : ("float",.1,300000),
+"refresh_credit" : ("bool",),
+"valve_batch_window" : ("float",0,3600),
+"pump_max_valves" : ("int",1,5),
+"ph_sensor_enabled" : ("bool",),
+"balance_ph" : ("bool",),
+"ideal_ph" : ("float",5,8),
+"ph_spread" : ("float",.1,2),
+"ph_valve_time" : ("float",.1,30),
+"ph_balance_interval" : ("float",20,300000),
+"ph_balance_water_limit" : ("float",5,300000),
+"ph_balance_retry" : ("float",5,300000),
+"ph_sensor_port" : ("str",8,"/dev/tty",True),
+"enable_web_api" : ("bool",),
+"pump_url" : ("url",10,("http://","https://")),
+"sensor_url" : ("url",10,("http://","https://")),
+"ph_url" : ("url",10,("http://","https://")),
+"enable_tds_meter" : ("bool",),
+"tds_samples" : ("int",1,20),
+"room_temperature" : ("float",-23,49),
+"sensor_time_api" : ("float",.1,300000),
+"soil_dry" : ("int",1000,70000),
+"soil_wet" : ("int",1000,70000),
+"number_of_soil_sensors" : ("int",1,5)
+}
+
+# Turn one schema rule into a check function, value -> None if valid or the reason it is not
+def compile_parm_rule(rule):
+   kind = rule[0]
+   if (kind == "bool"):
+      def check(value):
+         if (type(value) != int):
+            return "is not a int"
+         if (value != 1 and value != 0):
+            return "Invalid value"
+         return None
+   elif (kind == "int" or kind == "float"):
+      types = (int,) if kind == "int" else (int, float)
+      min_val, max_val = rule[1], rule[2]
+      def check(value):
+         if (type(value) not in types):
+            return "is not " + kind + " variable type"
+         if (value < min_val or value > max_val):
+            return "is out of range"
+         return None
+   elif (kind == "str"):
+      length, sub_string, case_sensitive = rule[1], rule[2], rule[3]
+      if (not case_sensitive):
+         sub_string = sub_string.lower()
+      def check(value):
+         if (type(value) != str):
+            return "is not a string"
+         if (len(value) < length):
+            return "is too short"
+         if (sub_string not in (value if case_sensitive else value.lower())):
+            return "is not valid"
+         return None
+   elif (kind == "url"):
+      length, schemes = rule[1], rule[2]
+      def check(value):
+         if (type(value) != str):
+            return "is not a string"
+         if (len(value) < length):
+            return "is too short"
+         if (not value.lower().startswith(schemes)): # Scheme must lead, not just appear somewhere
+            return "is not a " + " or ".join(schemes) + " url"
+         return None
+   else:
+      raise ValueError("Unknown parm rule: " + str(rule))
+   return check
+
+def compile_parm_schema(schema): # key -> check function
+   return {key: compile_parm_rule(rule) for key, rule in schema.items()}
+
+parm_checks = compile_parm_schema(PARM_SCHEMA)
+
+# State shared across threads, pH / TDS / soil from the sensor workers and the relays, see AGsnapshot.py
+shared_state = AGsnapshot.Store({"pH": -1, "tds": -1, "soil": (), "soil_raw": (), "relays": (False,) * len(RELAY_PINS)})
+
+# Background log writer, every log line goes through it, opens no file and starts no thread until the first line
+log_writer = AGlogger.LogWriter(LOG_FLUSH_BYTES,LOG_FLUSH_INTERVAL,LOG_MAX_BYTES,LOG_GENERATIONS,LOG_MAX_PENDING,ERROR)
+
+# Sensor / pump history (replaces the sensor and pump json logs) and the web API uploader with its outbox.
+# Made by start_node() when the controller starts, so importing AGconfig for its constants creates no files
+sensor_history = None
+pump_history = None
+uploader = None
+
+def start_node(): # History directory and outbox file go in the current directory
+   global sensor_history, pump_history, uploader
+   if (uploader is not None):
+      return
+   sensor_history = AGseries.History(SERIES_DIR,"sensor",SERIES_FIELDS["sensor"])
+   pump_history = AGseries.History(SERIES_DIR,"pump",SERIES_FIELDS["pump"])
+   uploader = AGuploader.Uploader(AGoutbox.Outbox(OUTBOX_FILE,OUTBOX_MAX_ROWS,OUTBOX_MAX_BYTES),UPLOAD_BATCH_WINDOW,\
+      UPLOAD_BATCH_SIZE,UPLOAD_TIMEOUT,AGuploader.Breaker(BREAKER_FAILURES,BREAKER_COOLDOWN,BREAKER_MAX_COOLDOWN),\
+      ("sensor","pump","pH","parm"))
+   AGmetrics.gauge("ag_outbox_rows","Web API payloads waiting in the outbox",fn=uploader.outbox.count)
 
 #Write json data to log
 def write_json_to_log(data):
@@ -114,17 +364,10 @@ def write_parm_file():
    except Exception:
       AGlog("Could not write parameter file to disk",ERROR)
 
-# Write running parms back to API
+# Write running parms back to API, through the outbox and uploader like the other web calls
 def write_parm_api():
    AGsys("Sending data to parm API")
-   try:
-      response = requests.post(REMOTE_PARM_URL, data=run_parms, timeout=5)
-      if (response.status_code != 200):
-         AGlog("ERROR - API parm web call failed.  Return code: " + str(response.status_code),ERROR)
-      else:
-         AGsys("Sensor web API successful")
-   except Exception as e:
-      AGlog("ERROR - Exception on parm web API call, possible timeout",ERROR)
+   uploader.submit("parm", REMOTE_PARM_URL, dict(run_parms), None)
 
 # Read the parm file from disk, return empty dict for error
 def read_parm_file():
@@ -145,194 +388,66 @@ def read_parm_file():
       return file_parms
    return file_parms # All good, open, close and json parse
 
-# Read parms from the remote api / webserver
-def read_remote_parms():
-   remote_parms = {}
-   try:
-      response = urlopen(REMOTE_PARM_URL,timeout=5)
-      if (response.getcode() == 200):
-         remote_parms = json.loads(response.read())
-      if (remote_parms == {}):
-         AGlog("Could not get api parm data from website",ERROR)
-   except Exception as e:
-      AGlog("Exception getting api parm data from website: " + str(e),ERROR)
-   return remote_parms
-
-# Check to see if data coming in is a valid bool (in this case a 1 or 0)
-def check_bool_parm(new_parms, key): # Return true/false if running parm is changed
-   if (key not in new_parms):
-      AGsys("Key: " + key + " Not found in dictionary")
-      return False
-   if (type(new_parms[key]) != int):
-      AGsys("Key: " + key + " is not a int")
-      return False
-   if (new_parms[key] != 1 and new_parms[key] != 0):
-      AGsys("Key: " + key + " Invalid value")
-      return False
-   if (new_parms[key] != run_parms[key]):
-      run_parms[key] = new_parms[key]
-      AGsys("Key: " + key + " Updating value <<<<<<<<<<")
-      return True
-   else:
-      AGsys("Key " + key + " is the same")
-      return False
-
-# Check to see if data coming in is a valid string
-def check_string_parm(new_parms, key, length, sub_string, case_sensitive): # Return true/false if running parm is changed
-   if (key not in new_parms):
-      AGsys("Key: " + key + " Not found in dictionary")
-      return False
-   if (type(new_parms[key]) != str):
-      AGsys("Key: " + key + " is not a string")
-      return False
-   if (len(new_parms[key]) < length):
-      AGsys("Key: " + key + " is too short")
-      return False
-   if (case_sensitive ==  True):  # Routine can check with sensitivity or not
-      if (sub_string not in new_parms[key]):
-         AGsys("Key: " + key + " is not valid")
-         return False
-      else:
-         if (sub_string.lower() not in new_parms[key].lower()): # Force everything to lowercase to check
-            AGsys("Key: " + key + " is not valid")
-            return False
-   if (new_parms[key] != run_parms[key]):
-      run_parms[key] = new_parms[key]
-      AGsys("Key: " + key + " Updating value <<<<<<<<<<")
-      return True
-   else:
-      AGsys("Key " + key + " is the same")
-      return False
-
-# Check to see if data coming in is a valid int or float and min/max range
-def check_number_parm(new_parms,key,var_type,min_val,max_val): # Return true/false if running parm is changed
-   if (key not in new_parms):
-      AGsys("Key: " + key + " Not found in dictionary")
-      return False
-   if (var_type == int): # float can can cover int and float so checking both in this block
-      if (type(new_parms[key]) != int):
-         AGsys("Key: " + key + " is not integer variable type")
-         return False
-   else: # float check
-      if (type(new_parms[key]) != int and type(new_parms[key]) != float):
-         AGsys("Key: " + key + " is not integer or float type")
-         return False
-   if (new_parms[key] < min_val or new_parms[key] > max_val):
-      AGsys("Key: " + key + " is out of range")
-      return False
-   if (new_parms[key] != run_parms[key]):
-      run_parms[key] = new_parms[key]
-      AGsys("Key: " + key + " Updating value <<<<<<<<<<<<<<")
-      return True
-   else:
-      AGsys("Key " + key + " is the same")
-      return False
-
 # Check a new set of parms to update running parms
 # These came from a file read or a API get request
-# For ints or floats a range is checked for validity
-# For stirngs, a length is checked as well as contents
+# Only keys whose value differs from run_parms are validated, each against its
+# compiled PARM_SCHEMA check.  Returns the changeset, a dict of
+# key -> (old value, new value) for every key updated, empty if nothing changed.
+# Only updates and rejections are logged.
 def update_parms(new_parms):
-   changed = False
-   if (check_bool_parm(new_parms,"valve1_active")):
-      changed = True
-   if (check_bool_parm(new_parms,"valve2_active")):
-      changed = True
-   if (check_bool_parm(new_parms,"valve3_active")):
-      changed = True
-   if (check_bool_parm(new_parms,"valve4_active")):
-      changed = True
-   if (check_bool_parm(new_parms,"valve5_active")):
-      changed = True
-   if (check_number_parm(new_parms,"valve1_time",float,.1,500000)):
-      changed = True
-   if (check_number_parm(new_parms,"valve2_time",float,.1,500000)):
-      changed = True
-   if (check_number_parm(new_parms,"valve3_time",float,.1,500000)):
-      changed = True
-   if (check_number_parm(new_parms,"valve4_time",float,.1,500000)):
-      changed = True
-   if (check_number_parm(new_parms,"valve5_time",float,.1,500000)):
-      changed = True
-   if (check_number_parm(new_parms,"valve1_duration",float,.1,3600)):
-      changed = True
-   if (check_number_parm(new_parms,"valve2_duration",float,.1,3600)):
-      changed = True
-   if (check_number_parm(new_parms,"valve3_duration",float,.1,3600)):
-      changed = True
-   if (check_number_parm(new_parms,"valve4_duration",float,.1,3600)):
-      changed = True
-   if (check_number_parm(new_parms,"valve5_duration",float,.1,3600)):
-      changed = True
-   if (check_number_parm(new_parms,"water_refresh_cycle",float,.1,300000)):
-      changed = True
-   if (check_number_parm(new_parms,"water_refresh_cycle_length",float,.1,300000)):
-      changed = True
-   if (check_bool_parm(new_parms,"ph_sensor_enabled")):
-      changed = True
-   if (check_bool_parm(new_parms,"enable_web_api")):
-      changed = True
-   if (check_bool_parm(new_parms,"enable_tds_meter")):
-      changed = True
-   if (check_bool_parm(new_parms,"balance_ph")):
-      changed = True
-   if (check_number_parm(new_parms,"tds_samples",int,1,20)):
-      changed = True
-   if (check_number_parm(new_parms,"number_of_soil_sensors",int,1,5)):
-      changed = True
-   if (check_number_parm(new_parms,"soil_dry",int,1000,70000)):
-      changed = True
-   if (check_number_parm(new_parms,"soil_wet",int,1000,70000)):
-      changed = True
-   if (check_number_parm(new_parms,"ideal_ph",float,5,8)):
-      changed = True
-   if (check_number_parm(new_parms,"ph_spread",float,.1,2)):
-      changed = True
-   if (check_number_parm(new_parms,"ph_valve_time",float,.1,30)):
-      changed = True
-   if (check_number_parm(new_parms,"ph_balance_interval",float,20,300000)):
-      changed = True
-   if (check_number_parm(new_parms,"ph_balance_water_limit",float,5,300000)):
-      changed = True
-   if (check_number_parm(new_parms,"ph_balance_retry",float,5,300000)):
-      changed = True
-   if (check_number_parm(new_parms,"room_temperature",float,-23,49)):
-      changed = True
-   if (check_number_parm(new_parms,"sensor_time_api",float,.1,300000)):
-      changed = True
-   if (check_string_parm(new_parms,"ph_sensor_port",8,"/dev/tty",True)):
-      changed = True
-   if (check_string_parm(new_parms,"pump_url",10,"https://",False)):
-      changed = True
-   if (check_string_parm(new_parms,"sensor_url",10,"https://",False)):
-      changed = True
-   if (check_string_parm(new_parms,"ph_url",10,"https://",False)):
-      changed = True
-   return changed
+   changes = {}
+   missing = []
+   for key, check in parm_checks.items():
+      if (key not in new_parms):
+         missing.append(key)
+         continue
+      value = new_parms[key]
+      if (value == run_parms[key]): # Same as running value, nothing to check
+         continue
+      error = check(value)
+      if (error is not None):
+         AGsys("Key: " + key + " " + error + ", keeping " + str(run_parms[key]))
+         continue
+      changes[key] = (run_parms[key], value)
+      AGsys("Key: " + key + " Updating value " + str(run_parms[key]) + " -> " + str(value) + " <<<<<<<<<<")
+   if (missing):
+      AGsys("Keys not found in parms: " + ", ".join(missing))
+   run_parms.update({key: change[1] for key, change in changes.items()}) # One update, other threads never see half a change set
+   return changes
 
 ######## Log messages to main log and print to screen if required
 def AGsys(buf):
-   s = datetime.now().strftime("%m%d%y %H:%M:%S") + "  " + buf
+   s = datetime.fromtimestamp(AGhal.clock.time()).strftime("%m%d%y %H:%M:%S") + "  " + buf
    if (PRINT_TO_CONSOLE):
-      print(s)
-      sys.stdout.flush()
-   s = s + "\n"
-   try:
-      file = open(SYS,"a")
-      file.write(s)
-      file.close()
-   except Exception:
-      print("ERROR - Could not write to file: " + SYS)
+      log_writer.write(AGlogger.CONSOLE, s + "\n") # Printed by the writer thread, stdout may be a file on the SD card
+   log_writer.write(SYS, s + "\n")
 
 ######## Log messages to general diagnostic logs
 def AGlog(buf,file_name):
-   s = datetime.now().strftime("%m%d%y %H:%M:%S") + "  " + buf + "\n"
-   try:
-      file = open(file_name,"a")
-      file.write(s)
-      file.close()
-   except Exception:
-      print("ERROR - Could not write to file: " + file_name)
+   s = datetime.fromtimestamp(AGhal.clock.time()).strftime("%m%d%y %H:%M:%S") + "  " + buf + "\n"
+   log_writer.write(file_name, s)
+
+####### Log json in clear text to log for diagnostics, with web call result
+def write_api_json(json_file, data, web_success):
+   s = json.dumps(data,indent=4)
+   if (web_success is None):
+      s = s + "\nWeb API not enabled\n"
+   elif (web_success):
+      s = s + "\nSuccessful call\n"
+   else:
+      s = s + "\nERROR\n"
+   log_writer.write(json_file, s)
+
+####### Hand payload to the outbox and background uploader, the json log (if any) is written once the backend has it
+def web_api_on(): # Sim hardware never posts made up readings to the real web API unless asked to
+   return run_parms["enable_web_api"] and (HAL_BACKEND == "pi" or SIM_WEB_API)
+
+def send_api(name, url, data, json_file):
+   if (web_api_on()):
+      AGsys("Sending data to " + name + " web API")
+      uploader.submit(name, url, data, json_file)
+   elif (json_file is not None):
+      write_api_json(json_file, data, None)
 
 ####### Call Sensor web API
 def APIsensor(buf_list): # This list is max soil sensors, then tds, then pH
@@ -342,36 +457,11 @@ def APIsensor(buf_list): # This list is max soil sensors, then tds, then pH
       data["soil_" + str(i+1) + "_wet"] = buf_list[i] # Key soil_x_wet starts with x=1
    data["tds"] = buf_list[MAX_SOIL_SENSORS]
    data["ph"] = buf_list[MAX_SOIL_SENSORS + 1]
-   data["accessed"] = str(datetime.now())
-
-   # Web API call for sensors
-   web_success = False
-   if (run_parms["enable_web_api"]):
-      AGsys("Sending data to sensor web API")
-      try:
-         response = requests.post(url, data=data, timeout=5)
-         if (response.status_code != 200 and response.status_code != 201):
-            AGlog("ERROR - API sensor web call failed.  Return code: " + str(response.status_code),ERROR)
-         else:
-            web_success = True
-            AGsys("Sensor web API successful")
-      except Exception as e:
-         AGlog("ERROR - Exception on sensor web API call, possible timeout",ERROR)
-
-   # Log json in clear text to log for diagnostics
-   try:
-      file = open (SENSOR_JSON_FILE,"a")
-      file.write(json.dumps(data,indent=4))
-      if (run_parms["enable_web_api"]):
-         if (web_success):
-            file.write("\nSuccessful call\n")
-         else:
-            file.write("\nERROR\n")
-      else:
-         file.write("\nWeb API not enabled\n")
-      file.close()
-   except Exception:
-      print("ERROR - Could not write to file: " + SENSOR_JSON_FILE)
+   now = AGhal.clock.time()
+   data["accessed"] = str(datetime.fromtimestamp(now))
+
+   sensor_history.append(now, [data[f] for f in SERIES_FIELDS["sensor"]])
+   send_api("sensor", url, data, None)
 
 
 ####### Call Pump web API
@@ -394,43 +484,18 @@ def APIpump(Relay_Status,flow): # String that identifies valve and then flow met
       else:
          data[s] = 0
 
-   data["accessed"] = str(datetime.now())
-
-   # Web API call for pump
-   web_success = False
-   if (run_parms["enable_web_api"]):
-      AGsys("Sending data to pump web API")
-      try:
-         response = requests.post(url, data=data, timeout=5)
-         if (response.status_code != 200 and response.status_code != 201):
-            AGlog("ERROR - API pump web call failed.  Return code: " + str(response.status_code),ERROR)
-         else:
-            web_success = True
-            AGsys("Pump web API successful")
-      except Exception as e:
-         AGlog("ERROR - Exception on pump web API call, possible timeout",ERROR)
-
-   # Log json in clear text to log for diagnostics
-   try:
-      file = open (PUMP_JSON_FILE,"a")
-      file.write(json.dumps(data,indent=4))
-      if (run_parms["enable_web_api"]):
-         if (web_success):
-            file.write("\nSuccessful call\n")
-         else:
-            file.write("\nERROR\n")
-      else:
-         file.write("\nWeb API not enabled\n")
-      file.close()
-   except Exception:
-      print("ERROR - Could not write to file: " + PUMP_JSON_FILE)
+   now = AGhal.clock.time()
+   data["accessed"] = str(datetime.fromtimestamp(now))
+
+   pump_history.append(now, [data[f] for f in SERIES_FIELDS["pump"]])
+   send_api("pump", url, data, None)
 
 ####### Call pH web API
 def APIpH(ph_check_signal):  # Integer that describes results from pH check / adjustment routine 0 = no change, 1 = pH up, 2 = pH down
    url = run_parms["ph_url"]
    data = {} # Next several lines create JSON for Sensor API call
 
-   data["accessed"] = str(datetime.now())
+   data["accessed"] = str(datetime.fromtimestamp(AGhal.clock.time()))
    data["ph_down_trigger"] = 0
    data["ph_up_trigger"] = 0
 
@@ -439,31 +504,4 @@ def APIpH(ph_check_signal):  # Integer that describes results from pH check / ad
    if (ph_check_signal == 2): # pH down adjustment
       data["ph_down_trigger"] = 1
 
-   # Web API call for pH
-   web_success = False
-   if (run_parms["enable_web_api"]):
-      AGsys("Sending data to pH web API")
-      try:
-         response = requests.post(url, data=data, timeout=5)
-         if (response.status_code != 200 and response.status_code != 201):
-            AGlog("ERROR - API pH web call failed.  Return code: " + str(response.status_code),ERROR)
-         else:
-            web_success = True
-            AGsys("pH web API successful")
-      except Exception as e:
-         AGlog("ERROR - Exception on pH web API call, possible timeout",ERROR)
-
-   # Log json in clear text to log for diagnostics
-   try:
-      file = open (PH_JSON_FILE,"a")
-      file.write(json.dumps(data,indent=4))
-      if (run_parms["enable_web_api"]):
-         if (web_success):
-            file.write("\nSuccessful call\n")
-         else:
-            file.write("\nERROR\n")
-      else:
-         file.write("\nWeb API not enabled\n")
-      file.close()
-   except Exception:
-      print("ERROR - Could not write to file: " + PH_JSON_FILE)
+   send_api("pH", url, data, PH_JSON_FILE)
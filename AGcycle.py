@@ -0,0 +1,87 @@
+# Relay cycle state machines for AutoGro
+# V23
+#
+# A water cycle, water refresh or pH dose is a list of steps.  Each step does
+# its relay work right away and then says how long to wait before the next
+# step.  The scheduler steps the cycle, so the controller keeps servicing other
+# jobs while a valve is open instead of sleeping through it.
+#
+# Cycles that run the pump are exclusive, only one holds the pump at a time and
+# the rest wait their turn in order.
+#
+# A step that raises ends its cycle, the runner's on_error gets the cycle and
+# the exception (to force its relays off) and the next waiting cycle starts.
+
+import collections
+
+class Cycle:
+   def __init__(self, name, steps, uses_pump=True, on_done=None, covers=None, relays=()):
+      self.name = name
+      self.covers = covers if covers is not None else [name] # Names this cycle counts as running, a batch covers each valve
+      self.steps = steps          # List of (action, seconds to wait after action)
+      self.uses_pump = uses_pump  # Pump cycles are run one at a time
+      self.on_done = on_done      # Called after the last step
+      self.relays = relays        # Relays the cycle switches, forced off if a step fails
+      self.state = 0              # Index of next step, len(steps) when finished
+
+   def done(self):
+      return self.state >= len(self.steps)
+
+   # Run the next step, return seconds until the following one or None when finished
+   def step(self):
+      action, delay = self.steps[self.state]
+      action()
+      self.state = self.state + 1
+      if (self.done()):
+         if (self.on_done is not None):
+            self.on_done()
+         return None
+      return delay
+
+class CycleRunner:
+   def __init__(self, scheduler, on_error=None):
+      self.scheduler = scheduler
+      self.on_error = on_error            # on_error(cycle, exception) after a step raised
+      self.pump_cycle = None              # Cycle holding the pump
+      self.waiting = collections.deque()  # Pump cycles waiting their turn
+      self.active = {}                    # Running cycles by name
+
+   def busy(self): # True while any pump cycle is running or waiting
+      return self.pump_cycle is not None
+
+   def running(self, name):
+      return any(name in c.covers for c in self.active.values()) or any(name in c.covers for c in self.waiting)
+
+   # Start a cycle now, or queue it if it needs the pump and the pump is busy
+   def start(self, cycle):
+      if (cycle.uses_pump):
+         if (self.pump_cycle is not None):
+            self.waiting.append(cycle)
+            return False
+         self.pump_cycle = cycle
+      self.active[cycle.name] = cycle
+      self.scheduler.after(0, "cycle_" + cycle.name, lambda: self._step(cycle))
+      return True
+
+   def _step(self, cycle):
+      try:
+         delay = cycle.step()
+      except Exception as e:
+         self.active.pop(cycle.name, None)
+         try:
+            if (self.on_error is not None):
+               self.on_error(cycle, e) # Relays off before the next cycle takes the pump
+         finally:
+            self._release(cycle)
+         return None
+      if (delay is not None):
+         return delay
+      del self.active[cycle.name]
+      self._release(cycle)
+      return None
+
+   def _release(self, cycle): # Hand the pump to the next waiting cycle
+      if (cycle is self.pump_cycle):
+         self.pump_cycle = None
+         if (self.waiting):
+            self.start(self.waiting.popleft())
@@ -0,0 +1,63 @@
+# Flow meter pulse capture for AutoGro
+# V23
+#
+# The GPIO edge callback stores the monotonic time of each pulse in a
+# preallocated ring buffer and bumps a pulse counter, nothing is allocated per
+# pulse.  The callback is the only writer and nobody ever resets the counter,
+# so no pulse is lost to a reset racing an increment.  Code that wants the
+# flow for a cycle keeps the counter value at the start (a mark) and takes
+# the difference.
+#
+# Readers never lock.  They walk back from the newest pulse, and if the
+# writer has lapped the ring while they were reading they read it again.
+
+import array
+import AGhal
+
+class FlowMeter:
+   def __init__(self, size, litres_per_pulse):
+      self.size = size
+      self.times = array.array("d", bytes(8 * size)) # Pulse times, pulse n is at n % size
+      self.count = 0                                  # Pulses since start, only the callback changes it
+      self.litres_per_pulse = litres_per_pulse
+
+   def pulse(self, channel=None): # GPIO edge callback
+      n = self.count
+      self.times[n % self.size] = AGhal.clock.monotonic()
+      self.count = n + 1 # Published after the time is stored
+
+   def since(self, mark): # Pulses since a mark taken from .count
+      return self.count - mark
+
+   def litres(self, pulses):
+      return pulses * self.litres_per_pulse
+
+   # Pulses with a time at or after start, newest first walk so the cost is the pulses counted
+   def pulses_since(self, start):
+      while (True):
+         count = self.count
+         oldest = max(0, count - self.size)
+         i = count - 1
+         while (i >= oldest and self.times[i % self.size] >= start):
+            i = i - 1
+         lowest = i if i >= oldest else oldest # Slot i was read too when the loop stopped on its time
+         if (self.count - self.size <= lowest): # Nothing read was overwritten
+            return count - 1 - i
+
+   # Flow in litres per minute over the last window seconds
+   def rate(self, window):
+      return self.litres(self.pulses_since(AGhal.clock.monotonic() - window)) * 60 / window
+
+   # Flow in litres per minute from the last two pulses, 0 if the newest is older than max_age
+   def instant_rate(self, max_age):
+      while (True):
+         count = self.count
+         if (count < 2):
+            return 0
+         t1 = self.times[(count - 1) % self.size]
+         t0 = self.times[(count - 2) % self.size]
+         if (self.count - self.size <= count - 2):
+            break
+      if (AGhal.clock.monotonic() - t1 > max_age or t1 <= t0):
+         return 0
+      return self.litres(1) * 60 / (t1 - t0)
@@ -0,0 +1,181 @@
+# Site gateway for a fleet of AutoGro nodes
+# V23
+#
+# Run on one node or any box on the LAN, from its own directory:
+#   python3 AGgateway.py [port]
+# then point each node's sensor_url, pump_url and ph_url at
+#   http://<gateway>:<port>/sensor   /pump   /ph
+# and REMOTE_PARM_URL at http://<gateway>:<port>/parms
+#
+# The gateway takes the same form posts APIsensor, APIpump and APIpH send.
+# Payloads already seen (a node replaying its outbox after a timeout) are
+# dropped, the rest go into the gateway's own outbox (AGoutbox) and a single
+# uploader sends them upstream.  With GATEWAY_BULK_URL set, each batch goes up
+# as one gzipped json list in one request.  Without it the payloads go to the
+# normal per payload URLs from run_parms, still over one keep-alive session.
+# Bulk is off by default because the upstream server needs an endpoint that
+# takes the list, see ReadMe.md.
+#
+# Remote parms are fetched upstream by one AGremote.ConfigSync and served to
+# every node from memory with an ETag, so an unchanged config costs the nodes
+# a 304 and the upstream server one request per poll for the whole site.
+
+import collections
+import gzip
+import hashlib
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import AGhal
+import AGoutbox
+import AGremote
+import AGuploader
+from AGconfig import AGlog, AGsys, ERROR, run_parms, read_parm_file, update_parms
+from AGconfig import GATEWAY_PORT, GATEWAY_LOG, GATEWAY_OUTBOX_FILE, GATEWAY_OUTBOX_MAX_ROWS, GATEWAY_BULK_URL, \
+   GATEWAY_BATCH_WINDOW, GATEWAY_BATCH_SIZE, GATEWAY_DEDUPE_SIZE, OUTBOX_MAX_BYTES, UPLOAD_TIMEOUT, \
+   BREAKER_FAILURES, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN, \
+   REMOTE_PARM_URL, REMOTE_PARM_INTERVAL, REMOTE_PARM_JITTER, REMOTE_PARM_TIMEOUT, REMOTE_PARM_MAX_BACKOFF
+
+# Uploader that sends each outbox batch as one compressed request
+class BulkUploader(AGuploader.Uploader):
+   def __init__(self, url, outbox, batch_window, batch_size, timeout, breaker, apis):
+      AGuploader.Uploader.__init__(self, outbox, batch_window, batch_size, timeout, breaker, apis)
+      self.url = url
+
+   def send_batch(self):
+      rows = self.outbox.batch(self.batch_size)
+      if (not rows):
+         return True
+      body = gzip.compress(json.dumps([{"type": name, "data": data} for row_id, name, url, json_file, data in rows]).encode())
+      headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+      try:
+         response = self.session(self.url).post(self.url, data=body, headers=headers, timeout=self.timeout)
+      except Exception as e:
+         self.sessions.pop(urlsplit(self.url).netloc, None)
+         self.breaker.failure()
+         AGlog("ERROR - Exception on bulk upload of " + str(len(rows)) + " payload(s): " + str(e),ERROR)
+         return False
+      if (response.status_code != 200 and response.status_code != 201):
+         self.breaker.failure()
+         AGlog("ERROR - Bulk upload failed.  Return code: " + str(response.status_code),ERROR)
+         return False
+      self.breaker.success()
+      self.outbox.delete([row[0] for row in rows])
+      AGlog("Bulk upload of " + str(len(rows)) + " payload(s), " + str(len(body)) + " bytes",GATEWAY_LOG)
+      return True
+
+class Gateway:
+   def __init__(self, uploader, dedupe_size):
+      self.uploader = uploader
+      self.seen = collections.OrderedDict() # Digests of recent payloads, oldest first
+      self.dedupe_size = dedupe_size
+      self.lock = threading.Lock()
+      self.parms_body = None               # Cached remote parms, as the nodes expect them
+      self.parms_etag = None
+      self.received = 0
+      self.duplicates = 0
+
+   # Store one node payload, returns False if it was a duplicate
+   def accept(self, name, body):
+      digest = hashlib.sha1(name.encode() + b"\0" + body).digest()
+      with self.lock:
+         if (digest in self.seen):
+            self.duplicates = self.duplicates + 1
+            return False
+         self.seen[digest] = True
+         if (len(self.seen) > self.dedupe_size):
+            self.seen.popitem(last=False)
+         self.received = self.received + 1
+      data = dict(parse_qsl(body.decode()))
+      self.uploader.submit(name, run_parms[name + "_url"], data, None)
+      return True
+
+   def set_parms(self, parms):
+      body = json.dumps([parms]).encode()
+      with self.lock:
+         self.parms_body = body
+         self.parms_etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+   def poll_parms(self, sync): # Thread, keeps the parm cache current
+      while (True):
+         status, parms = sync.fetch()
+         if (status == AGremote.CHANGED):
+            AGlog("Remote parms changed upstream",GATEWAY_LOG)
+            self.set_parms(parms)
+         AGhal.clock.sleep(sync.next_delay())
+
+PATHS = {"/sensor": "sensor", "/pump": "pump", "/ph": "ph"} # Path -> run_parms url key prefix and outbox name
+
+def make_handler(gateway):
+   class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1" # Keep-alive for the nodes' sessions
+
+      def log_message(self, format, *args): # Quiet, requests are counted instead
+         pass
+
+      def reply(self, code, body=b"", headers={}):
+         self.send_response(code)
+         for key, value in headers.items():
+            self.send_header(key, value)
+         self.send_header("Content-Length", str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def do_POST(self):
+         length = int(self.headers.get("Content-Length", 0))
+         body = self.rfile.read(length)
+         name = PATHS.get(urlsplit(self.path).path)
+         if (name is None):
+            self.reply(404)
+            return
+         try:
+            gateway.accept(name, body)
+         except Exception as e:
+            AGlog("ERROR - Gateway could not store " + name + " payload: " + str(e),ERROR)
+            self.reply(500)
+            return
+         self.reply(201) # Duplicates are acknowledged too, the node can drop them
+
+      def do_GET(self):
+         if (urlsplit(self.path).path != "/parms"):
+            self.reply(404)
+            return
+         with gateway.lock:
+            body = gateway.parms_body
+            etag = gateway.parms_etag
+         if (body is None):
+            self.reply(503)
+         elif (self.headers.get("If-None-Match") == etag):
+            self.reply(304, b"", {"ETag": etag})
+         else:
+            self.reply(200, body, {"ETag": etag, "Content-Type": "application/json"})
+
+   return Handler
+
+def main():
+   port = int(sys.argv[1]) if len(sys.argv) > 1 else GATEWAY_PORT
+   file_parms = read_parm_file() # Upstream URLs come from the parm file like on a node
+   if (file_parms):
+      update_parms(file_parms)
+   outbox = AGoutbox.Outbox(GATEWAY_OUTBOX_FILE,GATEWAY_OUTBOX_MAX_ROWS,OUTBOX_MAX_BYTES)
+   breaker = AGuploader.Breaker(BREAKER_FAILURES,BREAKER_COOLDOWN,BREAKER_MAX_COOLDOWN)
+   if (GATEWAY_BULK_URL):
+      uploader = BulkUploader(GATEWAY_BULK_URL,outbox,GATEWAY_BATCH_WINDOW,GATEWAY_BATCH_SIZE,UPLOAD_TIMEOUT,breaker,PATHS.values())
+   else:
+      uploader = AGuploader.Uploader(outbox,GATEWAY_BATCH_WINDOW,GATEWAY_BATCH_SIZE,UPLOAD_TIMEOUT,breaker,PATHS.values())
+   gateway = Gateway(uploader,GATEWAY_DEDUPE_SIZE)
+   uploader.start() # Sends any backlog left from the last run
+   sync = AGremote.ConfigSync(REMOTE_PARM_URL,REMOTE_PARM_INTERVAL,REMOTE_PARM_JITTER,REMOTE_PARM_TIMEOUT,REMOTE_PARM_MAX_BACKOFF)
+   threading.Thread(target=gateway.poll_parms, args=(sync,), daemon=True).start()
+   server = ThreadingHTTPServer(("", port), make_handler(gateway))
+   AGsys("AutoGro gateway listening on port " + str(port) + ", bulk url: " + (GATEWAY_BULK_URL or "none"))
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   AGsys("Gateway exit, received: " + str(gateway.received) + " duplicates: " + str(gateway.duplicates))
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,388 @@
+# Hardware abstraction layer for AutoGro
+# V23
+#
+# Every pin, A to D and serial port access goes through this module so the
+# controller can run on a wired Pi ("pi" backend) or on a plain Linux box with
+# simulated hardware ("sim" backend).  The clock is also pluggable, the sim
+# backend uses a scaled clock so a 24 hour schedule can run in seconds.
+#
+# Rest of the code uses this module as:
+#   AGhal.clock.time() / AGhal.clock.monotonic() / AGhal.clock.sleep()
+#   AGhal.gpio        - RPi.GPIO module or a simulated stand in with the same calls
+#   AGhal.analog_in() - MCP3008 channel with .value and .voltage
+#   AGhal.adc_scan()  - burst read of several MCP3008 channels into a buffer
+#   AGhal.serial_port() - serial.Serial or simulated pH probe
+#   AGhal.usb_reset() - USB bus reset for the pH probe problem
+
+import random
+import threading
+import time
+
+################### Clocks ######################################################
+# Real clock, straight pass through to the time module
+class RealClock:
+   speed = 1
+
+   def time(self): # Wall clock seconds, used for log time stamps
+      return time.time()
+
+   def monotonic(self): # Never jumps, used for all timers
+      return time.monotonic()
+
+   def sleep(self, secs):
+      if (secs > 0):
+         time.sleep(secs)
+
+   def wait(self, cond, timeout): # Wait on a threading Event or Condition with clock time timeout
+      return cond.wait(timeout)
+
+# Scaled clock, simulated time runs speed times faster than real time
+# Both wall and monotonic time are derived from one real monotonic base so
+# every thread sees the same simulated time
+class SimClock:
+   def __init__(self, speed=1, start=None):
+      self.speed = float(speed)
+      self.real_base = time.monotonic()
+      self.wall_base = time.time() if start is None else start
+
+   def elapsed(self): # Simulated seconds since clock was created
+      return (time.monotonic() - self.real_base) * self.speed
+
+   def time(self):
+      return self.wall_base + self.elapsed()
+
+   def monotonic(self):
+      return self.elapsed()
+
+   def sleep(self, secs):
+      if (secs > 0):
+         time.sleep(secs / self.speed)
+
+   def wait(self, cond, timeout):
+      if (timeout is None):
+         return cond.wait()
+      return cond.wait(max(timeout, 0) / self.speed)
+
+clock = RealClock()
+
+def set_clock(new_clock): # Inject a clock, must be done before threads start
+   global clock
+   clock = new_clock
+
+################### Simulated plant #############################################
+# Very small model of the grow system so the sim backend returns believable
+# values.  Relay outputs feed back into the model: pump plus valve wets a soil
+# bed, pH up/down relays move the pH, pump flow drives the flow meter.
+class SimPlant:
+   SOIL_DRY = 49000          # Raw A to D soil value for 100% dry, matches run_parms default
+   SOIL_WET = 21000          # Raw A to D soil value for 100% wet
+   DRY_RATE = 1 / 20000      # Soil moisture lost per second (fraction of full scale)
+   WET_RATE = 1 / 60         # Soil moisture gained per second of watering
+   PH_DRIFT = 0.5 / 86400    # pH rise per second, nutrient water tends to drift up
+   PH_DOSE = 0.05            # pH change per second of pH up/down relay open
+   FLOW_HZ = 7.5             # Flow meter pulses per second with pump running
+   TDS_VOLTAGE = 0.9         # TDS probe voltage, roughly 400 ppm
+
+   def __init__(self, valves=5, seed=None):
+      self.lock = threading.Lock()
+      self.rand = random.Random(seed)
+      self.moisture = [0.5] * valves
+      self.pH = 6.5
+      self.ph_probe_connected = True
+      self.pump = False
+      self.valves = [False] * valves
+      self.ph_up = False
+      self.ph_down = False
+      self.last_update = None
+      self.pump_seconds = 0.0     # Total time pump has run, drives the flow meter
+
+   def update(self, now): # Integrate model up to now, called with lock held
+      if (self.last_update is None):
+         self.last_update = now
+         return
+      dt = now - self.last_update
+      if (dt <= 0):
+         return
+      self.last_update = now
+      if (self.pump):
+         self.pump_seconds = self.pump_seconds + dt
+      for i in range(len(self.moisture)):
+         if (self.pump and self.valves[i]):
+            self.moisture[i] = min(1.0, self.moisture[i] + self.WET_RATE * dt)
+         else:
+            self.moisture[i] = max(0.0, self.moisture[i] - self.DRY_RATE * dt)
+      self.pH = self.pH + self.PH_DRIFT * dt
+      if (self.ph_up):
+         self.pH = self.pH + self.PH_DOSE * dt
+      if (self.ph_down):
+         self.pH = self.pH - self.PH_DOSE * dt
+
+   def set_relays(self, now, pump, valves, ph_up, ph_down):
+      with self.lock:
+         self.update(now)
+         self.pump = pump
+         self.valves = valves
+         self.ph_up = ph_up
+         self.ph_down = ph_down
+
+   def soil_raw(self, now, channel):
+      with self.lock:
+         self.update(now)
+         moisture = self.moisture[channel]
+         noise = self.rand.gauss(0, 150)
+      return int(self.SOIL_DRY - moisture * (self.SOIL_DRY - self.SOIL_WET) + noise)
+
+   def tds_voltage(self, now):
+      with self.lock:
+         return max(0.0, self.TDS_VOLTAGE + self.rand.gauss(0, .01))
+
+   def pH_reading(self, now):
+      with self.lock:
+         self.update(now)
+         return self.pH + self.rand.gauss(0, .02)
+
+   def pumped(self, now): # Seconds of pump run time so far
+      with self.lock:
+         self.update(now)
+         return self.pump_seconds
+
+################### Simulated GPIO ##############################################
+# Same calls and constants as RPi.GPIO for the parts AutoGro uses
+class SimGPIO:
+   BCM = 11
+   BOARD = 10
+   OUT = 0
+   IN = 1
+   LOW = 0
+   HIGH = 1
+   PUD_OFF = 20
+   PUD_DOWN = 21
+   PUD_UP = 22
+   RISING = 31
+   FALLING = 32
+   BOTH = 33
+
+   FLOW_TICK = .02 # Real seconds between flow pulse batches
+
+   def __init__(self, plant, relay_pins, flow_pin, ph_up_relay, ph_down_relay):
+      self.plant = plant
+      self.relay_pins = list(relay_pins)
+      self.flow_pin = flow_pin
+      self.ph_up_relay = ph_up_relay
+      self.ph_down_relay = ph_down_relay
+      self.pins = {}
+      self.flow_thread = None
+
+   def setmode(self, mode):
+      self.mode = mode
+
+   def setwarnings(self, flag):
+      pass
+
+   def setup(self, pin, direction, pull_up_down=None, initial=None):
+      self.pins.setdefault(pin, 0)
+      if (initial is not None):
+         self.output(pin, initial)
+
+   def output(self, pin, value):
+      self.pins[pin] = 1 if value else 0
+      if (pin in self.relay_pins):
+         states = [self.pins.get(p, 0) == 1 for p in self.relay_pins]
+         self.plant.set_relays(clock.monotonic(), states[0], states[1:self.ph_up_relay], \
+            states[self.ph_up_relay], states[self.ph_down_relay])
+
+   def input(self, pin):
+      return self.pins.get(pin, 0)
+
+   def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+      if (pin == self.flow_pin and self.flow_thread is None):
+         self.flow_thread = threading.Thread(target=self._flow_pulses, args=(callback,), daemon=True)
+         self.flow_thread.start()
+
+   def remove_event_detect(self, pin):
+      pass
+
+   def cleanup(self):
+      self.pins = {}
+
+   def _flow_pulses(self, callback): # Generate flow meter pulses for the pump run time
+      sent = 0
+      while (True):
+         time.sleep(min(self.FLOW_TICK, 1 / clock.speed)) # At least one batch per simulated second
+         owed = int(self.plant.pumped(clock.monotonic()) * self.plant.FLOW_HZ)
+         while (sent < owed):
+            sent = sent + 1
+            callback(self.flow_pin)
+
+################### Simulated MCP3008 channel ###################################
+class SimAnalogIn:
+   TDS_CHANNEL = 7
+
+   def __init__(self, plant, channel):
+      self.plant = plant
+      self.channel = channel
+
+   @property
+   def value(self): # 16 bit value like adafruit AnalogIn
+      if (self.channel == self.TDS_CHANNEL):
+         return int(self.voltage * 65535 / 3.3)
+      if (self.channel < len(self.plant.moisture)):
+         return max(0, min(65535, self.plant.soil_raw(clock.monotonic(), self.channel)))
+      return 0
+
+   @property
+   def voltage(self):
+      if (self.channel == self.TDS_CHANNEL):
+         return self.plant.tds_voltage(clock.monotonic())
+      return self.value * 3.3 / 65535
+
+################### Simulated pH probe serial port ##############################
+# Probe streams one "x.xx\r" reading per second like the USB pH probe
+class SimSerial:
+   LINE_TIME = 1 # Seconds between pH readings from probe
+
+   def __init__(self, plant, port, baudrate=9600, timeout=None):
+      if (not plant.ph_probe_connected):
+         raise OSError(2, "could not open port " + port + ": No such file or directory")
+      self.plant = plant
+      self.port = port
+      self.timeout = timeout
+      self.buf = bytearray()
+      self.next_line = clock.monotonic() + self.LINE_TIME
+      self.is_open = True
+
+   def _fill(self):
+      now = clock.monotonic()
+      while (self.next_line <= now):
+         if (self.plant.ph_probe_connected):
+            self.buf += ("%.2f\r" % self.plant.pH_reading(self.next_line)).encode()
+         self.next_line = self.next_line + self.LINE_TIME
+
+   @property
+   def in_waiting(self):
+      self._fill()
+      return len(self.buf)
+
+   def read(self, size=1):
+      if (not self.is_open):
+         raise OSError("Attempting to use a port that is not open")
+      end = None if self.timeout is None else clock.monotonic() + self.timeout
+      while (True):
+         self._fill()
+         if (len(self.buf) >= size):
+            break
+         now = clock.monotonic()
+         if (end is not None and now >= end):
+            break
+         wake = self.next_line if end is None else min(self.next_line, end)
+         clock.sleep(wake - now)
+      data = bytes(self.buf[:size])
+      del self.buf[:size]
+      return data
+
+   def readline(self, size=-1): # pyserial semantics, stop at newline or size bytes
+      line = bytearray()
+      while (size < 0 or len(line) < size):
+         c = self.read(1)
+         if (c == b""):
+            break
+         line += c
+         if (c == b"\n"):
+            break
+      return bytes(line)
+
+   def reset_input_buffer(self):
+      self.buf = bytearray()
+
+   def close(self):
+      self.is_open = False
+
+################### Backend selection ###########################################
+backend = None
+gpio = None
+plant = None
+_mcp = None
+_mcp_lock = threading.Lock()
+
+# Select hardware backend, called once at startup before any device access
+# A sim run can be given its own plant and clock start, AGreplay does this
+def init(backend_name, relay_pins, flow_pin, ph_up_relay, ph_down_relay, sim_speed=1, sim_plant=None, sim_start=None):
+   global backend, gpio, plant
+   if (backend_name == "pi"):
+      import RPi.GPIO # Imported here so sim runs do not need Pi libraries
+      gpio = RPi.GPIO
+   elif (backend_name == "sim"):
+      set_clock(SimClock(sim_speed, sim_start))
+      plant = SimPlant(len(relay_pins) - 3) if sim_plant is None else sim_plant
+      gpio = SimGPIO(plant, relay_pins, flow_pin, ph_up_relay, ph_down_relay)
+   else:
+      raise ValueError("Unknown hardware backend: " + str(backend_name))
+   backend = backend_name
+
+def _get_mcp(): # MCP3008 object, created on first use
+   global _mcp
+   with _mcp_lock:
+      if (_mcp is None):
+         import board
+         import busio
+         import digitalio
+         import adafruit_mcp3xxx.mcp3008 as MCP
+         spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI) # create the spi bus
+         cs = digitalio.DigitalInOut(board.D17) # create the cs (chip select)
+         _mcp = MCP.MCP3008(spi,cs) # create the mcp object
+   return _mcp
+
+# Get a MCP3008 A to D input channel, object has .value and .voltage
+def analog_in(channel):
+   if (backend == "sim"):
+      return SimAnalogIn(plant, channel)
+   from adafruit_mcp3xxx.analog_in import AnalogIn
+   return AnalogIn(_get_mcp(), channel)
+
+# Read channels oversample times into out, sample s of channel i goes to
+# out[s * len(channels) + i], values are 16 bit like AnalogIn.value.
+# On the Pi the SPI bus is locked and configured once for the whole scan and
+# each conversion is a single 3 byte transfer, instead of a lock, configure
+# and object lookup per AnalogIn.value call.
+def adc_scan(channels, oversample, out):
+   i = 0
+   if (backend == "sim"):
+      inputs = [SimAnalogIn(plant, ch) for ch in channels]
+      for s in range(oversample):
+         for a in inputs:
+            out[i] = a.value
+            i = i + 1
+      return
+   device = _get_mcp()._spi_device # adafruit SPIDevice, bus and chip select
+   commands = [bytes([0x01, (0x08 | ch) << 4, 0x00]) for ch in channels] # Start bit, single ended, channel
+   reply = bytearray(3)
+   spi = device.spi
+   cs = device.chip_select
+   with _mcp_lock:
+      while (not spi.try_lock()):
+         pass
+      try:
+         spi.configure(baudrate=device.baudrate, polarity=device.polarity, phase=device.phase)
+         for s in range(oversample):
+            for command in commands:
+               cs.value = False # MCP3008 starts a conversion on each chip select edge
+               spi.write_readinto(command, reply)
+               cs.value = True
+               out[i] = (((reply[1] & 0x03) << 8) | reply[2]) << 6 # 10 bit result scaled to 16 bits
+               i = i + 1
+      finally:
+         spi.unlock()
+
+# Open serial port, pH probe is the only serial device
+def serial_port(port, baudrate, timeout=None):
+   if (backend == "sim"):
+      return SimSerial(plant, port, baudrate, timeout)
+   import serial
+   return serial.Serial(port, baudrate, timeout=timeout)
+
+# Reset the USB bus to recover the pH probe, device is an AGusb.Device, returns its result
+def usb_reset(device, port):
+   if (backend == "sim"):
+      plant.ph_probe_connected = True
+      return "ok"
+   return device.reset(port)
@@ -0,0 +1,125 @@
+# Buffered log writer for AutoGro
+# V23
+#
+# AGsys, AGlog and the json logs hand their lines to one writer thread and
+# return at once, no log call waits on the SD card.  The writer gathers lines
+# and writes each file in one go when enough bytes are waiting or the flush
+# interval is up, file handles stay open between flushes.
+#
+# Rotation is done here instead of the nightly Scripts/wrap copy.  A log is
+# rotated when it passes the size limit or at the first write on a new day:
+# file.log3 -> file.log4 ... file.log -> file.log1, each a single rename, and
+# a fresh file.log is started.  Anything past the last generation is dropped.
+#
+# Lines for CONSOLE go to stdout from the writer thread too, stdout is often
+# redirected to a log on the SD card (Scripts/start2).
+
+import atexit
+import os
+import sys
+import threading
+from datetime import date
+import AGhal
+
+CONSOLE = "-" # File name for stdout, never rotated
+
+class LogWriter:
+   def __init__(self, flush_bytes, flush_interval, max_bytes, generations, max_pending, error_file):
+      self.flush_bytes = flush_bytes        # Flush when this many bytes are waiting
+      self.flush_interval = flush_interval  # Flush at least this often in seconds while lines are waiting
+      self.max_bytes = max_bytes            # Rotate a log when it grows past this size
+      self.generations = generations        # Number of old logs kept, file.log1 to file.logN
+      self.max_pending = max_pending        # Lines are dropped rather than grow the buffer past this
+      self.error_file = error_file          # Where dropped line counts are reported
+      self.cond = threading.Condition()
+      self.flush_lock = threading.Lock()    # One flush at a time, writer thread or exit
+      self.pending = []                     # (file name, text) waiting to be written
+      self.pending_bytes = 0
+      self.dropped = 0
+      self.files = {}                       # Open logs, name -> [file, size, day opened]
+      self.thread = None
+
+   # Queue text for a log file, never blocks on disk
+   def write(self, file_name, text):
+      with self.cond:
+         if (self.thread is None): # Writer starts with the first line
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush) # Nothing queued is lost on a normal exit
+         if (self.pending_bytes + len(text) > self.max_pending):
+            self.dropped = self.dropped + 1
+            return
+         self.pending.append((file_name, text))
+         self.pending_bytes = self.pending_bytes + len(text)
+         if (len(self.pending) == 1 or self.pending_bytes >= self.flush_bytes):
+            self.cond.notify()
+
+   def run(self):
+      while (True):
+         with self.cond:
+            while (not self.pending):
+               AGhal.clock.wait(self.cond, None)
+            end = AGhal.clock.monotonic() + self.flush_interval
+            while (self.pending_bytes < self.flush_bytes):
+               wait = end - AGhal.clock.monotonic()
+               if (wait <= 0):
+                  break
+               AGhal.clock.wait(self.cond, wait)
+         self.flush()
+
+   # Write everything queued so far, one write per file
+   def flush(self):
+      with self.flush_lock:
+         with self.cond:
+            batch = self.pending
+            dropped = self.dropped
+            self.pending = []
+            self.pending_bytes = 0
+            self.dropped = 0
+         if (dropped):
+            batch.append((self.error_file, "Log buffer full, dropped " + str(dropped) + " line(s)\n"))
+         by_file = {}
+         for file_name, text in batch:
+            by_file.setdefault(file_name, []).append(text)
+         for file_name, texts in by_file.items():
+            data = "".join(texts)
+            try:
+               if (file_name == CONSOLE):
+                  sys.stdout.write(data)
+                  sys.stdout.flush()
+                  continue
+               entry = self.open(file_name)
+               entry[0].write(data)
+               entry[0].flush()
+               entry[1] = entry[1] + len(data)
+               if (entry[1] >= self.max_bytes):
+                  self.rotate(file_name)
+            except Exception:
+               self.files.pop(file_name, None)
+               print("ERROR - Could not write to file: " + file_name)
+
+   def open(self, file_name): # Open handle for a log, rotating first if it is from an earlier day
+      today = date.fromtimestamp(AGhal.clock.time())
+      entry = self.files.get(file_name)
+      if (entry is not None and entry[2] != today and entry[1] > 0):
+         self.rotate(file_name)
+         entry = None
+      if (entry is None):
+         if (os.path.exists(file_name)):
+            stat = os.stat(file_name)
+            if (stat.st_size > 0 and date.fromtimestamp(stat.st_mtime) != today):
+               self.rotate(file_name)
+         file = open(file_name, "a")
+         entry = [file, file.tell(), today]
+         self.files[file_name] = entry
+      return entry
+
+   def rotate(self, file_name): # Shift generations up by one with renames, start an empty log
+      entry = self.files.pop(file_name, None)
+      if (entry is not None):
+         entry[0].close()
+      for gen in range(self.generations - 1, 0, -1):
+         if (os.path.exists(file_name + str(gen))):
+            os.replace(file_name + str(gen), file_name + str(gen + 1))
+      if (os.path.exists(file_name)):
+         os.replace(file_name, file_name + "1")
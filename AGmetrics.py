@@ -0,0 +1,161 @@
+# Counters, gauges and latency histograms for AutoGro
+# V23
+#
+# Hot paths update a metric object they got once at import, which is a lock
+# and an add, nothing is formatted or written.  The text is only built when
+# something scrapes the endpoint:
+#   curl http://localhost:METRICS_PORT/metrics      (Prometheus text format)
+# It only listens on localhost unless METRICS_HOST opens it to the LAN.
+#
+# Counters are made with their base name and exported as <name>_total, which
+# is also the name on their HELP and TYPE lines.
+#
+# Metrics with labels are separate objects sharing a name, e.g.
+#   AGmetrics.histogram("ag_api_post_seconds", "...", {"api": "sensor"})
+
+import bisect
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60) # Seconds, histograms add +Inf
+
+metrics = {}              # (name, labels) -> metric, in the order made
+info = {}                 # name -> (type, help)
+_lock = threading.Lock()  # Guards the two dicts above
+
+class Counter:
+   def __init__(self):
+      self.value = 0
+      self.lock = threading.Lock()
+
+   def inc(self, n=1):
+      with self.lock:
+         self.value = self.value + n
+
+   def samples(self, name, labels):
+      return [(name + "_total", labels, self.value)]
+
+class Gauge:
+   def __init__(self, fn=None):
+      self.value = 0
+      self.fn = fn # Called at scrape time if set, for values that are cheaper to read than to track
+
+   def set(self, value):
+      self.value = value
+
+   def samples(self, name, labels):
+      value = self.value
+      if (self.fn is not None):
+         try:
+            value = self.fn()
+         except Exception:
+            value = math.nan
+      return [(name, labels, value)]
+
+class Histogram:
+   def __init__(self, buckets):
+      self.buckets = buckets
+      self.counts = [0] * (len(buckets) + 1) # Last one is +Inf
+      self.sum = 0.0
+      self.lock = threading.Lock()
+
+   def observe(self, value):
+      i = bisect.bisect_left(self.buckets, value)
+      with self.lock:
+         self.counts[i] = self.counts[i] + 1
+         self.sum = self.sum + value
+
+   def time(self): # with metric.time(): ...  observes the wall time of the block
+      return _Timer(self)
+
+   def samples(self, name, labels):
+      with self.lock:
+         counts = list(self.counts)
+         total = self.sum
+      out = []
+      cumulative = 0
+      for bound, count in zip(list(self.buckets) + [math.inf], counts):
+         cumulative = cumulative + count
+         out.append((name + "_bucket", labels + (("le", "+Inf" if bound == math.inf else repr(bound)),), cumulative))
+      out.append((name + "_sum", labels, total))
+      out.append((name + "_count", labels, cumulative))
+      return out
+
+class _Timer:
+   def __init__(self, histogram):
+      self.histogram = histogram
+
+   def __enter__(self):
+      self.start = time.perf_counter()
+      return self
+
+   def __exit__(self, *exc):
+      self.histogram.observe(time.perf_counter() - self.start)
+      return False
+
+def _get(kind, name, help, labels, make):
+   key = (name, tuple(sorted(labels.items())) if labels else ())
+   with _lock:
+      if (key not in metrics):
+         metrics[key] = make()
+         info.setdefault(name, (kind, help))
+      return metrics[key]
+
+def counter(name, help, labels=None):
+   return _get("counter", name, help, labels, Counter)
+
+def gauge(name, help, labels=None, fn=None):
+   return _get("gauge", name, help, labels, lambda: Gauge(fn))
+
+def histogram(name, help, labels=None, buckets=BUCKETS):
+   return _get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+def _format(value):
+   if (value == math.inf):
+      return "+Inf"
+   return repr(float(value)) if type(value) == float else str(value)
+
+# All metrics in Prometheus text format
+def render():
+   with _lock:
+      items = list(metrics.items())
+      types = dict(info)
+   lines = []
+   done = set()
+   for (name, labels), metric in sorted(items, key=lambda item: item[0][0]):
+      if (name not in done):
+         done.add(name)
+         family = name + "_total" if types[name][0] == "counter" else name # Same name as the samples
+         lines.append("# HELP " + family + " " + types[name][1])
+         lines.append("# TYPE " + family + " " + types[name][0])
+      for sample, sample_labels, value in metric.samples(name, labels):
+         text = sample
+         if (sample_labels):
+            text = text + "{" + ",".join(k + '="' + str(v) + '"' for k, v in sample_labels) + "}"
+         lines.append(text + " " + _format(value))
+   return "\n".join(lines) + "\n"
+
+class _Handler(BaseHTTPRequestHandler):
+   def log_message(self, format, *args):
+      pass
+
+   def do_GET(self):
+      if (self.path.split("?")[0] != "/metrics"):
+         self.send_response(404)
+         self.end_headers()
+         return
+      body = render().encode()
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+# Serve /metrics from a daemon thread, returns the server
+def serve(port, host="127.0.0.1"):
+   server = ThreadingHTTPServer((host, port), _Handler)
+   server.daemon_threads = True
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   return server
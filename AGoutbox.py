@@ -0,0 +1,65 @@
+# Store and forward outbox for AutoGro web API payloads
+# V23
+#
+# Every payload is written to a small SQLite database (WAL mode) before any
+# web call is tried, so readings taken while the site is offline are sent once
+# the network comes back instead of being lost.  Rows are deleted only after
+# the backend accepts them.  Disk use is capped, when the outbox is over its
+# row or byte limit the oldest payloads are evicted first.
+
+import json
+import sqlite3
+import threading
+import AGhal
+
+class Outbox:
+   def __init__(self, path, max_rows, max_bytes):
+      self.path = path
+      self.max_rows = max_rows
+      self.max_bytes = max_bytes
+      self.lock = threading.Lock() # One connection shared by all threads
+      self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+      self.db.execute("PRAGMA journal_mode=WAL")
+      self.db.execute("PRAGMA synchronous=NORMAL") # WAL stays consistent through a crash, put never waits on an fsync
+      self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, url TEXT, " \
+         "json_file TEXT, data TEXT, created REAL)")
+      self.page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+      self.rows = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] # Kept up to date, no COUNT(*) per insert
+
+   # Persist one payload, returns number of old payloads evicted to stay under the caps
+   def put(self, name, url, data, json_file):
+      with self.lock:
+         self.db.execute("INSERT INTO outbox (name, url, json_file, data, created) VALUES (?,?,?,?,?)", \
+            (name, url, json_file, json.dumps(data), AGhal.clock.time()))
+         self.rows = self.rows + 1
+         return self._evict()
+
+   def _evict(self): # Called with lock held
+      evicted = 0
+      if (self.rows > self.max_rows):
+         evicted = self._drop_oldest(self.rows - self.max_rows)
+      used = (self.db.execute("PRAGMA page_count").fetchone()[0] - self.db.execute("PRAGMA freelist_count").fetchone()[0]) \
+         * self.page_size
+      if (used > self.max_bytes and self.rows > 1): # Drop the oldest tenth, freed pages get reused for new rows
+         evicted = evicted + self._drop_oldest(max(1, self.rows // 10))
+      return evicted
+
+   def _drop_oldest(self, n): # Called with lock held, returns rows deleted
+      deleted = self.db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (n,)).rowcount
+      self.rows = self.rows - deleted
+      return deleted
+
+   # Oldest payloads first, list of (id, name, url, json_file, data)
+   def batch(self, limit):
+      with self.lock:
+         rows = self.db.execute("SELECT id, name, url, json_file, data FROM outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+      return [(r[0], r[1], r[2], r[3], json.loads(r[4])) for r in rows]
+
+   def delete(self, ids):
+      if (not ids):
+         return
+      with self.lock:
+         self.rows = self.rows - self.db.execute("DELETE FROM outbox WHERE id IN (" + ",".join("?" * len(ids)) + ")", ids).rowcount
+
+   def count(self):
+      return self.rows
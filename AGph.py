@@ -0,0 +1,167 @@
+# pH probe serial reader for AutoGro
+# V23
+#
+# The USB pH probe streams one reading per second as "x.xx\r".  A single reader
+# thread keeps the port open, reads whatever bytes are waiting in one call,
+# splits them on \r and keeps a rolling window of time stamped readings.
+# get_pH() then just looks at the window and returns at once.
+#
+# Opening and closing the port for every sample was the likely trigger for
+# the USB faults, the port is now only reopened after it fails.
+#
+# Each reading also feeds PHEstimator, a constant cost per reading filter:
+# median of the last three readings, then an exponential moving average and
+# variance.  Readings far outside the running spread are dropped as outliers,
+# unless they keep coming, which means the pH really moved.
+
+import collections
+import math
+import threading
+import AGhal
+import AGconfig
+
+class PHEstimator:
+   def __init__(self, alpha, outlier_sigma, outlier_floor, outlier_reset):
+      self.alpha = alpha                  # EMA weight of a new reading
+      self.outlier_sigma = outlier_sigma  # Readings this many std devs from the mean are outliers
+      self.outlier_floor = outlier_floor  # Never call a reading within this much of the mean an outlier
+      self.outlier_reset = outlier_reset  # This many outliers in a row restarts the estimate at the new level
+      self.recent = collections.deque(maxlen=3)
+      self.value = None                   # Current estimate, None until the first reading
+      self.variance = 0.0
+      self.count = 0                      # Readings in the estimate since last restart
+      self.outliers = 0                   # Outliers in a row
+      self.rejected = 0                   # Total outliers dropped
+      self.time = None                    # Time of last accepted reading
+
+   def restart(self, t, x):
+      self.value = x
+      self.variance = 0.0
+      self.count = 1
+      self.outliers = 0
+      self.time = t
+
+   def update(self, t, reading):
+      self.recent.append(reading)
+      x = sorted(self.recent)[len(self.recent) // 2] # Median of up to three, knocks out single spikes
+      if (self.value is None):
+         if (len(self.recent) == 3): # Start from a median so a first bad reading can not set the level
+            self.restart(t, x)
+         return
+      diff = x - self.value
+      if (self.count >= 3 and abs(diff) > max(self.outlier_sigma * math.sqrt(self.variance), self.outlier_floor)):
+         self.outliers = self.outliers + 1
+         self.rejected = self.rejected + 1
+         if (self.outliers >= self.outlier_reset): # Level really changed, follow it
+            self.restart(t, x)
+         return
+      self.outliers = 0
+      self.value = self.value + self.alpha * diff
+      self.variance = (1 - self.alpha) * (self.variance + self.alpha * diff * diff)
+      self.count = self.count + 1
+      self.time = t
+
+   # (value, std dev, age in seconds), value is -1 before any reading
+   def estimate(self, now):
+      if (self.value is None):
+         return (-1, math.inf, math.inf)
+      return (self.value, math.sqrt(self.variance), now - self.time)
+
+class PHReader:
+   def __init__(self, port, window, reopen_delay, warn_interval, estimator):
+      self.port = port
+      self.estimator = estimator
+      self.readings = collections.deque(maxlen=window) # (monotonic time, pH)
+      self.reopen_delay = reopen_delay     # Seconds between attempts to open a failed port
+      self.warn_interval = warn_interval   # Min seconds between repeated warnings in the error log
+      self.lock = threading.Lock()
+      self.thread = None
+      self.reopen = False                  # Set to make the thread close and reopen the port
+      self.connected = False
+      self.opened_time = None              # When the port was last opened, None if never
+      self.parse_errors = 0
+      self.warn_time = {}                  # Last time each warning was logged
+
+   def start(self):
+      if (self.thread is None):
+         self.thread = threading.Thread(target=self.run, daemon=True)
+         self.thread.start()
+
+   def set_port(self, port): # Switch to a new tty, used after a config change or USB reset
+      self.port = port
+      self.reopen = True
+
+   def warn(self, key, buf): # Log a warning, at most once per warn_interval for each key
+      now = AGhal.clock.monotonic()
+      if (key not in self.warn_time or self.warn_time[key] + self.warn_interval <= now):
+         self.warn_time[key] = now
+         AGconfig.AGlog(buf,AGconfig.ERROR)
+
+   def run(self):
+      while (True):
+         self.reopen = False
+         try:
+            ser = AGhal.serial_port(self.port,9600,timeout = 1)
+         except Exception as e:
+            self.connected = False
+            self.warn("open", "ERROR - Could not open USB port with pH probe: " + str(e))
+            AGhal.clock.sleep(self.reopen_delay)
+            continue
+         self.connected = True
+         self.opened_time = AGhal.clock.monotonic()
+         try:
+            self.read_port(ser)
+         except Exception as e:
+            self.warn("read", "ERROR - pH probe serial read failed: " + str(e))
+         self.connected = False
+         try:
+            ser.close()
+         except Exception:
+            AGconfig.AGlog("ERROR - Could not close USB serial port",AGconfig.ERROR)
+
+   def read_port(self, ser): # Read until the port fails or a reopen is asked for
+      buf = b""
+      while (not self.reopen):
+         data = ser.read(max(1, ser.in_waiting)) # Block for one byte, or take everything waiting
+         if (data == b""):
+            continue # Timeout, probe is quiet
+         buf = buf + data
+         lines = buf.split(b"\r")
+         buf = lines.pop() # Last piece has no \r yet
+         for line in lines:
+            self.add_line(line)
+
+   def add_line(self, line):
+      try:
+         value = float(line.decode().strip())
+      except Exception:
+         self.parse_errors = self.parse_errors + 1
+         self.warn("parse", "WARNING - pH routine got a parse error: " + repr(line))
+         return
+      now = AGhal.clock.monotonic()
+      with self.lock:
+         self.readings.append((now, value))
+         self.estimator.update(now, value)
+
+   def last_time(self): # Time of newest reading, None if none yet
+      with self.lock:
+         if (not self.readings):
+            return None
+         return self.readings[-1][0]
+
+   # (pH, std dev, age in seconds) from the estimator
+   def estimate(self):
+      with self.lock:
+         return self.estimator.estimate(AGhal.clock.monotonic())
+
+   # Quality gated pH, -1 if the estimate is too old, too noisy or still warming up
+   def quality_pH(self, max_age, max_std, min_count):
+      with self.lock:
+         count = self.estimator.count
+         value, std, age = self.estimator.estimate(AGhal.clock.monotonic())
+      if (age > max_age or count < min_count):
+         return -1
+      if (std > max_std):
+         self.warn("noisy", "WARNING - pH reading is noisy, std dev: " + str(round(std,3)))
+         return -1
+      return round(value,2)
@@ -0,0 +1,90 @@
+# Remote config sync for AutoGro
+# V23
+#
+# Polls REMOTE_PARM_URL for the remote parms.  Each request carries the ETag
+# and Last-Modified of the last good response (If-None-Match /
+# If-Modified-Since), a 304 means nothing changed and no body is sent.  Servers
+# that ignore those headers still send a 200, the body is hashed and if it
+# matches the last one it is not parsed or compared at all.
+#
+# The poll interval gets a random jitter so a room of controllers does not
+# hit the server in step, and after a failed fetch the delay doubles up to
+# REMOTE_PARM_MAX_BACKOFF, the normal interval comes back after a good fetch.
+
+import hashlib
+import json
+import random
+import requests
+import AGconfig
+import AGmetrics
+
+fetch_seconds = AGmetrics.histogram("ag_remote_parms_seconds", "Time for one remote parm fetch")
+
+UNCHANGED = "unchanged"  # 304 or same body as last time
+CHANGED = "changed"      # New parms, fetch() returns them
+FAILED = "failed"        # No usable response, back off
+
+class ConfigSync:
+   def __init__(self, url, interval, jitter, timeout, max_backoff):
+      self.url = url
+      self.interval = interval          # Seconds between polls
+      self.jitter = jitter              # +/- fraction of interval added at random
+      self.timeout = timeout
+      self.max_backoff = max_backoff    # Longest delay after repeated failures
+      self.session = requests.Session() # Keep-alive between polls
+      self.etag = None
+      self.last_modified = None
+      self.hash = None                  # Digest of last body that parsed
+      self.failures = 0
+
+   # Fetch the remote parms, returns (status, parms), parms is the parm dict for CHANGED, else None
+   def fetch(self):
+      with fetch_seconds.time():
+         status, parms = self._fetch()
+      AGmetrics.counter("ag_remote_parms_fetches", "Remote parm fetches by result", {"result": status}).inc()
+      return (status, parms)
+
+   def _fetch(self):
+      headers = {}
+      if (self.etag is not None):
+         headers["If-None-Match"] = self.etag
+      if (self.last_modified is not None):
+         headers["If-Modified-Since"] = self.last_modified
+      try:
+         response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+      except Exception as e:
+         AGconfig.AGlog("Exception getting api parm data from website: " + str(e),AGconfig.ERROR)
+         return self.failed()
+      if (response.status_code == 304):
+         self.failures = 0
+         return (UNCHANGED, None)
+      if (response.status_code != 200):
+         AGconfig.AGlog("Could not get api parm data from website, return code: " + str(response.status_code),AGconfig.ERROR)
+         return self.failed()
+      self.failures = 0
+      digest = hashlib.sha1(response.content).digest()
+      if (digest == self.hash):
+         return (UNCHANGED, None)
+      try:
+         remote_parms = json.loads(response.content)
+         parms = remote_parms[0] # Web API sends a list holding one parm dict
+         if (type(parms) != dict):
+            raise ValueError("not a dict")
+      except Exception as e:
+         AGconfig.AGlog("Could not parse api parm data from website: " + str(e),AGconfig.ERROR)
+         return self.failed()
+      self.hash = digest
+      self.etag = response.headers.get("ETag")
+      self.last_modified = response.headers.get("Last-Modified")
+      return (CHANGED, parms)
+
+   def failed(self):
+      self.failures = self.failures + 1
+      return (FAILED, None)
+
+   # Seconds until the next poll, interval with jitter, or the back off after failures
+   def next_delay(self):
+      delay = self.interval
+      if (self.failures):
+         delay = min(self.interval * 2 ** min(self.failures, 16), self.max_backoff)
+      return delay * (1 + random.uniform(-self.jitter, self.jitter))
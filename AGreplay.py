@@ -0,0 +1,304 @@
+# Log replay for AutoGro
+# V23
+#
+# Feeds a node's recorded logs back through the controller, so a field
+# incident can be rerun on any Linux box, faster than real time and with the
+# same inputs every time:
+#   AG_HAL=replay AG_REPLAY_DIR=Example_Logs AG_SIM_SPEED=20 python3 AutoGro.py
+# or to list what a set of logs holds without running the controller:
+#   python3 AGreplay.py [dir]
+#
+# AGsensors.log, AGerror.log, AGpump.log and AGsys.log are read a line at a
+# time and merged into one time ordered event stream, no log is loaded whole.
+# The older sensor_json.log / pump_json.log are used when the matching text
+# log is missing.
+#
+# Replay runs on the sim backend with a ReplayPlant in place of the plant
+# model.  The sim clock starts at the first recorded time, and as it passes
+# each event the recorded soil raw values, TDS, pH and probe dropouts become
+# what the simulated MCP3008 and pH probe return.  The controller's sensor
+# thread, pH reader, USB reset and cached pH logic see them through their
+# normal paths.  Parms the node logged at startup or changed later are
+# applied on the scheduler, so its timers run like the node's did.
+#
+# The controller still drives the relays.  Recorded pump runs and USB resets
+# are counted and compared with the replayed ones in the summary at the end.
+
+import collections
+import heapq
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+import AGhal
+from AGconfig import *
+
+STAMP_FORMAT = "%m%d%y %H:%M:%S"             # Time stamp at the start of every text log line
+JSON_STAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"   # "accessed" time in the json logs
+SENSOR_JSON_LOG = "sensor_json.log"          # Json logs written by versions before AGseries
+PUMP_JSON_LOG = "pump_json.log"
+
+SOIL_FIELD = re.compile(r"S(\d+): (-?\d+) \((-?\d+)\)")
+PARM_DUMP = re.compile(r"Key: (\S+) +Value: (.*)$")
+PARM_UPDATE = re.compile(r"Key: (\S+) Updating value .* -> (.*) <<<<<<<<<<$")
+DISCONNECTED = "Possible disconnected soil sensor: "
+
+# Logged parm value back to the type run_parms holds, bools are 0 / 1 there
+def _value(text):
+   if (text == "True" or text == "False"):
+      return 1 if text == "True" else 0
+   for kind in (int, float):
+      try:
+         return kind(text)
+      except ValueError:
+         pass
+   return text
+
+def _number(text):
+   try:
+      return float(text)
+   except ValueError:
+      return -1
+
+# One text log line without its time stamp to (kind, data), None if it is not an input
+def text_event(text):
+   if (text.startswith("S0: ")):
+      soil = {int(ch): (0 if int(raw) == -1 else int(raw)) for ch, raw, percent in SOIL_FIELD.findall(text)}
+      wc = text.find("WC: ")
+      ph = text.find(" pH: ")
+      if (wc == -1 or ph == -1):
+         return None
+      return ("sensors", {"soil": soil, "tds": _number(text[wc + 4:ph]), "pH": _number(text[ph + 5:])})
+   if (text.startswith("Pump: ")):
+      return ("pump", text.startswith("Pump: On"))
+   if (text.startswith(DISCONNECTED)):
+      return ("soil", {int(text[len(DISCONNECTED):]): 0})
+   if (text.startswith("Key: ")):
+      match = PARM_UPDATE.match(text) or PARM_DUMP.match(text)
+      if (match):
+         return ("parm", {match.group(1): _value(match.group(2))})
+      return None
+   if (text == "Starting"):
+      return ("start", None)
+   if (text.startswith("Resetting USB bus")):
+      return ("usb_reset", None)
+   if ("Could not open USB port" in text or text.startswith("Using cached pH reading")):
+      return ("ph_lost", None)
+   if (text.endswith("TDS fault")):
+      return ("tds", -1)
+   return None
+
+# Events from a text log as (time, kind, data), a line at a time
+def text_events(path):
+   last_stamp = None
+   with open(path, "r", errors="replace") as file:
+      for line in file:
+         if (line[:15] != last_stamp): # Most lines share their second with the line before
+            try:
+               t = time.mktime(time.strptime(line[:15], STAMP_FORMAT))
+            except ValueError:
+               continue
+            last_stamp = line[:15]
+         event = text_event(line[17:].rstrip("\n"))
+         if (event is not None):
+            yield (t,) + event
+
+# Events from a json log, one multi line object at a time, "ERROR" lines between them are skipped
+def json_events(path, to_event):
+   lines = None
+   with open(path, "r", errors="replace") as file:
+      for line in file:
+         if (line.startswith("{")):
+            lines = [line]
+         elif (lines is not None):
+            lines.append(line)
+            if (line.startswith("}")):
+               try:
+                  data = json.loads("".join(lines))
+                  t = datetime.strptime(data["accessed"], JSON_STAMP_FORMAT).timestamp()
+               except Exception:
+                  data = None
+               lines = None
+               if (data is not None):
+                  yield (t,) + to_event(data)
+
+def sensor_json_event(data):
+   soil = {}
+   for i in range(MAX_SOIL_SENSORS):
+      value = data.get("soil_" + str(i + 1) + "_wet", "")
+      if (value != ""):
+         soil[i] = value
+   return ("sensors", {"soil_percent": soil, "tds": data.get("tds", -1), "pH": data.get("ph", -1)})
+
+def pump_json_event(data):
+   return ("pump", data.get("pump_status", 0) != 0)
+
+# Every event in a log directory in time order, merged lazily from the per log streams
+def events(directory):
+   def path(name):
+      return os.path.join(directory, name)
+   streams = [text_events(path(name)) for name in (SYS, ERROR, PUMP) if os.path.exists(path(name))]
+   if (os.path.exists(path(SENSORS))): # USB resets are in the error log too, count them once
+      streams.append(e for e in text_events(path(SENSORS)) if e[1] != "usb_reset")
+   if (not os.path.exists(path(SENSORS)) and os.path.exists(path(SENSOR_JSON_LOG))):
+      streams.append(json_events(path(SENSOR_JSON_LOG), sensor_json_event))
+   if (not os.path.exists(path(PUMP)) and os.path.exists(path(PUMP_JSON_LOG))):
+      streams.append(json_events(path(PUMP_JSON_LOG), pump_json_event))
+   return heapq.merge(*streams, key=lambda event: event[0])
+
+# TDS probe voltage that tds_block turns into ppm at room_temperature, 0 volts is a fault
+def tds_voltage(ppm, room_temperature):
+   if (ppm < 0):
+      return 0.0
+   low, high = 0.0, 3.3 # The cubic rises over the whole A to D range
+   for i in range(40):
+      v = (low + high) / 2
+      if (v * (857.39 + v * (-255.86 + v * 133.42)) * .5 < ppm):
+         low = v
+      else:
+         high = v
+   return (low + high) / 2 * (1.0 + .02 * (room_temperature - 25))
+
+# Sim plant whose sensors return what the logs recorded, as of the sim clock
+class ReplayPlant(AGhal.SimPlant):
+   def __init__(self, events, valves):
+      self.events = events
+      self.next = next(events, None)
+      if (self.next is None):
+         raise ValueError("No replayable events in the logs")
+      self.start = self.next[0]   # Recorded time of the first event, sim monotonic 0
+      self.soil = {}              # Channel -> recorded raw value, 0 is disconnected
+      self.tds = None             # Recorded TDS in ppm, None until the logs give one
+      self.recorded_pH = None     # None while the logs show no probe readings
+      self.last_pH = 6.5          # Probe keeps sending this if a reading races a dropout
+      self.parms = {}             # Recorded parms not yet taken by the controller
+      self.recorded_pump = False
+      self.counts = collections.Counter()
+      AGhal.SimPlant.__init__(self, valves, seed=0)
+      self.counts.clear() # Init set the probe connected, that was no reset
+
+   @property
+   def ph_probe_connected(self):
+      with self.lock:
+         self.update(AGhal.clock.monotonic())
+         return self.recorded_pH is not None
+
+   @ph_probe_connected.setter
+   def ph_probe_connected(self, value): # Sim USB reset sets this, in a replay the logs decide
+      self.counts["replayed_usb_resets"] = self.counts["replayed_usb_resets"] + 1
+
+   def apply(self, t, kind, data):
+      self.counts[kind] = self.counts[kind] + 1
+      if (kind == "sensors"):
+         if ("soil" in data):
+            self.soil.update(data["soil"])
+         else:
+            for ch, percent in data["soil_percent"].items(): # Json logs only have percent wet
+               self.soil[ch] = 0 if percent == -1 else \
+                  int(run_parms["soil_dry"] - percent * (run_parms["soil_dry"] - run_parms["soil_wet"]) / 100)
+         self.tds = data["tds"]
+         self.recorded_pH = None if data["pH"] == -1 else data["pH"]
+         if (self.recorded_pH is None):
+            self.counts["pH_missing"] = self.counts["pH_missing"] + 1
+      elif (kind == "soil"):
+         self.soil.update(data)
+      elif (kind == "tds"):
+         self.tds = data
+      elif (kind == "ph_lost"):
+         self.recorded_pH = None
+      elif (kind == "pump"):
+         if (data and not self.recorded_pump):
+            self.counts["recorded_pump_starts"] = self.counts["recorded_pump_starts"] + 1
+         self.recorded_pump = data
+      elif (kind == "parm"):
+         self.parms.update(data)
+      if (self.recorded_pH is not None):
+         self.last_pH = self.recorded_pH
+
+   def update(self, now): # Model first, then every recorded event up to now, lock held
+      AGhal.SimPlant.update(self, now)
+      while (self.next is not None and self.next[0] - self.start <= now):
+         self.apply(*self.next)
+         self.next = next(self.events, None)
+
+   def set_relays(self, now, pump, valves, ph_up, ph_down):
+      if (pump and not self.pump):
+         self.counts["replayed_pump_starts"] = self.counts["replayed_pump_starts"] + 1
+      AGhal.SimPlant.set_relays(self, now, pump, valves, ph_up, ph_down)
+
+   def soil_raw(self, now, channel):
+      with self.lock:
+         self.update(now)
+         if (channel in self.soil):
+            return self.soil[channel]
+      return AGhal.SimPlant.soil_raw(self, now, channel) # Nothing recorded yet, use the model
+
+   def tds_voltage(self, now):
+      with self.lock:
+         self.update(now)
+         ppm = self.tds
+      if (ppm is None):
+         return AGhal.SimPlant.tds_voltage(self, now)
+      return tds_voltage(ppm, run_parms["room_temperature"])
+
+   def pH_reading(self, now):
+      with self.lock:
+         self.update(now)
+         return self.last_pH
+
+   # Recorded parms since the last call, less the ones the local parm file keeps
+   def take_parms(self, now):
+      with self.lock:
+         self.update(now)
+         parms = self.parms
+         self.parms = {}
+      return {key: value for key, value in parms.items() if key not in REPLAY_LOCAL_PARMS}
+
+   def finished(self):
+      return self.next is None
+
+   def summary(self):
+      c = self.counts
+      return "Replay events: " + str(sum(c[k] for k in ("sensors", "soil", "tds", "ph_lost", "pump", "parm", "start", "usb_reset"))) + \
+         " sensor readings: " + str(c["sensors"]) + " without pH: " + str(c["pH_missing"]) + \
+         " pump starts recorded: " + str(c["recorded_pump_starts"]) + " replayed: " + str(c["replayed_pump_starts"]) + \
+         " USB resets recorded: " + str(c["usb_reset"]) + " replayed: " + str(c["replayed_usb_resets"]) + " node restarts: " + str(max(0, c["start"] - 1))
+
+# Put the sim backend on a ReplayPlant for the logs in directory, returns the plant
+def init(directory, relay_pins, flow_pin, ph_up_relay, ph_down_relay, speed):
+   plant = ReplayPlant(events(directory), len(relay_pins) - 3)
+   AGhal.init("sim", relay_pins, flow_pin, ph_up_relay, ph_down_relay, speed, plant, plant.start)
+   return plant
+
+# List the events in a log directory and the pH dropouts in them
+def main():
+   directory = sys.argv[1] if len(sys.argv) > 1 else REPLAY_DIR
+   counts = collections.Counter()
+   first = last = None
+   dropout = None
+   for t, kind, data in events(directory):
+      if (first is None):
+         first = t
+      last = t
+      counts[kind] = counts[kind] + 1
+      if (kind == "sensors" or kind == "ph_lost"):
+         lost = kind == "ph_lost" or data["pH"] == -1
+         if (lost and dropout is None):
+            dropout = t
+         elif (not lost and dropout is not None):
+            print("pH dropout " + datetime.fromtimestamp(dropout).strftime(STAMP_FORMAT) + " for " + str(round(t - dropout)) + " seconds")
+            dropout = None
+   if (first is None):
+      print("No replayable events in " + directory)
+      return
+   if (dropout is not None):
+      print("pH dropout " + datetime.fromtimestamp(dropout).strftime(STAMP_FORMAT) + " to the end of the logs, " + str(round(last - dropout)) + " seconds")
+   print("Logs run " + datetime.fromtimestamp(first).strftime(STAMP_FORMAT) + " to " + \
+      datetime.fromtimestamp(last).strftime(STAMP_FORMAT) + ", " + str(round(last - first)) + " seconds")
+   for kind, count in sorted(counts.items()):
+      print("%-10s %d" % (kind, count))
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,179 @@
+# Event driven scheduler for AutoGro
+# V23
+#
+# Jobs sit on a heap keyed by their deadline on the monotonic clock and the run
+# loop sleeps until the earliest one is due, so there is no polling tick and no
+# start jitter.  Monotonic time means NTP stepping the wall clock after boot
+# (Pi has no RTC) can not fire or stall timers.
+#
+# A job callback returns the number of seconds until it should run again, or
+# None when it is finished.  A callback that raises is logged and dropped.
+# Job names are unique, scheduling a name that is already queued replaces
+# the old job.
+
+import heapq
+import itertools
+import threading
+import traceback
+import AGhal
+import AGconfig
+import AGmetrics
+
+job_lateness = AGmetrics.histogram("ag_job_lateness_seconds", "Time a scheduler job started after its deadline")
+job_seconds = AGmetrics.histogram("ag_job_seconds", "Time spent running a scheduler job callback")
+job_errors = AGmetrics.counter("ag_job_errors", "Scheduler job callbacks that raised")
+
+class Job:
+   def __init__(self, name, when, callback, seq):
+      self.name = name
+      self.when = when          # Monotonic deadline
+      self.callback = callback
+      self.seq = seq            # Tie breaker so equal deadlines run in order added
+      self.cancelled = False
+
+   def __lt__(self, other):
+      return (self.when, self.seq) < (other.when, other.seq)
+
+class Scheduler:
+   def __init__(self):
+      self.heap = []
+      self.jobs = {}                     # Live job for each name
+      self.cond = threading.Condition()  # Guards heap, notified when work is added
+      self.seq = itertools.count()
+      self.running = False
+
+   # Schedule callback to run at monotonic time when
+   def at(self, when, name, callback):
+      with self.cond:
+         old = self.jobs.get(name)
+         if (old is not None):
+            old.cancelled = True # Lazy delete, dropped when it reaches top of heap
+         job = Job(name, when, callback, next(self.seq))
+         heapq.heappush(self.heap, job)
+         self.jobs[name] = job
+         self.cond.notify()
+      return job
+
+   # Schedule callback to run delay seconds from now
+   def after(self, delay, name, callback):
+      return self.at(AGhal.clock.monotonic() + delay, name, callback)
+
+   def cancel(self, name):
+      with self.cond:
+         job = self.jobs.pop(name, None)
+         if (job is not None):
+            job.cancelled = True
+
+   # Monotonic deadline of named job, None if not scheduled
+   def deadline(self, name):
+      job = self.jobs.get(name)
+      if (job is None):
+         return None
+      return job.when
+
+   # Seconds until named job runs, None if not scheduled
+   def time_left(self, name):
+      when = self.deadline(name)
+      if (when is None):
+         return None
+      return when - AGhal.clock.monotonic()
+
+   # Earliest job whose name starts with prefix, returns (name, deadline) or (None, None)
+   def next_job(self, prefix):
+      best = (None, None)
+      for job in list(self.jobs.values()):
+         if (job.name.startswith(prefix) and (best[1] is None or job.when < best[1])):
+            best = (job.name, job.when)
+      return best
+
+   # Seconds left on every live job, name -> seconds, for checkpoints
+   def remaining(self):
+      now = AGhal.clock.monotonic()
+      return {job.name: job.when - now for job in list(self.jobs.values())}
+
+   # Wake the run loop, used by other threads after changing shared state
+   def wake(self):
+      with self.cond:
+         self.cond.notify()
+
+   def stop(self):
+      with self.cond:
+         self.running = False
+         self.cond.notify()
+
+   # Pop the next due job, or None if nothing is due yet.  Called with cond held
+   def _pop_due(self, now):
+      while (self.heap and self.heap[0].cancelled):
+         heapq.heappop(self.heap)
+      if (self.heap and self.heap[0].when <= now):
+         job = heapq.heappop(self.heap)
+         del self.jobs[job.name]
+         return job
+      return None
+
+   def _run_job(self, job):
+      job_lateness.observe(AGhal.clock.monotonic() - job.when)
+      try:
+         with job_seconds.time():
+            delay = job.callback()
+      except Exception as e: # Logged and dropped, the run loop and every other job carry on
+         job_errors.inc()
+         AGconfig.AGlog("ERROR - Scheduler job " + job.name + " failed: " + str(e) + " " + \
+            traceback.format_exc().replace("\n", " | "),AGconfig.ERROR)
+         return
+      if (delay is not None and job.name not in self.jobs): # Callback may have rescheduled itself
+         self.after(delay, job.name, job.callback)
+
+   # Run every job that is due now, returns number of jobs run
+   def run_pending(self):
+      count = 0
+      while (True):
+         with self.cond:
+            job = self._pop_due(AGhal.clock.monotonic())
+         if (job is None):
+            return count
+         self._run_job(job)
+         count = count + 1
+
+   # Main loop, sleeps until the next deadline or until woken
+   def run(self):
+      self.running = True
+      while (self.running):
+         with self.cond:
+            job = self._pop_due(AGhal.clock.monotonic())
+            if (job is None):
+               timeout = None
+               if (self.heap):
+                  timeout = self.heap[0].when - AGhal.clock.monotonic()
+               AGhal.clock.wait(self.cond, timeout)
+               continue
+         self._run_job(job)
+
+# Latest value hand off from another thread to the scheduler thread.  publish()
+# stores the value and queues a job due at once, which wakes the run loop, so
+# the callback runs as soon as the scheduler is free instead of on a poll.
+# Values published before that job runs replace each other, the callback gets
+# the newest one.
+class Channel:
+   def __init__(self, scheduler, name, callback):
+      self.scheduler = scheduler
+      self.name = name          # Job name the callback runs under
+      self.callback = callback
+      self.lock = threading.Lock()
+      self.value = None
+      self.pending = False      # Job queued and not yet run
+
+   def publish(self, value): # Any thread, never waits on the scheduler thread
+      with self.lock:
+         self.value = value
+         if (self.pending):
+            return
+         self.pending = True
+      self.scheduler.at(AGhal.clock.monotonic(), self.name, self._deliver)
+
+   def _deliver(self):
+      with self.lock:
+         value = self.value
+         self.pending = False
+      self.callback(value)
+      return None
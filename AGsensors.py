@@ -9,15 +9,14 @@
 # This site indicates what python libs to install etc
 
 import sys
-import os
-import time
+import array
 from AGconfig import *
-import AGconfig # Used to gain access to global_pH
-import busio
-import board
-import digitalio
-import adafruit_mcp3xxx.mcp3008 as MCP
-from adafruit_mcp3xxx.analog_in import AnalogIn
+import AGhal # Hardware access and clock
+import AGph
+import AGmetrics
+import AGworkers
+import AGusb
+from AGsnapshot import GOOD, CACHED, BAD
 
 # Map function from:
 # https://www.theamplituhedron.com/articles/How-to-replicate-the-Arduino-map-function-in-Python-for-Raspberry-Pi/
@@ -25,210 +24,202 @@ from adafruit_mcp3xxx.analog_in import AnalogIn
 def _map(x, in_min, in_max, out_min, out_max):
     return int((x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min)
 
+# Burst scan of the MCP3008, every channel is read oversample times in one
+# pass into a preallocated buffer, sample s of channel ch is at
+# buf[s * channel count + ch], so one channel's samples are a stride slice
+class ADCScan:
+   def __init__(self, channels, max_oversample):
+      self.channels = list(channels)
+      self.width = len(self.channels)
+      self.buf = array.array("H", bytes(2 * self.width * max_oversample))
+      self.max_oversample = max_oversample
+      self.count = 0 # Samples per channel in the last scan
+
+   def scan(self, oversample):
+      self.count = min(oversample, self.max_oversample)
+      AGhal.adc_scan(self.channels, self.count, self.buf)
+
+   def samples(self, ch): # Raw samples of a channel from the last scan
+      return self.buf[ch:self.count * self.width:self.width]
+
+   def mean(self, ch): # Decimate a channel to one value
+      return sum(self.samples(ch)) / self.count
+
+# Soil raw values to percent wet for a block of sensors, 0 raw is a disconnected sensor (-1)
+def soil_percent(raw_values, wet, dry):
+   return [-1 if r == 0 else min(100, max(0, _map(r, wet, dry, 100, 0))) for r in raw_values]
+
+# TDS for a block of raw samples from the TDS channel, -1 if any sample is 0
+# Temperature compensation is worked out once for the block and folded into
+# the raw to voltage scale, the cubic is in Horner form
+def tds_block(raw_values, room_temperature):
+   if (0 in raw_values): # Zero from the TDS sensor is considered an error condition
+      return -1
+   scale = 3.3 / 65535 / (1.0 + .02 * (room_temperature - 25)) # Raw to temperature compensated voltage
+   total = 0.0
+   for v in [r * scale for r in raw_values]:
+      total = total + v * (857.39 + v * (-255.86 + v * 133.42))
+   return round(total * .5 / len(raw_values),1) # Ending TDS value is an average of readings
+
+get_pH_seconds = AGmetrics.histogram("ag_get_ph_seconds", "Time get_pH() blocks, including the USB reset path")
+tds_faults = AGmetrics.counter("ag_tds_faults", "TDS readings dropped as faults")
+
+soil_channel = None # AGsched.Channel the main program sets, gets the snapshot of every ADC read
+
+# USB reset for the pH probe when it stops reading, see AGusb.py
+usb_recovery = AGusb.Recovery(AGusb.Device(USB_RESET_DEVICE,USB_SYSFS_ROOT,USB_DEV_ROOT,USB_DETACH_TIME,USB_SETTLE_TIMEOUT,USB_POLL_INTERVAL),\
+   USB_RESET_MIN_INTERVAL,USB_RESET_MAX_INTERVAL,AGhal.usb_reset)
+
+# pH probe reader thread, keeps the USB port open and a window of recent readings
+pH_reader = AGph.PHReader(run_parms["ph_sensor_port"],PH_WINDOW,PH_REOPEN_DELAY,PH_WARN_INTERVAL,\
+   AGph.PHEstimator(PH_EMA_ALPHA,PH_OUTLIER_SIGMA,PH_OUTLIER_FLOOR,PH_OUTLIER_RESET))
+
 # get pH and return to main program, inserted for error recovery, USB reset
 # This calls get_pH_driver where the work is done, this is only error recovery
 def get_pH():
+   if (get_pH.start_time is None):
+      get_pH.start_time = AGhal.clock.monotonic()
+   pH_reader.start()
    driver_pH = get_pH_driver()
    if (driver_pH != -1):
-      return driver_pH
-   driver_pH = get_pH_driver() # Trying get pH twice due to boot time problem
-   if (driver_pH != -1):
+      usb_recovery.healthy()
       return driver_pH
 
-   if (get_pH.usb_reset_time == 0 or (get_pH.usb_reset_time + 1200) < time.time()): # Just allow usb reset once in 20 minutes (1200 is seconds in 20 minutes)
-      AGlog("Resetting USB bus!!!!!",ERROR)
-      AGlog("Resetting USB bus!!!!!",SENSORS)
-      get_pH.usb_reset_time = time.time()
-      os.system(USB_RESET) # Rest USB bus and try pH again
-      time.sleep(3)
-      return get_pH_driver()
-   else:
+   # No readings for a while, port will not open or probe has gone quiet
+   last = pH_reader.last_time()
+   if (last is None):
+      last = pH_reader.opened_time
+   if (last is None):
+      last = get_pH.start_time
+   if (last + PH_RESET_AFTER > AGhal.clock.monotonic()):
       return -1
-get_pH.usb_reset_time = 0 # This is used as a static variable substitute in above function
-
 
-# get_pH_driver() reads the USB serial port and gets pH from probe #######################
+   if (usb_recovery.due()): # Resets back off from USB_RESET_MIN_INTERVAL to USB_RESET_MAX_INTERVAL
+      AGlog("Resetting USB bus!!!!!",ERROR)
+      AGlog("Resetting USB bus!!!!!",SENSORS)
+      result = usb_recovery.recover(run_parms["ph_sensor_port"]) # Returns when the probe tty is back or gives up
+      last = usb_recovery.last
+      AGlog("USB reset " + result + " in %.1f seconds" % last["seconds"] + \
+         "".join(" " + name + ": %.2f" % secs for name, secs in last["timings"].items()),SENSORS)
+      if (result != AGusb.OK):
+         AGlog("ERROR - USB reset " + result + ": " + str(last["error"]),ERROR)
+      pH_reader.set_port(run_parms["ph_sensor_port"]) # Reader thread reopens the port
+   return -1
+get_pH.start_time = None # First call, reset waits PH_RESET_AFTER from then if probe never opens (set late, clock may be a sim one)
+
+# get_pH_driver() returns the filtered pH from the reader thread, -1 if not fresh and stable #######################
 def get_pH_driver():
-   try:
-      ser = serial.Serial(run_parms["ph_sensor_port"],9600,timeout = 4)
-   except Exception as e:
-      AGlog("ERROR - Could not open USB port with pH probe: " + str(e),ERROR)
-      return -1
-
-   time_out = False
-   parse_error = False
-   pH_mismatch = False
-   parse_error_string = ""
-   previous_pH = 0
-   stored_previous_pH = False
-   end_time = time.time() + 20
-
-   while (end_time > time.time()):
-      line = ""
-      s = ""
-      while(line != b"\r" and end_time > time.time()):
-         line = ser.readline(1)
-         if (line == b""):
-            time_out = True
-            continue
-         s = s + line.decode()
-
-      try:
-         pH_value = float(s) # Attempt to convert pH string to float, if error read USB again
-         float_convert_success = True
-      except Exception:
-         parse_error = True
-         parse_error_string = s
-         continue
-
-      if (stored_previous_pH == False):
-         previous_pH = pH_value
-         stored_previous_pH = True
-      else:
-         if ( abs(previous_pH - pH_value) < .1): # Previous two pH values are close, good to return
-            break
-         else:
-            previous_pH = pH_value
-            pH_mismatch = True
-
-   # Close USB serial port
-   try:
-      ser.close()
-   except Exception:
-      AGlog("ERROR - Could not close USB serial port",ERROR)
-
-   if (time_out == True):
-      AGlog("WARNING - pH routine received a time out",ERROR)
-
-   if (parse_error == True):
-      AGlog("WARNING - pH routine got a parse error: " + parse_error_string,ERROR)
-
-   if (pH_mismatch == True):
-      AGlog("WARNING - pH routine received a pH mismatch",ERROR)
-
-   if (end_time > time.time()):
-      return pH_value
+   return pH_reader.quality_pH(PH_MAX_AGE,PH_MAX_STD,3)
+
+# Sensor workers, each device class is read by its own supervised thread, see AGworkers.py ##############
+
+# pH worker, probe reader thread plus the USB reset path
+def read_pH():
+   last_pH = shared_state.current.pH
+   if (run_parms["ph_sensor_enabled"]):
+      with get_pH_seconds.time():
+         pH = get_pH() # Look at error log for trouble, can block in a USB reset
+      if (pH != -1):
+         return {"pH": (pH, GOOD)} # System wide pH for possible auto adjustment, time kept for caching and checkpoints
+      if (last_pH.quality != BAD and last_pH.age() < 1500): # Use old pH value for 25 minutes if pH system is offline (1500 seconds is 25 minutes)
+         AGlog("Using cached pH reading",SENSORS)
+         return {"pH": (last_pH.value, CACHED, last_pH.time)} # Keeps its time so it still runs out
+   return {"pH": (-1, BAD)} # pH error or meter not enabled
+
+# ADC worker, soil and TDS from one burst scan of every MCP3008 channel, soil sensors are inputs 0 up
+def adc_reader(): # Each worker thread gets its own scan buffer
+   adc = ADCScan(range(ADC_CHANNELS), ADC_MAX_OVERSAMPLE)
+   return lambda: read_adc(adc)
+
+def read_adc(adc):
+   oversample = ADC_OVERSAMPLE
+   if (run_parms["enable_tds_meter"]):
+      oversample = max(oversample, run_parms["tds_samples"])
+   adc.scan(oversample) # One pass over every channel, no sleeps between samples
+
+   # TDS routine ###############################################
+   if (run_parms["enable_tds_meter"]):
+      # TDS water quality calc from Arduino example
+      # Note: cannot determine if TDS is not plugged in based on zero since this is a valid value
+      tdsValue = tds_block(adc.samples(ADC_TDS_CHANNEL)[:run_parms["tds_samples"]], run_parms["room_temperature"]) # Exactly tds_samples, the scan can take more for soil
+      if (tdsValue == -1):
+         tds_faults.inc()
+         AGlog("ERROR - TDS fault",ERROR)
    else:
-      AGlog("ERROR - pH routine received a global time out, no pH reading",ERROR)
-      return -1
+      tdsValue = -1 # if TDS is not enabled, same as error but no error logging
+   # End TDS routine #############################################
 
-# Begin main sensor thread ##############################################
-
-def sensors():
-   # Store last good ph reading time - used for caching incase of pH error
-   last_good_pH_time = 0
-   # create the spi bus
-   spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI)
-   # create the cs (chip select)
-   cs = digitalio.DigitalInOut(board.D17)
-   # create the mcp object
-   mcp = MCP.MCP3008(spi,cs)
-   # Setup array to hold MCP objects
-   SoilArray = []
-   # create analog input channels
+   SoilRaw = [int(adc.mean(i)) for i in range(0,run_parms["number_of_soil_sensors"])]
+   SoilPercent = soil_percent(SoilRaw,run_parms["soil_wet"],run_parms["soil_dry"])
    for i in range(0,run_parms["number_of_soil_sensors"]):
-      SoilArray.append(AnalogIn(mcp,i)) # i is the input pin on the mux
-
-   wq = AnalogIn(mcp,7) # Water qaulity sensor is connected to last mux input - #7
-   # wq.voltage is actual voltage measurement, same as volt meter
-
-   # Setup array to hole raw soil sensor values
-   SoilRaw = [None] * run_parms["number_of_soil_sensors"]
-   # Setup array to hold soil percent wet values
-   SoilPercent = [None] * run_parms["number_of_soil_sensors"]
-
-   sensor_time_api_clock = 0  # Stores clock to trigger API web call
-   sensor_time_diag_clock = 0 # Stores clock to trigger DIAG log call
-
-   while(True):
-
-      if (run_parms["ph_sensor_enabled"]):
-         pH = get_pH() # Call time for this function can be lengthy if pH probe is having trouble, look at error log
-         if (pH != -1):
-            AGconfig.global_pH = pH # Set system wide pH value for possible auto adjustment
-            last_good_pH_time = time.time()
-         else:
-            # Thinking through initial run with last_good_ph_time = 0, the logic still works
-            if ((last_good_pH_time + 1500) > time.time()): # Use old pH value for 25 minutes if pH system is offline (1500 seconds is 25 minutes)
-               AGlog("Using cached pH reading",SENSORS)
-               # Don't update pH value just use old one unless too old
-            else:
-               AGconfig.global_pH = -1
-      else:
-         pH = -1 # Since pH meter is not enabled just set to -1, same as an error
-
-
-      # TDS routine ###############################################
-      if (run_parms["enable_tds_meter"]):
-         # TDS water quality calc from Arduino example
-         # Note: cannot determine if TDS is not plugged in based on zero since this is a valid value
-         tds_average = 0
-         TDS_FAULT = False # Set if TDS fault detected
-         for i in range (0,run_parms["tds_samples"]):
-            time.sleep(.1) # Time between TDS samples
-            wq_voltage =  wq.voltage # Real voltage from TDS
-            temperatureCompensation = 1.0 + .02 * (run_parms["room_temperature"] - 25)
-            voltageCompensation = wq_voltage / temperatureCompensation
-            tdsValue = ((133.42 * voltageCompensation * voltageCompensation * voltageCompensation) - 255.86 * voltageCompensation * voltageCompensation + 857.39 * voltageCompensation) * .5
-            if (tdsValue == 0): # Zero from the TDS sensor is considered an error condition
-               TDS_FAULT = True
-            tds_average = tds_average + tdsValue
-
-         if (TDS_FAULT == True):
-            AGlog("ERROR - TDS fault",ERROR)
-            tdsValue = -1
-         else:
-            tdsValue = round(tds_average / TDS_SAMPLES,1) # Ending TDS value is an average of readings
-
-      else:
-         tdsValue = -1 # if TDS is not enabled, same as error but no error logging
-      # End TDS routine #############################################
-
-      for i in range(0,run_parms["number_of_soil_sensors"]):
-         SoilRaw[i] = SoilArray[i].value
-         SoilPercent[i] = _map(SoilRaw[i],run_parms["soil_wet"],run_parms["soil_dry"],100,0)
-         if (SoilPercent[i] < 0): # Force Soil Percent to 0 or 100 if above or below
-            SoilPercent[i] = 0
-         if (SoilPercent[i] > 100):
-            SoilPercent[i] = 100
-
-         if (SoilRaw[i] == 0): # If the soil sensor is unplugged, the AtoD returns 0, so flagging this as -1
-            SoilPercent[i] = -1
-            SoilRaw[i] = -1
-            AGlog("Possible disconnected soil sensor: " + str(i),ERROR)
-
-      # Prepping buf string for regular diag log, just soil sensors that are active
-      # Yes, prepping these on every loop even though they are just used once in a while
+      if (SoilPercent[i] == -1): # If the soil sensor is unplugged, the AtoD returns 0, so flagging this as -1
+         SoilRaw[i] = -1
+         AGlog("Possible disconnected soil sensor: " + str(i),ERROR)
+
+   return {"tds": (tdsValue, BAD if tdsValue == -1 else GOOD), "soil_raw": (tuple(SoilRaw), GOOD), \
+      "soil": (tuple(SoilPercent), BAD if -1 in SoilPercent else GOOD)}
+
+def publish_soil(snapshot): # Soil triggered valves see each ADC reading right away
+   if (soil_channel is not None):
+      soil_channel.publish(snapshot)
+
+# Report worker, sensor log and web API from the latest values.  Each call
+# sleeps until a report is due, then waits for readings newer than the last
+# report, for at most wait seconds, the worker calls again straight away.
+def reporter(wait=REPORT_WORKER_WAIT):
+   clocks = {"api": 0,  # Stores clock to trigger API web call
+             "diag": 0, # Stores clock to trigger DIAG log call
+             "seq": 0}  # Snapshot seq of the last report
+   return lambda: report(clocks, wait)
+
+def report(clocks, wait):
+   end = AGhal.clock.monotonic() + wait
+   due = min(clocks["diag"], clocks["api"])
+   if (due > AGhal.clock.monotonic()):
+      AGhal.clock.sleep(min(due, end) - AGhal.clock.monotonic())
+      if (due > AGhal.clock.monotonic()):
+         return None
+   snapshot = shared_state.current # One consistent set of readings for both
+   while (snapshot.seq <= clocks["seq"] or snapshot.soil.time is None): # Nothing new, or no ADC read yet
+      left = end - AGhal.clock.monotonic()
+      if (left <= 0):
+         return None
+      snapshot = shared_state.wait_newer(snapshot.seq, left)
+   clocks["seq"] = snapshot.seq
+   current_clock = AGhal.clock.monotonic()
+   SoilRaw = snapshot.soil_raw.value
+   SoilPercent = snapshot.soil.value
+   sensors = min(run_parms["number_of_soil_sensors"], len(SoilPercent))
+
+   if (clocks["diag"] < current_clock): # DIAG log block, just soil sensors that are active
       buf = ""
-      for i in range(0,run_parms["number_of_soil_sensors"]):
+      for i in range(0,sensors):
          buf = buf + "S" + str(i) + ": " + str(SoilRaw[i]) + " (" + str(SoilPercent[i]) + ") "
+      buf = buf + "WC: " + str(snapshot.tds.value) # WC is water quality sensor
+      buf = buf + " pH: " + str(snapshot.pH.value) # pH from USB probe
+      AGlog(str(buf),SENSORS)
+      clocks["diag"] = current_clock + SENSOR_TIME_DIAG
 
-      buf = buf + "WC: " + str(tdsValue) # WC is water quality sensor
-      buf = buf + " pH: " + str(AGconfig.global_pH) # pH from USB probe
-
-
-      # Prepping SensorAPI list for web API call
+   if (clocks["api"] < current_clock): # API web call block
       # The list will contain all possible max soil sensors with ones not in use ""
       # This is being done for the web API so DBs can populate all their columns
       SensorAPI = []
       for i in range (0,MAX_SOIL_SENSORS):
-         if (i < run_parms["number_of_soil_sensors"]):
+         if (i < sensors):
             SensorAPI.append(SoilPercent[i])
          else:
             SensorAPI.append("")  # Forcing full Soil Sensor List for DB purposes, ones not in use get ""
-
-      SensorAPI.append(tdsValue)
-      SensorAPI.append(AGconfig.global_pH)
-
-      ###### Decide here what to log based on time delay counts - all logging funcs can have different log times
-      current_clock = time.time()
-
-      if (sensor_time_diag_clock < current_clock): # DIAG log block
-         AGlog(str(buf),SENSORS)
-         sensor_time_diag_clock = current_clock + SENSOR_TIME_DIAG
-
-      if (sensor_time_api_clock < current_clock): # API web call block, note SensorCSV is used same as CSVlog
-         APIsensor(SensorAPI)
-         sensor_time_api_clock = current_clock + run_parms["sensor_time_api"]
-
-      time.sleep(3) # Time delay on master sensor loop, must be smaller than smallest logging delay
+      SensorAPI.append(snapshot.tds.value)
+      SensorAPI.append(snapshot.pH.value)
+      APIsensor(SensorAPI)
+      clocks["api"] = current_clock + run_parms["sensor_time_api"]
+   return None
+
+STUCK_SOIL = (-1,) * MAX_SOIL_SENSORS # Soil published while the ADC worker is stuck
+
+def sensor_workers(): # Worker pool for all sensors, the main program starts it
+   pool = AGworkers.Pool(shared_state,WORKER_CHECK_INTERVAL,WORKER_RESTART_DELAY,WORKER_MAX_RESTART_DELAY)
+   pool.add("pH", lambda: read_pH, {"pH": -1}, PH_WORKER_INTERVAL, PH_WORKER_DEADLINE)
+   pool.add("adc", adc_reader, {"tds": -1, "soil_raw": STUCK_SOIL, "soil": STUCK_SOIL}, ADC_WORKER_INTERVAL, ADC_WORKER_DEADLINE, publish_soil)
+   pool.add("report", reporter, {}, REPORT_WORKER_INTERVAL, REPORT_WORKER_DEADLINE)
+   return pool
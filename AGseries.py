@@ -0,0 +1,243 @@
+# Binary time series store for AutoGro sensor and pump history
+# V23
+#
+# Each sample is a fixed width record, a float64 time stamp followed by one
+# float32 per field (36 bytes for the sensor or pump payload, the json logs
+# took about 200).  Records are appended to one segment file per day,
+# <root>/<series>/YYYYMMDD.dat.  Records are in time order and fixed width, so
+# a time range lookup is a binary search on the mmapped segment.
+#
+# Rollup series hold hourly and daily count/min/max/mean per field.  Once raw
+# segments are rolled up they are deleted after SERIES_RAW_DAYS, hourly after
+# SERIES_HOURLY_DAYS, daily rollups are kept, which bounds SD card use.
+#
+# Missing readings (-1 error value or "" for unused soil sensors) are stored
+# as NaN and are skipped by the rollups.
+#
+# The wall clock can step back (NTP sync after boot on a Pi with no RTC), so
+# append clamps time stamps to never go below the last record written, which
+# keeps every segment sorted for the binary search.
+#
+# Rollup and pruning run on the Maintainer's low priority thread, never on the
+# scheduler or sensor threads that append.
+#
+# Dump a range as CSV:  python3 AGseries.py sensor 2024-05-06 [2024-05-07]
+
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+from datetime import date, datetime, timedelta
+import AGhal
+import AGconfig
+
+HOUR = 3600
+DAY = 86400
+
+class Series:
+   def __init__(self, root, name, fields):
+      self.name = name
+      self.dir = os.path.join(root, name)
+      self.fields = fields
+      self.record = struct.Struct("<d" + "f" * len(fields))
+      self.lock = threading.Lock()
+      self.file = None
+      self.day = None
+      self.last_ts = None # Time of the last record written, None until the first append
+      os.makedirs(self.dir, exist_ok=True)
+
+   def segment(self, day):
+      return os.path.join(self.dir, day.strftime("%Y%m%d") + ".dat")
+
+   # Append one sample, values in field order, None / "" / negative error values become NaN
+   def append(self, ts, values):
+      packed = [math.nan if (v is None or v == "" or v == -1) else float(v) for v in values]
+      with self.lock:
+         if (self.last_ts is None):
+            self.last_ts = self.last_time() or -math.inf
+         ts = max(ts, self.last_ts) # Clock stepped back, keep the segment in time order
+         self.last_ts = ts
+         data = self.record.pack(ts, *packed)
+         day = date.fromtimestamp(ts)
+         if (day != self.day):
+            if (self.file is not None):
+               self.file.close()
+            self.file = open(self.segment(day), "ab")
+            self.day = day
+         self.file.write(data)
+         self.file.flush()
+
+   def days(self): # Segment days on disk, oldest first
+      days = []
+      for file_name in os.listdir(self.dir):
+         if (file_name.endswith(".dat")):
+            days.append(datetime.strptime(file_name[:-4], "%Y%m%d").date())
+      return sorted(days)
+
+   # Records with start <= time < end, oldest first, each a (time, values...) tuple
+   def query(self, start, end):
+      first = date.fromtimestamp(start)
+      last = date.fromtimestamp(end)
+      for day in self.days():
+         if (first <= day <= last):
+            yield from self.read_segment(self.segment(day), start, end)
+
+   def read_segment(self, path, start, end):
+      size = self.record.size
+      with open(path, "rb") as file:
+         length = os.fstat(file.fileno()).st_size // size
+         if (length == 0):
+            return
+         with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lo = self.search(mm, length, start)
+            for i in range(lo, length):
+               record = self.record.unpack_from(mm, i * size)
+               if (record[0] >= end):
+                  break
+               yield record
+
+   def search(self, mm, length, ts): # Index of first record at or after ts
+      lo, hi = 0, length
+      while (lo < hi):
+         mid = (lo + hi) // 2
+         if (struct.unpack_from("<d", mm, mid * self.record.size)[0] < ts):
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+
+   def first_time(self):
+      for day in self.days():
+         for record in self.read_segment(self.segment(day), 0, math.inf):
+            return record[0]
+      return None
+
+   def last_time(self):
+      days = self.days()
+      if (not days):
+         return None
+      path = self.segment(days[-1])
+      length = os.path.getsize(path) // self.record.size
+      if (length == 0):
+         return None
+      with open(path, "rb") as file:
+         file.seek((length - 1) * self.record.size)
+         return self.record.unpack(file.read(self.record.size))[0]
+
+   def prune(self, keep_days, before=None): # Delete segments older than keep_days, never past before
+      cutoff = date.fromtimestamp(AGhal.clock.time()) - timedelta(days=keep_days)
+      if (before is not None):
+         cutoff = min(cutoff, date.fromtimestamp(before))
+      for day in self.days():
+         if (day < cutoff and day != self.day):
+            os.remove(self.segment(day))
+
+def rollup_fields(fields):
+   out = ["count"]
+   for field in fields:
+      out = out + [field + "_min", field + "_max", field + "_mean"]
+   return out
+
+def period_start(ts, period): # Local hour or local midnight at or before ts
+   start = datetime.fromtimestamp(ts).replace(minute=0, second=0, microsecond=0)
+   if (period == DAY):
+      start = start.replace(hour=0)
+   return start
+
+# Roll raw samples up into out for every whole period not yet rolled, up to now
+def rollup(raw, out, period, now):
+   step = timedelta(hours=1) if period == HOUR else timedelta(days=1)
+   last = out.last_time()
+   if (last is None):
+      first = raw.first_time()
+      if (first is None):
+         return
+      start = period_start(first, period)
+   else:
+      start = period_start(last, period) + step
+   while ((start + step).timestamp() <= now):
+      begin = start.timestamp()
+      finish = (start + step).timestamp()
+      count = 0
+      stats = [[math.inf, -math.inf, 0.0, 0] for f in raw.fields] # min, max, sum, n
+      for record in raw.query(begin, finish):
+         count = count + 1
+         for i, value in enumerate(record[1:]):
+            if (not math.isnan(value)):
+               s = stats[i]
+               s[0] = min(s[0], value)
+               s[1] = max(s[1], value)
+               s[2] = s[2] + value
+               s[3] = s[3] + 1
+      if (count):
+         values = [count]
+         for s in stats:
+            if (s[3]):
+               values = values + [s[0], s[1], s[2] / s[3]]
+            else:
+               values = values + [None, None, None]
+         out.append(begin, values)
+      start = start + step
+
+# A raw series with its hourly and daily rollups
+class History:
+   def __init__(self, root, name, fields):
+      self.raw = Series(root, name, fields)
+      self.hourly = Series(root, name + "_hourly", rollup_fields(fields))
+      self.daily = Series(root, name + "_daily", rollup_fields(fields))
+
+   def append(self, ts, values):
+      self.raw.append(ts, values)
+
+   # Bring rollups up to date and drop old raw and hourly segments that are rolled up
+   def maintain(self, raw_days, hourly_days):
+      now = AGhal.clock.time()
+      rollup(self.raw, self.hourly, HOUR, now)
+      rollup(self.raw, self.daily, DAY, now)
+      rolled = self.daily.last_time()
+      if (rolled is not None): # Raw data is only dropped once it is in the daily rollup
+         self.raw.prune(raw_days, rolled)
+      self.hourly.prune(hourly_days)
+
+# Background thread that keeps the rollups of some histories up to date
+class Maintainer:
+   def __init__(self, histories, interval, raw_days, hourly_days, nice=10):
+      self.histories = histories
+      self.interval = interval       # Seconds between passes, the first pass runs at start
+      self.raw_days = raw_days
+      self.hourly_days = hourly_days
+      self.nice = nice               # Added to the thread's nice value, rollups give way to control
+      self.thread = None
+
+   def start(self):
+      if (self.thread is None):
+         self.thread = threading.Thread(target=self.run, daemon=True)
+         self.thread.start()
+
+   def run(self):
+      try:
+         os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice) # Linux nice is per thread
+      except (AttributeError, OSError):
+         pass
+      while (True):
+         for history in self.histories:
+            try:
+               history.maintain(self.raw_days, self.hourly_days)
+            except Exception as e:
+               AGconfig.AGlog("ERROR - History rollup of " + history.raw.name + " failed: " + str(e),AGconfig.ERROR)
+         AGhal.clock.sleep(self.interval)
+
+if __name__ == "__main__": # Dump a series as CSV
+   import AGconfig
+   name = sys.argv[1]
+   start = datetime.strptime(sys.argv[2], "%Y-%m-%d")
+   end = datetime.strptime(sys.argv[3], "%Y-%m-%d") if len(sys.argv) > 3 else start + timedelta(days=1)
+   fields = AGconfig.SERIES_FIELDS[name.split("_")[0]]
+   if (name.endswith("_hourly") or name.endswith("_daily")):
+      fields = rollup_fields(fields)
+   series = Series(AGconfig.SERIES_DIR, name, fields)
+   print("time," + ",".join(fields))
+   for record in series.query(start.timestamp(), end.timestamp()):
+      print(datetime.fromtimestamp(record[0]).strftime("%Y-%m-%d %H:%M:%S") + "," + ",".join("%g" % v for v in record[1:]))
@@ -0,0 +1,97 @@
+# Shared plant state for AutoGro, published as versioned read only snapshots
+# V23
+#
+# The sensor workers, the scheduler thread and the web / metrics threads all
+# look at the same pH, TDS, soil and relay state.  Instead of globals and
+# lists changed in place, a writer publishes the fields it changed and gets a
+# new Snapshot with the next sequence number, the rest of the fields carried
+# over from the last one.  Readers take store.current, a single reference,
+# and everything in it stays as it was when published, so there is no lock
+# on the read side and no half updated state.
+#
+# Each field is a Field of value, the monotonic time it was measured and a
+# quality flag.  A value kept after its source failed keeps its old time, so
+# its age shows how stale it is.  Values must be immutable too (numbers,
+# tuples).
+#
+# store.wait_newer(seq, timeout) sleeps until something newer than seq is
+# published, on the AGhal clock so sim runs scale.
+
+import threading
+import AGhal
+
+GOOD = "good"       # Fresh reading
+CACHED = "cached"   # Last good reading kept while the source is failing
+BAD = "bad"         # No usable reading, value is -1 (or the default for the field)
+
+FIELDS = ("pH", "tds", "soil", "soil_raw", "relays")
+
+class Field:
+   __slots__ = ("value", "time", "quality")
+
+   def __init__(self, value, time, quality):
+      object.__setattr__(self, "value", value)
+      object.__setattr__(self, "time", time)       # Monotonic, None if never measured
+      object.__setattr__(self, "quality", quality)
+
+   def __setattr__(self, name, value):
+      raise AttributeError("snapshot fields are read only, publish a new value")
+
+   def age(self, now=None): # Seconds since measured, None if never measured
+      if (self.time is None):
+         return None
+      if (now is None):
+         now = AGhal.clock.monotonic()
+      return now - self.time
+
+   def __repr__(self):
+      return "Field(" + repr(self.value) + ", " + repr(self.time) + ", " + self.quality + ")"
+
+class Snapshot:
+   __slots__ = ("seq", "time") + FIELDS
+
+   def __init__(self, seq, time, fields):
+      object.__setattr__(self, "seq", seq)   # Goes up by one with every publish
+      object.__setattr__(self, "time", time) # Monotonic time published
+      for name in FIELDS:
+         object.__setattr__(self, name, fields[name])
+
+   def __setattr__(self, name, value):
+      raise AttributeError("snapshots are read only, publish a new one")
+
+class Store:
+   def __init__(self, defaults):
+      self.cond = threading.Condition() # Serialises writers, wakes wait_newer
+      self.current = Snapshot(0, None, {name: Field(defaults[name], None, BAD) for name in FIELDS})
+
+   # Publish changed fields, each as (value, quality) or (value, quality, time), returns the new snapshot
+   def publish(self, **changes):
+      now = AGhal.clock.monotonic()
+      fields = {}
+      for name, change in changes.items():
+         if (name not in FIELDS):
+            raise KeyError("unknown snapshot field: " + name)
+         fields[name] = Field(change[0], change[2] if len(change) > 2 else now, change[1])
+      with self.cond:
+         last = self.current
+         for name in FIELDS:
+            if (name not in fields):
+               fields[name] = getattr(last, name)
+         self.current = Snapshot(last.seq + 1, now, fields)
+         self.cond.notify_all()
+         return self.current
+
+   # Snapshot newer than seq, or the current one if timeout runs out first, None waits forever
+   def wait_newer(self, seq, timeout=None):
+      with self.cond:
+         if (timeout is not None):
+            end = AGhal.clock.monotonic() + timeout
+         while (self.current.seq <= seq):
+            if (timeout is None):
+               AGhal.clock.wait(self.cond, None)
+               continue
+            left = end - AGhal.clock.monotonic()
+            if (left <= 0):
+               break
+            AGhal.clock.wait(self.cond, left)
+         return self.current
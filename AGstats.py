@@ -0,0 +1,296 @@
+# Log analytics for AutoGro
+# V23
+#
+# Answers questions like how much water valve 3 got this week, how many pH
+# down doses there were yesterday or when USB resets bunched up, straight from
+# the text logs, every rotated generation (AGsys.log4 ... AGsys.log) included:
+#   python3 AGstats.py                          everything in the logs
+#   python3 AGstats.py --days 7                 the last 7 days
+#   python3 AGstats.py 2024-05-06 "2024-05-07 12:00" --bucket 600
+#   python3 AGstats.py --dir /path/to/logs      logs copied off a node
+#   python3 AGstats.py --sys AGsys.log --pump AGpump.log --error AGerror.log
+#                                               log names, if not AGconfig's
+#
+# Each log file is read once, as a stream, a line at a time, and only the
+# counters are kept, so memory does not grow with the logs.  To start a time
+# range without reading everything before it, each file gets a sparse index:
+# every INDEX_STEP bytes the offset of a line and the latest time stamp up to
+# there.  Indexes live in INDEX_FILE in the log directory, keyed by inode, so
+# a log keeps its index when rotation renames it, and grow as the log does.
+
+import argparse
+import bisect
+import collections
+import json
+import math
+import os
+import re
+import time
+from datetime import datetime
+
+STAMP_FORMAT = "%m%d%y %H:%M:%S"  # Time stamp at the start of every log line
+INDEX_FILE = ".AGstats.idx"       # Sparse offset indexes, in the log directory
+INDEX_STEP = 65536                # Bytes between index entries
+MAX_RUN = 3600                    # Longest believable gap in seconds between pump log lines with the pump on
+USB_CLUSTER_GAP = 3600            # USB resets closer together than this in seconds are one cluster
+BAR_WIDTH = 50                    # Widest histogram bar
+
+VALVE_STATE = re.compile(r"V(\d+): (On|Off)")
+VALVE_LITRES = re.compile(r"^Valve (.+) cycle used ([\d.]+) litres")
+CYCLE_START = re.compile(r"^Starting Water Cycle Valve: (.+?) Flow = ")
+FLOW = re.compile(r"Flow = (\d+)(?: \(([\d.]+) litres\))?")
+API_OK = re.compile(r"^(\w+) web API successful")
+API_FAIL = re.compile(r"(?:Exception on (\w+) web API call|API (\w+) web call failed)")
+
+# Files of one log, oldest generation first
+def generations(directory, name):
+   rotated = []
+   for entry in os.listdir(directory):
+      if (entry.startswith(name) and entry[len(name):].isdigit()):
+         rotated.append((int(entry[len(name):]), entry))
+   paths = [os.path.join(directory, entry) for n, entry in sorted(rotated, reverse=True)]
+   if (os.path.exists(os.path.join(directory, name))):
+      paths.append(os.path.join(directory, name))
+   return paths
+
+class Index:
+   def __init__(self, directory):
+      self.path = os.path.join(directory, INDEX_FILE)
+      self.files = {}  # "dev:inode" -> {"head": first line, "size": bytes indexed, "entries": [[offset, max time]]}
+      self.used = set()
+      try:
+         with open(self.path, "r") as file:
+            self.files = json.load(file)
+      except Exception:
+         pass
+
+   # Index for an open log file, a fresh one if the file is new or was rewritten
+   def get(self, file):
+      st = os.fstat(file.fileno())
+      key = str(st.st_dev) + ":" + str(st.st_ino)
+      head = file.readline(64).decode("utf-8", "replace")
+      file.seek(0)
+      entry = self.files.get(key)
+      if (entry is None or entry["head"] != head or entry["size"] > st.st_size):
+         entry = {"head": head, "size": 0, "entries": []}
+         self.files[key] = entry
+      self.used.add(key)
+      return entry
+
+   def save(self): # Best effort, the log directory may be read only
+      self.files = {key: entry for key, entry in self.files.items() if key in self.used}
+      try:
+         with open(self.path + ".tmp", "w") as file:
+            json.dump(self.files, file)
+         os.replace(self.path + ".tmp", self.path)
+      except OSError:
+         pass
+
+# (time, text) for each line of a log file in [start, end), seeking past the lines before start
+def read_log(path, index, start, end):
+   last_stamp = None
+   with open(path, "rb") as file:
+      entry = index.get(file)
+      entries = entry["entries"]
+      offset = 0
+      latest = 0
+      i = bisect.bisect_left([e[1] for e in entries], start) - 1 # Last entry with everything before it earlier than start
+      if (i >= 0):
+         offset, latest = entries[i]
+         file.seek(offset)
+      next_entry = entries[-1][0] + INDEX_STEP if entries else 0
+      for line in file:
+         line_offset = offset
+         offset = offset + len(line)
+         if (line[:15] != last_stamp): # Most lines share their second with the line before
+            try:
+               t = time.mktime(time.strptime(line[:15].decode("ascii"), STAMP_FORMAT))
+            except (ValueError, UnicodeDecodeError):
+               continue
+            last_stamp = line[:15]
+         if (line_offset >= next_entry and line_offset >= entry["size"]):
+            entries.append([line_offset, latest]) # Latest time before this line
+            next_entry = line_offset + INDEX_STEP
+         latest = max(latest, t)
+         if (t >= end):
+            break
+         entry["size"] = max(entry["size"], offset)
+         if (t >= start):
+            yield t, line[17:].decode("utf-8", "replace").rstrip("\n")
+
+# Pump log: watering time and flow per valve, refresh runs
+class PumpStats:
+   def __init__(self):
+      self.seconds = collections.Counter()  # Valve -> seconds open with the pump on
+      self.litres = collections.Counter()   # Valve -> litres, shared evenly by valves watered together
+      self.pulses = collections.Counter()   # Valve -> flow pulses, from logs older than the litres line
+      self.cycles = collections.Counter()   # Valve -> water cycles
+      self.refreshes = 0
+      self.refresh_seconds = 0
+      self.refresh_litres = 0.0
+      self.state = None                     # (time, pump on, valves open) from the last status line
+      self.cycle_valves = []
+      self.cycle_litres = False
+
+   def line(self, t, text):
+      if (text.startswith("Pump: ")):
+         pump = text.startswith("Pump: On")
+         valves = [v for v, state in VALVE_STATE.findall(text) if state == "On"]
+         if (self.state is not None and self.state[1] and t - self.state[0] <= MAX_RUN):
+            if (self.state[2]):
+               for v in self.state[2]:
+                  self.seconds[v] = self.seconds[v] + t - self.state[0]
+            else:
+               self.refresh_seconds = self.refresh_seconds + t - self.state[0]
+         self.state = (t, pump, valves)
+         return
+      match = CYCLE_START.match(text)
+      if (match):
+         self.cycle_valves = match.group(1).split(", ")
+         self.cycle_litres = False
+         for v in self.cycle_valves:
+            self.cycles[v] = self.cycles[v] + 1
+         return
+      match = VALVE_LITRES.match(text)
+      if (match):
+         valves = match.group(1).split(", ")
+         for v in valves:
+            self.litres[v] = self.litres[v] + float(match.group(2)) / len(valves)
+         self.cycle_litres = True
+         return
+      if (text.startswith("Water Cycle Complete") and not self.cycle_litres):
+         match = FLOW.search(text)
+         if (match):
+            for v in self.cycle_valves:
+               self.pulses[v] = self.pulses[v] + int(match.group(1)) / len(self.cycle_valves)
+      elif (text.startswith("Finished Water refresh cycle")):
+         self.refreshes = self.refreshes + 1
+         match = FLOW.search(text)
+         if (match and match.group(2)):
+            self.refresh_litres = self.refresh_litres + float(match.group(2))
+
+   def report(self):
+      print("Water per valve ---------------------------------------------")
+      print("%-6s %8s %12s %10s %12s" % ("valve", "cycles", "minutes", "litres", "flow pulses"))
+      for v in sorted(set(self.seconds) | set(self.cycles) | set(self.litres), key=int):
+         print("%-6s %8d %12.1f %10.2f %12d" % (v, self.cycles[v], self.seconds[v] / 60, self.litres[v], self.pulses[v]))
+      print("Water refresh runs: %d, %.1f minutes, %.2f litres" % (self.refreshes, self.refresh_seconds / 60, self.refresh_litres))
+
+# System log: pH balance decisions and web API successes
+class SysStats:
+   def __init__(self):
+      self.pH = collections.Counter()
+      self.api_ok = collections.Counter()
+      self.starts = 0
+
+   def line(self, t, text):
+      if (text == "Making pH higher"):
+         self.pH["up doses"] = self.pH["up doses"] + 1
+      elif (text == "Making pH lower"):
+         self.pH["down doses"] = self.pH["down doses"] + 1
+      elif (text == "pH is within range"):
+         self.pH["in range"] = self.pH["in range"] + 1
+      elif (text.endswith("no auto adjustment") or text.endswith("no auto adjustment possible")):
+         self.pH["skipped, bad reading"] = self.pH["skipped, bad reading"] + 1
+      elif (text == "Starting"):
+         self.starts = self.starts + 1
+      else:
+         match = API_OK.match(text)
+         if (match):
+            name = match.group(1).lower()
+            self.api_ok[name] = self.api_ok[name] + 1
+
+# Error log: errors per kind and per time bucket, web API failures, USB reset clusters
+class ErrorStats:
+   def __init__(self, bucket):
+      self.bucket = bucket
+      self.kinds = collections.Counter()
+      self.buckets = collections.Counter()  # Bucket start time -> errors
+      self.api_fail = collections.Counter()
+      self.clusters = []                    # [first, last, resets]
+
+   def line(self, t, text):
+      kind = re.sub(r"\d+", "N", text.split(": ", 1)[0]) # Message up to its details, numbers folded
+      self.kinds[kind] = self.kinds[kind] + 1
+      b = t - t % self.bucket
+      self.buckets[b] = self.buckets[b] + 1
+      match = API_FAIL.search(text)
+      if (match):
+         name = (match.group(1) or match.group(2)).lower()
+         self.api_fail[name] = self.api_fail[name] + 1
+      if (text.startswith("Resetting USB bus")):
+         if (self.clusters and t - self.clusters[-1][1] <= USB_CLUSTER_GAP):
+            self.clusters[-1][1] = t
+            self.clusters[-1][2] = self.clusters[-1][2] + 1
+         else:
+            self.clusters.append([t, t, 1])
+
+   def report(self):
+      print("Errors by kind ----------------------------------------------")
+      for kind, count in self.kinds.most_common():
+         print("%8d  %s" % (count, kind))
+      print("Errors per " + str(self.bucket) + " seconds ------------------------------")
+      top = max(self.buckets.values()) if self.buckets else 0
+      for b in sorted(self.buckets):
+         print("%s %6d %s" % (stamp(b), self.buckets[b], "#" * max(1, self.buckets[b] * BAR_WIDTH // top)))
+      print("USB reset clusters ------------------------------------------")
+      for first, last, resets in self.clusters:
+         print("%s to %s  %d reset(s)" % (stamp(first), stamp(last), resets))
+
+def stamp(t):
+   return datetime.fromtimestamp(t).strftime(STAMP_FORMAT)
+
+def report_api(sys_stats, error_stats):
+   print("Web API calls -----------------------------------------------")
+   for name in sorted(set(sys_stats.api_ok) | set(error_stats.api_fail)):
+      ok = sys_stats.api_ok[name]
+      fail = error_stats.api_fail[name]
+      print("%-8s %8d ok %8d failed  %5.1f%% success" % (name, ok, fail, 100 * ok / (ok + fail)))
+
+def parse_time(text):
+   for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+      try:
+         return datetime.strptime(text, fmt).timestamp()
+      except ValueError:
+         pass
+   raise argparse.ArgumentTypeError("time is YYYY-MM-DD [HH:MM[:SS]]: " + text)
+
+# Run every log in directory for [start, end) through the stats, one pass over each file
+def analyse(directory, start, end, bucket, sys_log, pump_log, error_log):
+   index = Index(directory)
+   pump = PumpStats()
+   system = SysStats()
+   errors = ErrorStats(bucket)
+   for name, stats in ((pump_log, pump), (sys_log, system), (error_log, errors)):
+      for path in generations(directory, name):
+         for t, text in read_log(path, index, start, end):
+            stats.line(t, text)
+   index.save()
+   return pump, system, errors
+
+def main():
+   parser = argparse.ArgumentParser(description="Water, pH, error and web API totals from the AutoGro logs")
+   parser.add_argument("start", nargs="?", type=parse_time, help="YYYY-MM-DD [HH:MM[:SS]], default the start of the logs")
+   parser.add_argument("end", nargs="?", type=parse_time, help="YYYY-MM-DD [HH:MM[:SS]], default the end of the logs")
+   parser.add_argument("--days", type=float, help="last this many days, instead of start and end")
+   parser.add_argument("--dir", default=".", help="log directory, default the current one")
+   parser.add_argument("--bucket", type=int, default=3600, help="error histogram bucket in seconds, default 3600")
+   parser.add_argument("--sys", default="AGsys.log", help="system log name, default AGsys.log")
+   parser.add_argument("--pump", default="AGpump.log", help="pump log name, default AGpump.log")
+   parser.add_argument("--error", default="AGerror.log", help="error log name, default AGerror.log")
+   args = parser.parse_args()
+   start = args.start or 0
+   end = args.end or math.inf
+   if (args.days):
+      start = time.time() - args.days * 86400
+   pump, system, errors = analyse(args.dir, start, end, args.bucket, args.sys, args.pump, args.error)
+   print("Program starts: " + str(system.starts))
+   pump.report()
+   print("pH balance ------------------------------------------------")
+   for kind in ("up doses", "down doses", "in range", "skipped, bad reading"):
+      print("%-22s %d" % (kind, system.pH[kind]))
+   report_api(system, errors)
+   errors.report()
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,151 @@
+# Background web API uploader for AutoGro
+# V23
+#
+# APIsensor, APIpump and APIpH store their payload in the outbox (AGoutbox) and
+# return right away, a single worker thread does the web calls.  The worker
+# keeps one keep-alive requests.Session per host so TLS is only set up once,
+# and sends the oldest payloads in batches back to back on it.  After an outage
+# the backlog is replayed the same way, batch after batch, oldest first.
+#
+# A circuit breaker stops web calls after repeated failures.  Each time it
+# opens again the cool down doubles, up to a max, so a long outage costs
+# almost nothing.  A successful call closes it and resets the cool down.
+#
+# Payloads with a json log (pH) get an entry there for each try, marked
+# ERROR for a failed one and Successful call once it goes out.
+
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+import AGhal
+import AGconfig
+import AGmetrics
+
+# Circuit breaker, closed is normal, open is no calls until cool down ends,
+# then one trial call (half open) decides whether to close or open again
+class Breaker:
+   def __init__(self, failures, cooldown, max_cooldown):
+      self.failures = failures          # Consecutive failures before opening
+      self.min_cooldown = cooldown      # First cool down in seconds
+      self.max_cooldown = max_cooldown  # Cool down stops doubling here
+      self.cooldown = cooldown
+      self.count = 0
+      self.open_until = None
+
+   def wait_time(self): # Seconds until calls are allowed, 0 if allowed now
+      if (self.open_until is None):
+         return 0
+      return max(0, self.open_until - AGhal.clock.monotonic())
+
+   def success(self):
+      self.count = 0
+      self.open_until = None
+      self.cooldown = self.min_cooldown
+
+   def failure(self):
+      self.count = self.count + 1
+      if (self.count >= self.failures):
+         AGconfig.AGlog("ERROR - Web API circuit breaker open for " + str(self.cooldown) + " seconds",AGconfig.ERROR)
+         self.open_until = AGhal.clock.monotonic() + self.cooldown
+         self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+
+class Uploader:
+   def __init__(self, outbox, batch_window, batch_size, timeout, breaker, apis):
+      self.outbox = outbox
+      self.batch_window = batch_window
+      self.batch_size = batch_size
+      self.timeout = timeout
+      self.breaker = breaker
+      self.sessions = {}   # One pooled session per host
+      self.wake = threading.Event()
+      self.thread = None
+      self.lock = threading.Lock()
+      self.post_seconds = {}   # Payload name -> metrics, made once here, not per post
+      self.failures = {}
+      for name in apis:
+         self.api_metrics(name)
+
+   def api_metrics(self, name):
+      self.post_seconds[name] = AGmetrics.histogram("ag_api_post_seconds", "Time for one web API post", {"api": name})
+      self.failures[name] = AGmetrics.counter("ag_api_failures", "Web API calls that failed", {"api": name})
+
+   # Persist a payload and wake the worker, never waits on the network
+   def submit(self, name, url, data, json_file):
+      self.start() # Worker starts with the first payload
+      try:
+         evicted = self.outbox.put(name, url, data, json_file)
+      except Exception as e:
+         AGconfig.AGlog("ERROR - Could not store " + name + " payload in outbox: " + str(e),AGconfig.ERROR)
+         return
+      if (evicted):
+         AGconfig.AGlog("ERROR - Outbox full, evicted " + str(evicted) + " oldest payload(s)",AGconfig.ERROR)
+      self.wake.set()
+
+   def start(self):
+      with self.lock:
+         if (self.thread is None):
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+   def session(self, url):
+      host = urlsplit(url).netloc
+      if (host not in self.sessions):
+         self.sessions[host] = requests.Session()
+      return self.sessions[host]
+
+   def post(self, name, url, data): # One web call, True on success
+      if (name not in self.failures): # Payload name not given at start, only its first post looks it up
+         self.api_metrics(name)
+      start = time.perf_counter()
+      try:
+         response = self.session(url).post(url, data=data, timeout=self.timeout)
+      except Exception as e:
+         self.failures[name].inc()
+         self.sessions.pop(urlsplit(url).netloc, None) # Fresh connection next time
+         self.breaker.failure()
+         AGconfig.AGlog("ERROR - Exception on " + name + " web API call, possible timeout",AGconfig.ERROR)
+         return False
+      self.post_seconds[name].observe(time.perf_counter() - start)
+      if (response.status_code != 200 and response.status_code != 201):
+         self.failures[name].inc()
+         self.breaker.failure()
+         AGconfig.AGlog("ERROR - API " + name + " web call failed.  Return code: " + str(response.status_code),AGconfig.ERROR)
+         return False
+      self.breaker.success()
+      AGconfig.AGsys(name + " web API successful")
+      return True
+
+   # Send one batch of the oldest payloads, returns True if the whole batch went out
+   def send_batch(self):
+      sent = []
+      rows = self.outbox.batch(self.batch_size)
+      for row_id, name, url, json_file, data in rows:
+         if (not self.post(name, url, data)):
+            if (json_file is not None): # ERROR entry for every failed try, like the direct calls wrote
+               AGconfig.write_api_json(json_file, data, False)
+            break # Keep order, retry this one first after back off
+         sent.append(row_id)
+         if (json_file is not None):
+            AGconfig.write_api_json(json_file, data, True)
+      self.outbox.delete(sent)
+      return len(sent) == len(rows)
+
+   def run(self):
+      while (True):
+         try:
+            self.run_once()
+         except Exception as e: # Keep the worker alive, the payloads are still in the outbox
+            AGconfig.AGlog("ERROR - Web API uploader: " + str(e),AGconfig.ERROR)
+            AGhal.clock.sleep(self.batch_window)
+
+   def run_once(self):
+      AGhal.clock.sleep(self.breaker.wait_time())
+      self.wake.clear()
+      if (self.outbox.count() == 0):
+         AGhal.clock.wait(self.wake, None) # Idle until the next payload
+         AGhal.clock.sleep(self.batch_window) # Let payloads from the same cycle gather into one batch
+         return
+      backlog = self.outbox.count()
+      if (self.send_batch() and backlog > self.batch_size):
+         AGconfig.AGsys("Replaying web API backlog, " + str(backlog - self.batch_size) + " payload(s) left")
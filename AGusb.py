@@ -0,0 +1,157 @@
+# USB reset and recovery for the pH probe
+# V23
+#
+# Does in process what usb_reset/fix_usb and the usb_reset.c tool did: finds
+# the USB device in sysfs, sends it the USBDEVFS_RESET ioctl, then watches
+# sysfs for the probe's tty to go away and come back instead of sleeping a
+# fixed time.  Needs write access to the /dev/bus/usb node (root, or a udev
+# rule giving the pi user the hub).
+#
+# The device reset is either a vendor:product from lsusb (default the VIA Labs
+# hub the probe hangs off, like fix_usb) or, with "", the USB device that owns
+# the tty.  sysfs and /dev roots are parameters, so the whole path runs
+# against a fake tree:
+#   <root>/sys/bus/usb/devices/1-1/{idVendor,idProduct,busnum,devnum}
+#   <root>/sys/class/tty/ttyUSB0
+#   <root>/dev/bus/usb/001/002
+# with a reset function standing in for the ioctl.
+#
+# Recovery adds exponential back off between resets and keeps the timings.
+#   python3 AGusb.py [tty]      reset now and print the timings
+
+import fcntl
+import glob
+import os
+import sys
+import AGhal
+import AGmetrics
+
+USBDEVFS_RESET = ord("U") << 8 | 20 # _IO('U', 20) from linux/usbdevice_fs.h
+
+OK = "ok"                  # Reset done and the tty is back
+NO_DEVICE = "no_device"    # Nothing in sysfs to reset
+FAILED = "failed"          # Could not open the device node or the ioctl failed
+TIMEOUT = "timeout"        # Reset done, the tty did not come back in time
+
+def ioctl_reset(path): # Send a USB port reset to the device node
+   fd = os.open(path, os.O_WRONLY)
+   try:
+      fcntl.ioctl(fd, USBDEVFS_RESET, 0)
+   finally:
+      os.close(fd)
+
+def _read(path):
+   with open(path) as file:
+      return file.read().strip()
+
+class Device:
+   def __init__(self, device, sysfs_root, dev_root, detach_time, settle_timeout, poll_interval, reset=ioctl_reset):
+      self.device = device                 # "vendor:product" to reset, "" for the tty's own USB device
+      self.sysfs_root = sysfs_root
+      self.dev_root = dev_root
+      self.detach_time = detach_time       # Max seconds to see the tty go away after the reset
+      self.settle_timeout = settle_timeout # Max seconds from the reset to the tty being back
+      self.poll_interval = poll_interval
+      self.reset_fn = reset
+      self.error = None                    # Why the last reset failed
+      self.timings = {}                    # Phase -> seconds for the last reset
+
+   def tty_path(self, port):
+      return os.path.join(self.sysfs_root, "class", "tty", os.path.basename(port))
+
+   # /dev/bus/usb node of the device to reset, None if it is not there
+   def find(self, port):
+      if (self.device):
+         vendor, product = self.device.lower().split(":")
+         for path in sorted(glob.glob(os.path.join(self.sysfs_root, "bus", "usb", "devices", "*"))):
+            try:
+               if (_read(os.path.join(path, "idVendor")) == vendor and _read(os.path.join(path, "idProduct")) == product):
+                  return self.node(path)
+            except OSError:
+               continue # Interfaces have no ids
+         return None
+      path = os.path.realpath(os.path.join(self.tty_path(port), "device"))
+      while (len(path) > len(os.path.realpath(self.sysfs_root))): # Walk up from the interface to its device
+         if (os.path.exists(os.path.join(path, "busnum")) and os.path.exists(os.path.join(path, "devnum"))):
+            return self.node(path)
+         path = os.path.dirname(path)
+      return None
+
+   def node(self, path):
+      return os.path.join(self.dev_root, "bus", "usb", "%03d" % int(_read(os.path.join(path, "busnum"))), \
+         "%03d" % int(_read(os.path.join(path, "devnum"))))
+
+   def wait_for(self, test, timeout): # Poll sysfs until test() or timeout, True if it passed
+      end = AGhal.clock.monotonic() + timeout
+      while (not test()):
+         if (AGhal.clock.monotonic() >= end):
+            return False
+         AGhal.clock.sleep(self.poll_interval)
+      return True
+
+   # Reset the device and wait for port's tty, returns OK, NO_DEVICE, FAILED or TIMEOUT
+   def reset(self, port):
+      self.error = None
+      self.timings = {}
+      start = AGhal.clock.monotonic()
+      node = self.find(port)
+      self.timings["find"] = AGhal.clock.monotonic() - start
+      if (node is None):
+         self.error = "no USB device " + (self.device or "for " + port) + " in " + self.sysfs_root
+         return NO_DEVICE
+      try:
+         self.reset_fn(node)
+      except OSError as e:
+         self.error = "reset of " + node + ": " + str(e)
+         return FAILED
+      reset_done = AGhal.clock.monotonic()
+      self.timings["reset"] = reset_done - start
+      tty = self.tty_path(port)
+      self.wait_for(lambda: not os.path.exists(tty), self.detach_time) # Fast resets can come back before a poll sees it go
+      self.timings["detach"] = AGhal.clock.monotonic() - reset_done
+      back = self.wait_for(lambda: os.path.exists(tty), max(0, start + self.settle_timeout - AGhal.clock.monotonic()))
+      self.timings["reappear"] = AGhal.clock.monotonic() - reset_done
+      if (not back):
+         self.error = tty + " not back after " + str(self.settle_timeout) + " seconds"
+         return TIMEOUT
+      return OK
+
+class Recovery:
+   def __init__(self, device, min_interval, max_interval, reset=None):
+      self.device = device
+      self.min_interval = min_interval # First wait between resets, doubles each reset
+      self.max_interval = max_interval
+      self.interval = min_interval
+      self.reset_fn = reset            # reset(device, port), default device.reset(port)
+      self.next_time = None            # Monotonic time the next reset is allowed, None is now
+      self.last = None                 # Result, seconds, timings and error of the last recovery
+      self.seconds = AGmetrics.histogram("ag_usb_recovery_seconds", "USB reset until the pH probe tty is back")
+      self.resets = {result: AGmetrics.counter("ag_usb_resets", "USB resets for the pH probe by result", {"result": result}) \
+         for result in (OK, NO_DEVICE, FAILED, TIMEOUT)}
+
+   def due(self):
+      return self.next_time is None or AGhal.clock.monotonic() >= self.next_time
+
+   def healthy(self): # Probe is reading again, back off starts over
+      self.interval = self.min_interval
+
+   def recover(self, port): # Reset now, returns the result
+      start = AGhal.clock.monotonic()
+      self.next_time = start + self.interval
+      self.interval = min(self.interval * 2, self.max_interval)
+      if (self.reset_fn is None):
+         result = self.device.reset(port)
+      else:
+         result = self.reset_fn(self.device, port)
+      seconds = AGhal.clock.monotonic() - start
+      self.seconds.observe(seconds)
+      self.resets[result].inc()
+      self.last = {"result": result, "seconds": seconds, "timings": dict(self.device.timings), "error": self.device.error}
+      return result
+
+if __name__ == "__main__":
+   from AGconfig import *
+   port = sys.argv[1] if len(sys.argv) > 1 else run_parms["ph_sensor_port"]
+   device = Device(USB_RESET_DEVICE,USB_SYSFS_ROOT,USB_DEV_ROOT,USB_DETACH_TIME,USB_SETTLE_TIMEOUT,USB_POLL_INTERVAL)
+   result = device.reset(port)
+   print(result, " ".join(name + ": %.2fs" % secs for name, secs in device.timings.items()), device.error or "")
@@ -0,0 +1,156 @@
+# Supervised sensor workers for AutoGro
+# V23
+#
+# Each device class (pH probe, MCP3008, reporting) is read by its own worker
+# thread on its own cadence, so a pH probe stuck in a USB reset no longer
+# holds up soil and TDS.  A worker's read returns the fields it measured,
+# which the worker publishes to the shared AGsnapshot store, the latest
+# values table every other thread reads.
+#
+# The pool's supervisor thread watches every worker:
+#   read raised      worker is failed, restarted after its back off delay
+#   read past its    worker is stuck, its fields are published bad (-1), and
+#   deadline         once the stuck read returns its result is dropped and a
+#                    new thread takes over (Python threads cannot be killed,
+#                    and two threads must never read one device)
+# The back off doubles with each restart up to a max, and goes back to the
+# start delay after a good read.
+#
+# Health states: starting, ok, failed, stuck.
+
+import threading
+import time
+import traceback
+import AGhal
+import AGmetrics
+from AGsnapshot import BAD
+from AGconfig import *
+
+STARTING = "starting"
+OK = "ok"
+FAILED = "failed"
+STUCK = "stuck"
+
+class Worker:
+   def __init__(self, name, make_read, bad_values, interval, deadline, on_publish=None):
+      self.name = name
+      self.make_read = make_read   # Called on each thread start, returns the read function for that thread
+      self.bad_values = bad_values # Snapshot field -> value published as bad when the worker is stuck
+      self.interval = interval     # Seconds from the start of one read to the next
+      self.deadline = deadline     # Seconds a read may take before the worker is stuck
+      self.on_publish = on_publish # Called with each snapshot the worker published
+      self.state = STARTING
+      self.generation = 0          # Bumped on every thread start, an old thread sees it and quits
+      self.read_start = None       # Monotonic start of the read in progress, None between reads
+      self.last_ok = None          # Monotonic time of the last good read
+      self.restart_at = None       # Monotonic time to restart a failed or stuck worker
+      self.thread = None
+      self.read_seconds = AGmetrics.histogram("ag_worker_read_seconds", "Time for one sensor worker read", {"worker": name})
+      self.restarts = AGmetrics.counter("ag_worker_restarts", "Sensor worker restarts after a failed or stuck read", {"worker": name})
+      self.deadline_misses = AGmetrics.counter("ag_worker_deadline_misses", "Sensor worker reads that ran past their deadline", {"worker": name})
+      AGmetrics.gauge("ag_worker_up", "1 if the sensor worker's last read was good", {"worker": name}, fn=lambda: int(self.state == OK))
+
+   def run(self, generation, store, lock):
+      try:
+         read = self.make_read()
+         while (True):
+            with lock:
+               if (generation != self.generation):
+                  return
+               self.read_start = AGhal.clock.monotonic()
+            start = time.perf_counter()
+            fields = read()
+            self.read_seconds.observe(time.perf_counter() - start)
+            with lock:
+               if (generation != self.generation): # Taken over while stuck, the new thread owns the fields
+                  return
+               snapshot = store.publish(**fields) if fields else None
+               if (self.state == FAILED or self.state == STUCK):
+                  AGsys("Sensor worker " + self.name + " recovered")
+               self.state = OK
+               self.last_ok = self.read_start
+               self.read_start = None
+            if (snapshot is not None and self.on_publish is not None):
+               self.on_publish(snapshot)
+            AGhal.clock.sleep(self.last_ok + self.interval - AGhal.clock.monotonic())
+      except Exception as e:
+         with lock:
+            if (generation == self.generation):
+               self.state = FAILED
+               self.read_start = None
+         AGlog("ERROR - Sensor worker " + self.name + " failed: " + str(e) + " " + traceback.format_exc().replace("\n", " | "),ERROR)
+
+class Pool:
+   def __init__(self, store, check_interval, restart_delay, max_restart_delay):
+      self.store = store
+      self.check_interval = check_interval
+      self.restart_delay = restart_delay
+      self.max_restart_delay = max_restart_delay
+      self.workers = []
+      self.delays = {}     # Worker name -> next restart delay
+      self.lock = threading.Lock() # Guards worker state against the worker threads
+      self.started = False
+
+   def add(self, name, make_read, bad_values, interval, deadline, on_publish=None):
+      worker = Worker(name, make_read, bad_values, interval, deadline, on_publish)
+      self.workers.append(worker)
+      self.delays[name] = self.restart_delay
+      return worker
+
+   def start(self):
+      if (self.started):
+         return
+      self.started = True
+      for worker in self.workers:
+         self.start_worker(worker)
+      threading.Thread(target=self.supervise, daemon=True, name="AGsupervisor").start()
+
+   def start_worker(self, worker): # Call with the lock held, or before the workers run
+      worker.generation = worker.generation + 1
+      worker.read_start = None
+      worker.restart_at = None
+      worker.thread = threading.Thread(target=worker.run, args=(worker.generation, self.store, self.lock), \
+         daemon=True, name="AG" + worker.name)
+      worker.thread.start()
+
+   def supervise(self): # Thread
+      while (True):
+         AGhal.clock.sleep(self.check_interval)
+         try:
+            self.check(AGhal.clock.monotonic())
+         except Exception as e:
+            AGlog("ERROR - Sensor worker supervisor: " + str(e),ERROR)
+
+   def check(self, now): # One supervisor pass
+      with self.lock:
+         for worker in self.workers:
+            if (worker.state == OK):
+               self.delays[worker.name] = self.restart_delay
+            if (worker.restart_at is None and worker.read_start is not None and now - worker.read_start > worker.deadline):
+               worker.deadline_misses.inc()
+               AGlog("ERROR - Sensor worker " + worker.name + " stuck for " + str(round(now - worker.read_start)) + \
+                  " seconds, its readings are marked bad",ERROR)
+               worker.state = STUCK
+               worker.generation = worker.generation + 1 # Stuck thread drops its result if it ever returns
+               worker.read_start = None
+               self.store.publish(**{name: (value, BAD) for name, value in worker.bad_values.items()})
+               self.schedule_restart(worker, now)
+            elif (worker.restart_at is None and (worker.state == FAILED or not worker.thread.is_alive())):
+               worker.state = FAILED
+               self.schedule_restart(worker, now)
+            elif (worker.restart_at is not None and now >= worker.restart_at):
+               if (worker.thread.is_alive()): # Stuck read still holds the device, restart after it returns
+                  continue
+               worker.restarts.inc()
+               AGsys("Sensor worker " + worker.name + " was " + worker.state + ", restarting")
+               self.start_worker(worker)
+
+   def schedule_restart(self, worker, now):
+      delay = self.delays[worker.name]
+      worker.restart_at = now + delay
+      self.delays[worker.name] = min(delay * 2, self.max_restart_delay)
+
+   def health(self): # Worker name -> (state, seconds since last good read or None)
+      now = AGhal.clock.monotonic()
+      with self.lock:
+         return {w.name: (w.state, None if w.last_ok is None else now - w.last_ok) for w in self.workers}
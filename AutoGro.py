@@ -33,6 +33,25 @@
 # V21 10-27-23  Made URL parm check non-case sensitive, changed pH_enabled logic, print web parms before checking
 # V22 11-4-23   Process enable/disable fields in api stream as 1/0 instead of bool true/false
 # V23 5-6-24    Added pH check API
+#               Hardware access and clock moved behind AGhal, sim backend for running off the Pi
+#               Master loop replaced by AGsched timer heap on the monotonic clock
+#               Water, refresh and pH dose cycles are AGcycle state machines, no sleeping in the main thread
+#               pH from a persistent reader thread and a streaming estimator, auto balance uses quality gated pH
+#               Soil and TDS read in one oversampled MCP3008 burst scan, fixed TDS average
+#               Parm checks driven by PARM_SCHEMA, only changed keys are checked and logged
+#               Remote parms polled by AGremote with ETag / hash checks, jitter and back off
+#               Parm changes applied live, timers keep their phase, no restart
+#               Timers and cached pH checkpointed to AGstate.json, warm restart resumes the schedule
+#               Flow pulses time stamped in an AGflow ring buffer, flow rate, litres per cycle and leak check
+#               Valves due close together can share one pump run, refresh skipped after a recent pump run
+#               Counters and latency histograms served in Prometheus format by AGmetrics
+#               Bench/AGbench.py times the hot paths on sim hardware against a saved baseline
+#               AGreplay drives the controller from recorded logs on the sim backend, AG_HAL=replay
+#               AGstats.py water, pH, error and web API totals from the logs, seeks time ranges with a sparse index
+#               Valves can water on a soil sensor reading, low / high thresholds and spacing per valve
+#               pH, TDS, soil and relay state shared between threads as AGsnapshot versioned read only snapshots
+#               pH, soil / TDS and reporting each on a supervised AGworkers thread, deadlines and restart back off
+#               pH probe USB reset done in process by AGusb, waits for the tty in sysfs, back off between resets
 
 
 # SPDX-FileCopyrightText: 2021 ladyada for Adafruit Industries
@@ -45,25 +64,44 @@
 # For Bookworm OS and newer GPIO pin access has changed - to correct pin trigger on flow meter:
 #  sudo apt remove python3-rpi.gpio
 #  pip3 install rpi-lgpio
+#
+# To run on simulated hardware, a full day in about 20 seconds:
+#  AG_HAL=sim AG_SIM_SPEED=5000 AG_SIM_RUN_TIME=86400 python3 AutoGro.py
+# Sim and replay runs make no web API calls, AG_SIM_WEB_API=1 sends them to the run_parms urls
+# To rerun a node's recorded logs through the controller (see AGreplay.py):
+#  AG_HAL=replay AG_REPLAY_DIR=Example_Logs AG_SIM_SPEED=20 python3 AutoGro.py
 
 
 import array
-import copy
-import time
-import busio
-import digitalio
-import board
-import RPi.GPIO as GPIO
-import adafruit_mcp3xxx.mcp3008 as MCP
-from adafruit_mcp3xxx.analog_in import AnalogIn
 from datetime import datetime
 import signal
 import sys
 import csv
 import threading
-import AGconfig # Doing this to get access to global_pH variable
+import AGhal
+import AGsched
+import AGcycle
+import AGremote
+import AGcheckpoint
+import AGflow
+import AGmetrics
+import AGreplay
+import AGseries
+import AGworkers
+from AGsnapshot import GOOD, CACHED # Quality flags for shared_state fields
+import AGconfig # History and uploader are made at startup, see start_node()
 from AGconfig import *
 from AGsensors import *
+import AGsensors # Soil readings reach the scheduler through AGsensors.soil_channel
+
+# Select real or simulated hardware before anything touches a pin or the clock
+if (HAL_BACKEND == "replay"): # Sim hardware reading back recorded logs
+   replay = AGreplay.init(REPLAY_DIR,RELAY_PINS,FLOW_PIN_INPUT,PH_UP_RELAY,PH_DOWN_RELAY,SIM_SPEED)
+else:
+   AGhal.init(HAL_BACKEND,RELAY_PINS,FLOW_PIN_INPUT,PH_UP_RELAY,PH_DOWN_RELAY,SIM_SPEED)
+AGconfig.start_node() # Sensor / pump history and the web API outbox
+GPIO = AGhal.gpio
+clock = AGhal.clock
 
 AGsys("Starting")
 AGsys("Version: " + str(VERSION))
@@ -80,15 +118,21 @@ AGsys("AG system log: " + SYS)
 AGsys("AG pump log: " + PUMP)
 AGsys("AG sensor log: " + SENSORS)
 AGsys("AG error log: " + ERROR)
-AGsys("AG sensor json log: " + SENSOR_JSON_FILE)
-AGsys("AG pump json log: " + PUMP_JSON_FILE)
+AGsys("AG sensor / pump history: " + SERIES_DIR)
 AGsys("AG file parm file: " + FILE_PARMS)
 AGsys("AG remote config url: " + REMOTE_PARM_URL)
 AGsys("Turn on remote parms: " + str(REMOTE_PARMS))
 AGsys("Remote parm interval: " + str(REMOTE_PARM_INTERVAL))
 AGsys("Reflect parm url: " + REFLECT_PARM_URL)
 AGsys("Enable reflect parms: " + str(REFLECT_PARMS))
-AGsys("USB reset command: " + USB_RESET)
+AGsys("USB reset device: " + (USB_RESET_DEVICE or "pH probe") + " sysfs: " + USB_SYSFS_ROOT)
+AGsys("Hardware backend: " + HAL_BACKEND)
+if (HAL_BACKEND == "sim" or HAL_BACKEND == "replay"):
+   AGsys("Sim clock speed: " + str(SIM_SPEED))
+   AGsys("Sim run time: " + str(SIM_RUN_TIME))
+   AGsys("Sim web API calls: " + ("on, AG_SIM_WEB_API=1" if SIM_WEB_API else "off, set AG_SIM_WEB_API=1 to send"))
+if (HAL_BACKEND == "replay"):
+   AGsys("Replay logs: " + REPLAY_DIR)
 AGsys(".........................................")
 
 AGsys("Default parms ----------------------------------")
@@ -100,39 +144,34 @@ AGsys("End default parms ------------------------------")
 ######## Read in old parms from file, verify, apply as needed #########################################
 file_parms = read_parm_file()
 if (len(file_parms) > 0):
-   AGsys("Checking file parms for runtime update, file parms ------------")
-   write_json_to_log(file_parms)
-   AGsys("End of file parms --------------------------")
+   AGsys("Checking file parms for runtime update")
    if (update_parms(file_parms)):
       AGsys("One or more runtime parms were updated from file")
-      AGsys("Updated parms from file -----------------------")
-      write_json_to_log(run_parms)
-      AGsys("End updated parms from file -------------------")
    else:
       AGsys("No file parms were qualified for update")
 else:
    AGsys("No file parms to check")
 
 ############# Read initial remote parms #########################################
+config_sync = AGremote.ConfigSync(REMOTE_PARM_URL,REMOTE_PARM_INTERVAL,REMOTE_PARM_JITTER,REMOTE_PARM_TIMEOUT,REMOTE_PARM_MAX_BACKOFF)
 if (REMOTE_PARMS):
    AGsys("Getting remote parms from web api")
-   remote_parms = read_remote_parms()
-   old_remote_parms = copy.deepcopy(remote_parms) # keep copy of parms
-   if (remote_parms != {} and len(remote_parms) > 0):
-      AGsys("Received remote parms, these are parms ---------")
-      write_json_to_log(remote_parms[0])
-      AGsys("Checking remote parms ----------")
-      if (update_parms(remote_parms[0])):
+   status, remote_parms = config_sync.fetch()
+   if (status == AGremote.CHANGED):
+      AGsys("Received remote parms, checking them")
+      if (update_parms(remote_parms)):
          AGsys("Parms updated, writing to file")
          write_parm_file()
-         AGsys("New parms after remote update -----------------")
-         write_json_to_log(run_parms)
-         AGsys("End remote parm updates ----------------------")
       else:
          AGsys("No updated needed for remote parms")
    else:
       AGsys("No remote parms available")
 
+if (HAL_BACKEND == "replay"): # Run with the parms the recorded node logged at its start
+   AGsys("Checking parms recorded in the replay logs")
+   if (not update_parms(replay.take_parms(clock.monotonic()))):
+      AGsys("No recorded parms were qualified for update")
+
 if (REFLECT_PARMS): # Push running parms back to web api if enabled
    write_parm_api()
 
@@ -142,19 +181,36 @@ if (REFLECT_PARMS): # Push running parms back to web api if enabled
 # The VALVES list contains the water valve timing information
 # First value is time between valve watering and second value is the duration the valve is open
 # If the valve is disabled, before parms are set to zero
-VALVES = []
-for a in range(MAX_WATER_VALVES):
-   if (run_parms["valve" + str(a+1) + "_active"] == True):
-      VALVES.append( [ run_parms["valve" + str(a+1) + "_time"], run_parms["valve" + str(a+1) + "_duration"] ] )
-   else:
-      VALVES.append( [0,0] )
+def build_valves(): # Valve table from run_parms
+   valves = []
+   for a in range(MAX_WATER_VALVES):
+      if (run_parms["valve" + str(a+1) + "_active"] == True):
+         valves.append( [ run_parms["valve" + str(a+1) + "_time"], run_parms["valve" + str(a+1) + "_duration"] ] )
+      else:
+         valves.append( [0,0] )
+   return valves
 
-AGsys("Water schedule in seconds, zero means valve disabled --------")
-cnt = 1
-for valve in VALVES:
-   AGsys("Valve: " + str(cnt) + " Time: " + str(valve[0]) + " Duration: " + str(valve[1]))
-   cnt = cnt + 1
-AGsys("....................................")
+def soil_sensor(valve_number): # Soil sensor channel for a valve, None if it waters on its timer only
+   channel = run_parms["valve" + str(valve_number + 1) + "_soil_sensor"]
+   if (channel < 0 or channel >= run_parms["number_of_soil_sensors"] or VALVES[valve_number][0] == 0):
+      return None
+   return channel
+
+def log_valves():
+   AGsys("Water schedule in seconds, zero means valve disabled --------")
+   cnt = 1
+   for valve in VALVES:
+      soil = ""
+      if (soil_sensor(cnt - 1) is not None):
+         prefix = "valve" + str(cnt) + "_soil_"
+         soil = " Soil sensor: " + str(run_parms[prefix + "sensor"]) + " Low: " + str(run_parms[prefix + "low"]) + \
+            " High: " + str(run_parms[prefix + "high"]) + " Spacing: " + str(run_parms[prefix + "spacing"])
+      AGsys("Valve: " + str(cnt) + " Time: " + str(valve[0]) + " Duration: " + str(valve[1]) + soil)
+      cnt = cnt + 1
+   AGsys("....................................")
+
+VALVES = build_valves()
+log_valves()
 
 def all_relays_off(): # Force all relays off - shutoff pump and valves
    cnt = 0
@@ -162,10 +218,11 @@ def all_relays_off(): # Force all relays off - shutoff pump and valves
       GPIO.setup(a,GPIO.OUT)
       GPIO.output(a,0)
       if (cnt == 0):
-         time.sleep(PUMP_DELAY) # Make sure pump is off before turning off valves
+         clock.sleep(PUMP_DELAY) # Make sure pump is off before turning off valves
       cnt = cnt + 1
 
 def log_water_valve_status(): # Log status of pump and valves
+   Relay_Status = relays()
    output = "Pump: "
    if (Relay_Status[0] == True):
       output = output + "On "
@@ -179,76 +236,130 @@ def log_water_valve_status(): # Log status of pump and valves
       else:
          output = output + "Off"
       cnt = cnt + 1
-   output = output + "  Flow Meter: " + str(flow_count)
+   output = output + "  Flow Meter: " + str(flow_count()) + "  Flow: %.2f l/min (now %.2f)" % (flow.rate(FLOW_RATE_WINDOW), \
+      flow.instant_rate(FLOW_INSTANT_MAX_AGE))
    AGlog(output,PUMP)
 
+def relays(): # Relay states as last published, a tuple, pump is relay 0
+   return shared_state.current.relays.value
+
 def relay_control():
+   global pump_stop_time, pump_start_time, last_circulation
+   Relay_Status = relays()
    for i in range(0,len(Relay_Status)):
       if (Relay_Status[i]):
          GPIO.output(Relays[i],1)
       else:
          GPIO.output(Relays[i],0)
-
-def water_refresh():
-   global flow_count
-   AGsys("Starting Water refresh cycle");
-   AGlog("Starting Water refresh cycle ------ Flow = " + str(flow_count),PUMP)
-   Relay_Status[0] = True # Turn on water pump
-   APIpump(Relay_Status,flow_count)
-   relay_control()
-   log_water_valve_status()
-   time.sleep(run_parms["water_refresh_cycle_length"])
-   Relay_Status[0] = False # Turn off water pump
-   APIpump(Relay_Status,flow_count)
+   if (Relay_Status[0]):
+      if (pump_stop_time is not None):
+         pump_start_time = clock.monotonic()
+      pump_stop_time = None
+   elif (pump_stop_time is None):
+      pump_stop_time = clock.monotonic()
+      if (pump_stop_time - pump_start_time >= run_parms["water_refresh_cycle_length"]):
+         last_circulation = pump_start_time # Ran long enough to count as a water refresh started then
+
+def set_relays(changes): # {relay: state}, publish the new relay states and push them to GPIO
+   states = list(relays())
+   for relay, state in changes.items():
+      states[relay] = state
+   shared_state.publish(relays=(tuple(states), GOOD))
    relay_control()
-   log_water_valve_status()
-   AGsys("Finished Water refresh cycle");
-   AGlog("Finished Water refresh cycle ----- Flow = " + str(flow_count),PUMP)
-   flow_count = 0
-
-# Water cycle routine, run a single passed in valve  ##########################################
-def run_water_cycle(valve_number):
-   global flow_count
-   AGsys("Starting Water Cycle Valve: " + str(valve_number + 1) + " Flow = " + str(flow_count))
-   AGlog("Starting Water Cycle Valve: " + str(valve_number + 1) + " Flow = " + str(flow_count),PUMP)
-   APIpump(Relay_Status,flow_count)
-
-   flow_count = 0 # Reset flow count after logging start cycle to look for leaks during sleep
-
-   Relay_Status[valve_number + 1] = True # Turn valve on, pump is zero, valves start at 1
-   APIpump(Relay_Status, flow_count) # Before relay engage incase web api is delayed
-   flow_count = 0
-   relay_control()
-   log_water_valve_status()
-   time.sleep(PUMP_DELAY)
 
-   Relay_Status[0] = True # Turn on water pump (Zero is pump relay)
-   APIpump(Relay_Status, flow_count)
-   relay_control()
-   log_water_valve_status()
-   time.sleep(VALVES[valve_number][1])
-
-   Relay_Status[0] = False # Turn off water pump (Zero is pump relay)
-   APIpump(Relay_Status, flow_count)
-   relay_control()
-   log_water_valve_status()
-   time.sleep(PUMP_DELAY)
-
-   Relay_Status[valve_number + 1] = False # Turn off valve
-   relay_control()
-   log_water_valve_status()
-   APIpump(Relay_Status, flow_count) # After relay engage incase web api delay
-   flow_count = 0
-   time.sleep(PUMP_DELAY)
-
-   AGsys("Water Cycle Complete - Flow = " + str(flow_count))
-   AGlog("Water Cycle Complete - Flow = " + str(flow_count),PUMP)
-   APIpump(Relay_Status, flow_count)
+# Water refresh cycle, run pump with no valves open ###########
+def water_refresh(on_done=None):
+   def start():
+      pump_starts.inc()
+      AGsys("Starting Water refresh cycle");
+      AGlog("Starting Water refresh cycle ------ Flow = " + str(flow_count()),PUMP)
+      set_relays({0: True}) # Turn on water pump
+      APIpump(relays(),flow_count())
+      log_water_valve_status()
+
+   def finish():
+      set_relays({0: False}) # Turn off water pump
+      APIpump(relays(),flow_count())
+      log_water_valve_status()
+      AGsys("Finished Water refresh cycle");
+      AGlog("Finished Water refresh cycle ----- Flow = " + str(flow_count()) + " (%.2f litres)" % flow.litres(flow_count()),PUMP)
+      reset_flow()
+
+   return AGcycle.Cycle("refresh", [(start, run_parms["water_refresh_cycle_length"]), (finish, 0)], on_done=on_done, relays=[0])
+
+# Water cycle routine, run the passed in valves on one pump start  ############################
+# Steps: valves open -> pump on -> valves close as their durations end, shortest first
+#        -> pump off -> last valve close -> complete
+# One valve is the original single valve cycle
+def run_water_cycle(valve_numbers):
+   valve_numbers = sorted(valve_numbers, key=lambda v: VALVES[v][1])
+   names = ", ".join(str(v + 1) for v in valve_numbers)
+
+   def valve_open():
+      for v in valve_numbers:
+         last_watered[v] = clock.monotonic()
+      AGsys("Starting Water Cycle Valve: " + names + " Flow = " + str(flow_count()))
+      AGlog("Starting Water Cycle Valve: " + names + " Flow = " + str(flow_count()),PUMP)
+      APIpump(relays(),flow_count())
+
+      reset_flow() # Reset flow count after logging start cycle to look for leaks during sleep
+
+      set_relays({v + 1: True for v in valve_numbers}) # Turn valve on, pump is zero, valves start at 1
+      APIpump(relays(), flow_count())
+      reset_flow()
+      log_water_valve_status()
+
+   pump_on_time = [0] # Set when the pump starts, valve open time is measured from it
+
+   def pump_on():
+      pump_on_time[0] = clock.monotonic()
+      pump_starts.inc()
+      set_relays({0: True}) # Turn on water pump (Zero is pump relay)
+      APIpump(relays(), flow_count())
+      log_water_valve_status()
+
+   def early_close(valve_number): # Valve done while others in the batch keep watering
+      def close():
+         valve_drift.observe(clock.monotonic() - pump_on_time[0] - VALVES[valve_number][1])
+         set_relays({valve_number + 1: False})
+         log_water_valve_status()
+         APIpump(relays(), flow_count())
+      return close
+
+   def pump_off():
+      valve_drift.observe(clock.monotonic() - pump_on_time[0] - VALVES[valve_numbers[-1]][1])
+      set_relays({0: False}) # Turn off water pump (Zero is pump relay)
+      APIpump(relays(), flow_count())
+      log_water_valve_status()
+
+   def valve_close():
+      set_relays({valve_numbers[-1] + 1: False}) # Turn off valve
+      log_water_valve_status()
+      APIpump(relays(), flow_count())
+      AGlog("Valve " + names + " cycle used %.2f litres" % flow.litres(flow_count()),PUMP)
+      reset_flow()
+
+   def complete():
+      AGsys("Water Cycle Complete - Flow = " + str(flow_count()))
+      AGlog("Water Cycle Complete - Flow = " + str(flow_count()),PUMP)
+      APIpump(relays(), flow_count())
+
+   steps = [(valve_open, PUMP_DELAY), (pump_on, VALVES[valve_numbers[0]][1])]
+   for i in range(1, len(valve_numbers)):
+      steps.append((early_close(valve_numbers[i-1]), VALVES[valve_numbers[i]][1] - VALVES[valve_numbers[i-1]][1]))
+   steps = steps + [(pump_off, PUMP_DELAY), (valve_close, PUMP_DELAY), (complete, 0)]
+   covers = ["valve" + str(v + 1) for v in valve_numbers]
+   return AGcycle.Cycle("+".join(covers), steps, covers=covers, relays=[0] + [v + 1 for v in valve_numbers])
 # End water cycle routine #####################################
 
+# pH dose cycle, open pH up or down valve for ph_valve_time
+def pH_dose(relay, ph_check_signal):
+   return AGcycle.Cycle("pH_dose", [(lambda: set_relays({relay: True}), run_parms["ph_valve_time"]), \
+      (lambda: set_relays({relay: False}), 0), (lambda: APIpH(ph_check_signal), 0)], uses_pump=False, relays=[relay])
+
 # Adjust pH if needed #########################################
 def adjust_pH():
-   current_pH = AGconfig.global_pH # Storing to prevent reading change while doing auto pH correct
+   current_pH = get_pH_driver() # Fresh, quality gated pH from the estimator, -1 if stale or noisy
 
    # If you needed to force pH value to test
    # current_pH = 3
@@ -257,56 +368,61 @@ def adjust_pH():
    upper_pH = run_parms["ideal_ph"] + run_parms["ph_spread"]
    AGsys("Auto pH enabled, Current pH: " + str(current_pH) + ", Range goal (" + str(lower_pH) + " - " + str(upper_pH) + ")")
 
-   if (current_pH < 2 or current_pH > 12): # Prevent some odd pH reading from impacting auto ajustment
+   if (current_pH == -1): # Never dose on a cached or noisy reading
+      pH_value, pH_std, pH_age = pH_reader.estimate()
+      AGsys("pH reading is not fresh and stable (std dev: %.3f age: %.0f), no auto adjustment" % (pH_std, pH_age))
+      AGlog("ERROR - pH reading not usable and auto balance enabled",ERROR)
+   elif (current_pH < 2 or current_pH > 12): # Prevent some odd pH reading from impacting auto ajustment
       AGsys("pH reading is out of spec, no auto adjustment possible")
       AGlog("ERROR - pH reading is out of spec and auto balance enabled",ERROR)
    else:
       if (current_pH < lower_pH): # pH too low, make higher
+         ph_doses_up.inc()
          AGsys("Making pH higher")
-         Relay_Status[PH_UP_RELAY] = True
-         relay_control()
-         time.sleep(run_parms["ph_valve_time"])
-         Relay_Status[PH_UP_RELAY] = False
-         relay_control()
-         APIpH(1)
+         cycles.start(pH_dose(PH_UP_RELAY, 1))
 
       if (current_pH > upper_pH): # pH too high, make lower
+         ph_doses_down.inc()
          AGsys("Making pH lower")
-         Relay_Status[PH_DOWN_RELAY] = True
-         relay_control()
-         time.sleep(run_parms["ph_valve_time"])
-         Relay_Status[PH_DOWN_RELAY] = False
-         relay_control()
-         APIpH(2)
+         cycles.start(pH_dose(PH_DOWN_RELAY, 2))
 
       if (current_pH < upper_pH and current_pH > lower_pH): # pH needs no adjustment
          AGsys("pH is within range")
          APIpH(0)
 
-   pH_time_limit = time.time() + run_parms["ph_balance_interval"]
    AGsys("pH auto adjustment routine complete")
 # End adjust pH if needed #####################################
 
 GPIO.setmode(GPIO.BCM)
 
 #Relay GPIO pin setup
-Relays = [5,6,13,16,19,20,21,26]
+Relays = RELAY_PINS
 all_relays_off()
-Relay_Status = [False,False,False,False,False,False,False,False] # Pi hat has eight relays
+shared_state.publish(relays=((False,) * len(Relays), GOOD)) # Pi hat has eight relays, all off
+
+pump_stop_time = clock.monotonic() # When the pump last turned off, None while it runs
+pump_start_time = 0                # When the pump last turned on
+last_circulation = None            # Start of the last pump run long enough to refresh the water
 
-flow_count = 0  # used to store total flow count
-# routine for flow meter pin interrupt
-def flow_meter_trigger(channel):
-   global flow_count
-   flow_count = flow_count + 1
+# Flow meter pulses go into a time stamped ring buffer, see AGflow.py
+flow = AGflow.FlowMeter(FLOW_RING_SIZE,FLOW_LITRES_PER_PULSE)
+flow_mark = 0 # flow.count at the last flow reset
+
+def flow_count(): # Pulses since last reset
+   return flow.since(flow_mark)
+
+def reset_flow():
+   global flow_mark
+   flow_mark = flow.count
 
 # setup Flow meter input pin - 25
 GPIO.setup(FLOW_PIN_INPUT,GPIO.IN,pull_up_down=GPIO.PUD_DOWN)
-GPIO.add_event_detect(FLOW_PIN_INPUT,GPIO.FALLING,callback=flow_meter_trigger,bouncetime=5)
+GPIO.add_event_detect(FLOW_PIN_INPUT,GPIO.FALLING,callback=flow.pulse,bouncetime=FLOW_BOUNCE_TIME)
 
 # Catch ctrl-c and turn off pump before exit
 def signal_handler(sig,frame):
    all_relays_off()
+   save_checkpoint()
    AGsys("Program exit")
    sys.exit(0)
 
@@ -314,109 +430,295 @@ def signal_handler(sig,frame):
 signal.signal(signal.SIGINT,signal_handler)
 signal.signal(signal.SIGTERM,signal_handler)
 
-# Make sure pH sample bucket is full before starting sensor thread
-water_refresh()
-
-# Start sensor thread
-sensor_thread = threading.Thread(target=sensors,daemon=True)
-sensor_thread.start()
-
-remote_parm_time_limit = time.time() + REMOTE_PARM_INTERVAL # This is the timer for accessing remote web api parms
-pH_time_limit = time.time() + run_parms["ph_balance_interval"] # Time when the next pH auto cycle can run
-water_refresh_time_limit = time.time() + run_parms["water_refresh_cycle"] # Time when the next water refresh cycle will run for pH  sensor
-logging_timer = 0 # Controls when logs output for timing status
-
-valve_timers = [] # Setup initial time numbers for valves
-for valve in VALVES:
-   valve_timers.append(valve[0] + time.time())
-
-while(True): # Master loop for water cycle and pH rebalance
-
-   if (run_parms["balance_ph"] and (pH_time_limit - time.time()) < 1): # pH balance routine
-      valve_number = -1 # Must be -1 for logic below to work
-      cnt = 0
-      shortest_timer = -1 # This must be -1 for logic below
-      for valve_time in valve_timers:
-         if (VALVES[cnt][0] != 0 and (valve_time < shortest_timer or valve_number == -1)):
-            shortest_timer = valve_time
-            valve_number = cnt
-         cnt = cnt + 1
-
-      # Check and see if too close to a water cycle to adjust pH
-      # shortest_timer == -1 if there are no valves enabled
-      if (run_parms["ph_balance_water_limit"] <  shortest_timer - time.time() or shortest_timer == -1):
+# Metrics, served at http://METRICS_HOST:METRICS_PORT/metrics, see AGmetrics.py
+pump_starts = AGmetrics.counter("ag_pump_starts", "Pump starts for water and refresh cycles")
+valve_drift = AGmetrics.histogram("ag_valve_drift_seconds", "Valve open time with the pump on minus its set duration")
+soil_signal = AGmetrics.histogram("ag_soil_signal_seconds", "Time from a soil reading in the sensor thread to the scheduler acting on it")
+soil_waterings = AGmetrics.counter("ag_soil_waterings", "Water cycles started by a dry soil sensor")
+adjust_pH_seconds = AGmetrics.histogram("ag_adjust_ph_seconds", "Time for one pH check and adjust")
+ph_doses_up = AGmetrics.counter("ag_ph_doses", "pH dose cycles started", {"direction": "up"})
+ph_doses_down = AGmetrics.counter("ag_ph_doses", "pH dose cycles started", {"direction": "down"})
+AGmetrics.gauge("ag_flow_pulses", "Flow meter pulses since start", fn=lambda: flow.count)
+AGmetrics.gauge("ag_flow_rate", "Flow in litres per minute from the last two pulses", fn=lambda: flow.instant_rate(FLOW_INSTANT_MAX_AGE))
+AGmetrics.gauge("ag_ph", "Filtered pH from the probe, -1 if none", fn=lambda: pH_reader.estimate()[0])
+if (METRICS_PORT):
+   try:
+      AGmetrics.serve(METRICS_PORT,METRICS_HOST)
+   except Exception as e:
+      AGlog("ERROR - Could not start metrics endpoint: " + str(e),ERROR)
+
+scheduler = AGsched.Scheduler()
+def cycle_failed(cycle, e): # A cycle step raised, shut its relays and let whatever waits on it carry on
+   AGlog("ERROR - " + cycle.name + " cycle failed, turning its relays off: " + str(e),ERROR)
+   AGsys("Cycle " + cycle.name + " failed, relays off: " + ", ".join(str(r) for r in cycle.relays))
+   set_relays({r: False for r in cycle.relays})
+   log_water_valve_status()
+   if (cycle.on_done is not None):
+      cycle.on_done()
+
+cycles = AGcycle.CycleRunner(scheduler, cycle_failed) # Steps valve, refresh and pH dose cycles from the scheduler
+
+# Sensor workers, pH / soil and TDS / reporting each on a supervised thread, see AGworkers.py
+sensor_pool = sensor_workers()
+def start_sensors():
+   sensor_pool.start()
+
+# Warm start from the last checkpoint if it is recent, the schedule carries on where it stopped
+warm = None
+if (HAL_BACKEND != "replay"): # A replay always starts the way the recorded node did
+   warm = AGcheckpoint.load(CHECKPOINT_FILE, CHECKPOINT_MAX_AGE)
+if (warm is not None):
+   AGsys("Warm start from checkpoint, down for " + str(round(warm["down"])) + " seconds")
+   if (warm["pH"] != -1 and warm["pH_age"] is not None):
+      shared_state.publish(pH=(warm["pH"], CACHED, clock.monotonic() - warm["pH_age"])) # Cached pH until the probe reader has fresh readings
+   start_sensors() # Reservoir was circulated before the restart, no refresh needed first
+else:
+   # Make sure pH sample bucket is full before starting the sensor workers
+   cycles.start(water_refresh(on_done=start_sensors))
+
+# Scheduled jobs ##############################################################
+# Every timed routine is a job on the scheduler, each returns seconds until it runs again
+
+def valve_job(valve_number): # Water cycle for one valve, waits its turn if the pump is busy
+   name = "valve" + str(valve_number + 1)
+   if (cycles.running(name)):
+      AGsys("Water cycle valve: " + str(valve_number + 1) + " still running, skipping this cycle")
+   elif (soil_controlled(valve_number)):
+      AGsys("Water cycle valve: " + str(valve_number + 1) + " soil at " + str(soil_readings[valve_number][1]) + \
+         "% wet decides, skipping timer cycle")
+   else:
+      cycles.start(run_water_cycle([valve_number] + batch_valves(valve_number)))
+   return VALVES[valve_number][0]
+
+# Other valves due within valve_batch_window, they water early on this pump start
+# Up to pump_max_valves open at once, their timers restart from now
+def batch_valves(valve_number):
+   window = run_parms["valve_batch_window"]
+   if (window <= 0):
+      return []
+   due = []
+   for cnt in range(len(VALVES)):
+      name = "valve" + str(cnt + 1)
+      left = scheduler.time_left(name)
+      if (cnt != valve_number and left is not None and left <= window and not cycles.running(name) and not soil_controlled(cnt)):
+         due.append((left, cnt))
+   batch = [cnt for left, cnt in sorted(due)][:run_parms["pump_max_valves"] - 1]
+   for cnt in batch:
+      scheduler.after(VALVES[cnt][0], "valve" + str(cnt + 1), lambda cnt=cnt: valve_job(cnt))
+   return batch
+
+# Soil triggered watering ####################################################
+# A valve with a soil sensor waters when its bed reads at or below soil_low %
+# wet, then not again until the bed is back up to soil_high (hysteresis) and
+# soil_spacing seconds have passed.  While its sensor gives fresh readings the
+# valve's timer does not water it.  A disconnected sensor or stale readings
+# hand the valve back to its timer.
+soil_readings = [None] * MAX_WATER_VALVES  # Latest (monotonic time, % wet) of each soil triggered valve's sensor
+soil_armed = [True] * MAX_WATER_VALVES      # Cleared when a valve waters on soil, set again when its bed is wet again
+last_watered = [None] * MAX_WATER_VALVES    # Monotonic start of each valve's last water cycle
+
+def soil_controlled(valve_number): # True while a fresh soil reading decides when this valve waters
+   reading = soil_readings[valve_number]
+   return soil_sensor(valve_number) is not None and reading is not None and clock.monotonic() - reading[0] <= SOIL_MAX_AGE
+
+def soil_job(snapshot): # Sensor thread published a pass, runs on the scheduler thread at once
+   now = snapshot.soil.time
+   percents = snapshot.soil.value
+   soil_signal.observe(clock.monotonic() - now)
+   for cnt in range(len(VALVES)):
+      channel = soil_sensor(cnt)
+      if (channel is None or percents[channel] == -1): # -1 is a disconnected sensor
+         soil_readings[cnt] = None
+         continue
+      wet = percents[channel]
+      soil_readings[cnt] = (now, wet)
+      prefix = "valve" + str(cnt + 1)
+      low = run_parms[prefix + "_soil_low"]
+      if (wet >= max(low, run_parms[prefix + "_soil_high"])):
+         soil_armed[cnt] = True
+      elif (wet <= low and soil_armed[cnt] and not cycles.running(prefix) and \
+            (last_watered[cnt] is None or now - last_watered[cnt] >= run_parms[prefix + "_soil_spacing"])):
+         soil_armed[cnt] = False
+         soil_waterings.inc()
+         AGsys("Soil sensor " + str(channel) + " at " + str(wet) + "% wet, starting water cycle valve: " + str(cnt + 1))
+         cycles.start(run_water_cycle([cnt] + batch_valves(cnt)))
+
+def pH_job(): # pH balance routine
+   if (not run_parms["balance_ph"]):
+      return run_parms["ph_balance_interval"]
+
+   # Check and see if too close to a water cycle to adjust pH
+   # shortest_timer is None if there are no valves enabled
+   valve_name, shortest_timer = scheduler.next_job("valve")
+   if (cycles.busy() or cycles.running("pH_dose")): # Never dose while the pump is running a cycle
+      AGsys("Water cycle running, pH balance routine rescheduled")
+      return run_parms["ph_balance_retry"]
+   if (shortest_timer is None or run_parms["ph_balance_water_limit"] < shortest_timer - clock.monotonic()):
+      with adjust_pH_seconds.time():
          adjust_pH()
-         pH_time_limit = time.time() + run_parms["ph_balance_interval"] # Time when the next pH auto cycle can run
-      else: # Water cycle too close, reschedule
-         AGsys("Water cycle too close to run pH balance routine, reschedule!!!!!")
-         AGsys("Limit: " + str(round((run_parms["ph_balance_water_limit"] / 60),1)) + " Next water cycle valve: "\
- + str(valve_number + 1) + " Time: " + str(round((shortest_timer - time.time())/60,1)))
-         pH_time_limit = time.time() + run_parms["ph_balance_retry"]
-
-   # If needed run valve water cycle if timer is up
-   # Check all valves here
-   cnt = 0
-   for valve_time in valve_timers:
-      if (valve_time < time.time()):
-         if (VALVES[cnt][0] != 0): # Zero here means valve is disabled
-            run_water_cycle(cnt)
-         valve_timers[cnt] = time.time() + VALVES[cnt][0]
-      cnt = cnt + 1
+      return run_parms["ph_balance_interval"] # Time when the next pH auto cycle can run
+   else: # Water cycle too close, reschedule
+      AGsys("Water cycle too close to run pH balance routine, reschedule!!!!!")
+      AGsys("Limit: " + str(round((run_parms["ph_balance_water_limit"] / 60),1)) + " Next water cycle valve: "\
+ + valve_name[len("valve"):] + " Time: " + str(round((shortest_timer - clock.monotonic())/60,1)))
+      return run_parms["ph_balance_retry"]
+
+def water_refresh_job(): # Water refresh routine
+   if (run_parms["refresh_credit"] and last_circulation is not None \
+      and clock.monotonic() - last_circulation < run_parms["water_refresh_cycle"]):
+      AGsys("Pump ran recently, water refresh not needed")
+      return last_circulation + run_parms["water_refresh_cycle"] - clock.monotonic() # Counts as the last refresh
+   if (not cycles.running("refresh")):
+      cycles.start(water_refresh())
+   return run_parms["water_refresh_cycle"]
+
+# Move a repeating job to a new interval, keeping the time it last ran, so a
+# changed interval neither skips nor restarts the current wait
+def reschedule(name, old_interval, new_interval, callback):
+   when = scheduler.deadline(name)
+   if (when is None or old_interval == 0):
+      scheduler.after(new_interval, name, callback)
+   else:
+      scheduler.at(max(when - old_interval + new_interval, clock.monotonic()), name, callback)
+
+# Apply changed run_parms to the running program.  Runs as a scheduler job so
+# no other job or cycle step is part way through.  Most parms are read where
+# they are used and need nothing here, timers and the pH port do.
+def apply_parm_changes(changes):
+   global VALVES
+   old_valves = VALVES
+   VALVES = build_valves()
+   if (VALVES != old_valves):
+      for cnt in range(len(VALVES)):
+         name = "valve" + str(cnt + 1)
+         if (VALVES[cnt][0] == 0):
+            scheduler.cancel(name)
+         elif (VALVES[cnt][0] != old_valves[cnt][0]):
+            reschedule(name, old_valves[cnt][0], VALVES[cnt][0], lambda cnt=cnt: valve_job(cnt))
+   if (VALVES != old_valves or any("_soil_" in key for key in changes)):
+      log_valves()
+   if ("water_refresh_cycle" in changes):
+      reschedule("refresh", changes["water_refresh_cycle"][0], run_parms["water_refresh_cycle"], water_refresh_job)
+   if ("ph_balance_interval" in changes):
+      reschedule("pH", changes["ph_balance_interval"][0], run_parms["ph_balance_interval"], pH_job)
+   if ("ph_sensor_port" in changes):
+      pH_reader.set_port(run_parms["ph_sensor_port"])
+   AGsys("Parm changes applied: " + ", ".join(changes))
+
+def remote_parm_job(): # Start a remote parm fetch, its result comes back through remote_parm_channel
+   threading.Thread(target=fetch_remote_parms, daemon=True).start()
+   return None # remote_parm_result schedules the next fetch
+
+def fetch_remote_parms(): # Thread, the web call blocks here instead of the scheduler
+   try:
+      result = config_sync.fetch()
+   except Exception as e:
+      AGlog("ERROR - Remote parm fetch failed: " + str(e),ERROR)
+      result = config_sync.failed()
+   remote_parm_channel.publish(result)
+
+def remote_parm_result(result): # Remote parm update routine, on the scheduler thread
+   status, remote_parms = result
+   scheduler.after(config_sync.next_delay(), "remote_parms", remote_parm_job)
+   if (status == AGremote.CHANGED):
+      AGsys("New remote parms are different than last set, checking them")
+      changes = update_parms(remote_parms)
+      if (changes):
+         AGsys("Parms updated, writing to file")
+         write_parm_file()
+         restart = [key for key in changes if key in RESTART_PARMS]
+         if (restart):
+            AGsys("Exiting program for restart, changed: " + ", ".join(restart))
+            save_checkpoint()
+            sys.exit(0)
+         apply_parm_changes(changes)
+      else:
+         AGsys("No updated needed for remote parms")
+   elif (status == AGremote.UNCHANGED):
+      AGsys("Remote parms unchanged, no need to check")
 
-   if (remote_parm_time_limit < time.time()): # Remote parm update routine
-      remoet_parm_time_limit = time.time() + REMOTE_PARM_INTERVAL
-      if (REMOTE_PARMS):
-         AGsys("Getting remote parms from web api")
-         remote_parms = read_remote_parms()
-         if (remote_parms != {} and len(remote_parms) > 0):
-            AGsys("Received remote parms")
-            if (old_remote_parms != remote_parms):
-               old_remote_parms = copy.deepcopy(remote_parms) # Keep copy of parms, no need to check duplicate parms
-               AGsys("New remote parms are different than last set, these are received parms --------")
-               write_json_to_log(remote_parms[0])
-               AGsys("Checking parms ----------------")
-               if (update_parms(remote_parms[0])):
-                  AGsys("Parms updated, writing to file")
-                  write_parm_file()
-                  AGsys("Running parms after remote update -----------------")
-                  write_json_to_log(run_parms)
-                  AGsys("End remote parm updates ----------------------")
-                  AGsys("Exiting program for restart")
-                  sys.exit(0)
-               else:
-                  AGsys("No updated needed for remote parms")
-            else:
-               AGsys("Old remote parms same as new parms no need to check")
-
-         else:
-            AGsys("No remote parms available")
-
-   if (water_refresh_time_limit < time.time()):  # Water refresh routine
-      water_refresh()
-      water_refresh_time_limit = time.time() + run_parms["water_refresh_cycle"]
-
-   if (logging_timer < time.time()): # Log time left before cycles in this code block
-      log_string = "Cycle minutes left: refresh:"
-      current_time = time.time()
-      log_string = log_string + str(round((water_refresh_time_limit - current_time)/60,1))
-
-      if (run_parms["balance_ph"]):
-         log_string = log_string + " pH:" + str(round((pH_time_limit - current_time)/60,1))
-
-      cnt = 0
-      for valve_time in valve_timers:
-         if (VALVES[cnt][0] != 0):
-            log_string = log_string + " V:" + str(cnt + 1) + " T:" + str(round((valve_time - current_time)/60,1))
-         cnt = cnt + 1
+def minutes_left(name): # Minutes until a job runs, for status logging
+   return str(round(scheduler.time_left(name)/60,1))
 
-      AGsys(log_string)
+def logging_job(): # Log time left before cycles
+   log_string = "Cycle minutes left: refresh:" + minutes_left("refresh")
 
-      if (not sensor_thread.is_alive()):
-         AGsys("Sensor Thread has crashed !!!!!!!!, Restarting.....")
-         AGlog("ERROR:  Sensor Thread has crashed",ERROR)
-         sensor_thread = threading.Thread(target=sensors,daemon=True) # Restart crashed sensor thread
-         sensor_thread.start()
+   if (run_parms["balance_ph"]):
+      log_string = log_string + " pH:" + minutes_left("pH")
 
-      logging_timer = time.time() + LOGGING_TIMER
+   for cnt in range(len(VALVES)):
+      if (VALVES[cnt][0] != 0):
+         log_string = log_string + " V:" + str(cnt + 1) + " T:" + minutes_left("valve" + str(cnt + 1))
 
-   time.sleep(5) # Master sleep in loop, must be smaller than all other sleep values
+   AGsys(log_string)
+   health = sensor_pool.health()
+   if (any(state == AGworkers.FAILED or state == AGworkers.STUCK for state, age in health.values())): # Keep reminding while a sensor is down
+      log_string = "Sensor workers:"
+      for name, (state, age) in health.items():
+         log_string = log_string + " " + name + ": " + state + (" never read" if age is None else " %.0fs since a good read" % age)
+      AGsys(log_string)
+   return LOGGING_TIMER
+
+def leak_job(): # Flow with the pump off for longer than it takes to settle means a leak or siphon
+   now = clock.monotonic()
+   if (pump_stop_time is not None and now - pump_stop_time >= FLOW_SETTLE_TIME):
+      pulses = flow.pulses_since(max(pump_stop_time + FLOW_SETTLE_TIME, now - FLOW_LEAK_INTERVAL))
+      if (pulses >= FLOW_LEAK_PULSES):
+         AGlog("ERROR - Possible leak, " + str(pulses) + " flow pulses (%.2f litres) with pump off" % flow.litres(pulses),ERROR)
+   return FLOW_LEAK_INTERVAL
+
+CHECKPOINT_JOBS = ["valve" + str(cnt + 1) for cnt in range(MAX_WATER_VALVES)] + ["pH", "refresh"]
+
+def save_checkpoint(): # Write timers and cached pH for a warm restart
+   jobs = {name: left for name, left in scheduler.remaining().items() if name in CHECKPOINT_JOBS}
+   pH = shared_state.current.pH
+   try:
+      AGcheckpoint.save(CHECKPOINT_FILE, jobs, pH.value, pH.age())
+   except Exception as e:
+      AGlog("ERROR - Could not write checkpoint: " + str(e),ERROR)
+
+def checkpoint_job():
+   save_checkpoint()
+   return CHECKPOINT_INTERVAL
+
+def first_delay(name, interval): # Time left from the checkpoint on a warm start, else a full interval
+   if (warm is not None and name in warm["jobs"]):
+      return min(warm["jobs"][name], interval)
+   return interval
+
+def replay_job(): # Apply parm changes as the replay clock passes them, end the run when the logs do
+   parms = replay.take_parms(clock.monotonic())
+   if (parms):
+      changes = update_parms(parms)
+      if (changes):
+         apply_parm_changes(changes)
+   if (replay.finished() and not SIM_RUN_TIME):
+      sim_end_job()
+   return REPLAY_INTERVAL
+
+def sim_end_job(): # End of simulated run
+   AGsys("Sim run time complete")
+   if (HAL_BACKEND == "replay"):
+      AGsys(replay.summary())
+   signal_handler(signal.SIGTERM,None)
+
+for cnt in range(len(VALVES)): # Zero time means valve is disabled and gets no job
+   if (VALVES[cnt][0] != 0):
+      scheduler.after(first_delay("valve" + str(cnt + 1), VALVES[cnt][0]), "valve" + str(cnt + 1), lambda cnt=cnt: valve_job(cnt))
+scheduler.after(first_delay("pH", run_parms["ph_balance_interval"]), "pH", pH_job) # Time when the next pH auto cycle can run
+scheduler.after(first_delay("refresh", run_parms["water_refresh_cycle"]), "refresh", water_refresh_job) # Next water refresh cycle for pH sensor
+if (REMOTE_PARMS):
+   scheduler.after(config_sync.next_delay(), "remote_parms", remote_parm_job) # Timer for accessing remote web api parms
+   remote_parm_channel = AGsched.Channel(scheduler, "remote_parm_result", remote_parm_result) # Fetch thread hands back its result
+AGseries.Maintainer([AGconfig.sensor_history, AGconfig.pump_history], SERIES_ROLLUP_INTERVAL, SERIES_RAW_DAYS, \
+   SERIES_HOURLY_DAYS).start() # Hourly / daily rollups and old raw data cleanup, off the scheduler thread
+scheduler.after(CHECKPOINT_INTERVAL, "checkpoint", checkpoint_job)
+scheduler.after(FLOW_LEAK_INTERVAL, "leak", leak_job)
+scheduler.after(0, "logging", logging_job) # Controls when logs output for timing status
+AGsensors.soil_channel = AGsched.Channel(scheduler, "soil", soil_job) # Every sensor pass wakes the scheduler with its snapshot
+if (HAL_BACKEND == "replay"):
+   scheduler.after(REPLAY_INTERVAL, "replay", replay_job)
+if (SIM_RUN_TIME):
+   scheduler.after(SIM_RUN_TIME, "sim_end", sim_end_job) # Sim runs stop here when SIM_RUN_TIME is set
+
+scheduler.run() # Master loop for water cycle and pH rebalance, sleeps until the next job is due
@@ -0,0 +1,287 @@
+# Benchmarks for the AutoGro controller hot paths, on simulated hardware
+# V23
+#
+# Run from anywhere, needs no Pi hardware:
+#   python3 Bench/AGbench.py            run and compare with the saved baseline
+#   python3 Bench/AGbench.py save       run and save the results as the baseline
+#   python3 Bench/AGbench.py check      run, compare, exit 1 if anything regressed
+#   python3 Bench/AGbench.py <name>...  run only the named benchmarks
+#
+# Each benchmark reports calls per second, p50 / p99 call latency, the
+# tracemalloc peak for a batch of calls and the memory blocks still held per
+# call afterwards (a leak shows up there).  Baselines are per machine, they
+# are kept in Bench/baseline.json next to this script.  A benchmark whose p50
+# is more than TOLERANCE slower than its baseline is flagged.
+#
+# The controller modules log and write history into the current directory,
+# so everything runs in a scratch directory that is removed afterwards.
+
+import gc
+import http.server
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+TOLERANCE = .25          # p50 this much over baseline is a regression
+SIM_DAY_SPEED = 10000    # Sim clock speed for the simulated day
+
+sys.path.insert(0, REPO_DIR)
+work_dir = tempfile.mkdtemp(prefix="agbench")
+os.chdir(work_dir)
+
+from AGconfig import *
+import AGconfig
+import AGhal
+AGhal.init("sim",RELAY_PINS,FLOW_PIN_INPUT,PH_UP_RELAY,PH_DOWN_RELAY,1)
+AGconfig.start_node()
+import AGph
+import AGsensors
+import AGsnapshot
+AGconfig.PRINT_TO_CONSOLE = 0
+run_parms["enable_web_api"] = 0 # Only the api benchmark talks to a web API, its local mock
+
+# Time calls of fn, returns the result dict for one benchmark
+def measure(fn, iterations):
+   for i in range(min(iterations, 100)): # Warm up
+      fn()
+   gc.collect()
+   times = []
+   start = time.perf_counter()
+   for i in range(iterations):
+      t = time.perf_counter_ns()
+      fn()
+      times.append(time.perf_counter_ns() - t)
+   total = time.perf_counter() - start
+   times.sort()
+   batch = max(1, iterations // 10)
+   gc.collect()
+   blocks = sys.getallocatedblocks()
+   tracemalloc.start()
+   for i in range(batch):
+      fn()
+   peak = tracemalloc.get_traced_memory()[1]
+   tracemalloc.stop()
+   gc.collect()
+   return {"ops": iterations / total,
+           "p50_us": times[len(times) // 2] / 1000,
+           "p99_us": times[min(len(times) - 1, len(times) * 99 // 100)] / 1000,
+           "peak_kb": peak / 1024,
+           "blocks_per_call": (sys.getallocatedblocks() - blocks) / batch}
+
+################### Benchmarks, each returns a result dict ######################
+
+def bench_adc_scan(): # One burst scan of all channels at the max oversample
+   adc = AGsensors.ADCScan(range(ADC_CHANNELS), ADC_MAX_OVERSAMPLE)
+   return measure(lambda: adc.scan(ADC_MAX_OVERSAMPLE), 2000)
+
+def bench_soil_tds(): # Soil and TDS conversion of one scan's sample blocks
+   adc = AGsensors.ADCScan(range(ADC_CHANNELS), ADC_MAX_OVERSAMPLE)
+   adc.scan(ADC_MAX_OVERSAMPLE)
+   def convert():
+      raw = [int(adc.mean(i)) for i in range(MAX_SOIL_SENSORS)]
+      AGsensors.soil_percent(raw, run_parms["soil_wet"], run_parms["soil_dry"])
+      AGsensors.tds_block(adc.samples(ADC_TDS_CHANNEL), run_parms["room_temperature"])
+   return measure(convert, 20000)
+
+def bench_sensor_pass(): # One read of every sensor worker, each publishing, without their sleeps
+   read_adc = AGsensors.adc_reader()
+   report = AGsensors.reporter(0) # Never wait, a report only goes out when due
+   def sensor_pass():
+      shared_state.publish(**AGsensors.read_pH())
+      shared_state.publish(**read_adc())
+      report()
+   return measure(sensor_pass, 2000)
+
+def bench_snapshot(): # Publish one sensor pass worth of fields, then a reader picks it up
+   def cycle():
+      snap = shared_state.publish(pH=(6.53, AGsnapshot.GOOD), tds=(343.3, AGsnapshot.GOOD), \
+         soil=((55, 60, 65, 70), AGsnapshot.GOOD))
+      shared_state.wait_newer(snap.seq - 1, 0)
+   return measure(cycle, 20000)
+
+class FakeSerial: # Serial port holding a fixed byte stream, asks the reader to stop when empty
+   def __init__(self, data, reader):
+      self.data = data
+      self.pos = 0
+      self.reader = reader
+
+   @property
+   def in_waiting(self):
+      return min(64, len(self.data) - self.pos) # Probe data arrives in USB sized chunks
+
+   def read(self, n):
+      if (self.pos >= len(self.data)):
+         self.reader.reopen = True
+         return b""
+      chunk = self.data[self.pos:self.pos + n]
+      self.pos = self.pos + len(chunk)
+      return chunk
+
+def bench_ph_parse(): # Reader thread parsing 100 probe lines, with the odd garbled one
+   reader = AGph.PHReader("/dev/null",PH_WINDOW,PH_REOPEN_DELAY,PH_WARN_INTERVAL,\
+      AGph.PHEstimator(PH_EMA_ALPHA,PH_OUTLIER_SIGMA,PH_OUTLIER_FLOOR,PH_OUTLIER_RESET))
+   data = b"".join(b"%.2f\r" % (6.5 + (i % 7) * .01) if i % 50 else b"6.\x005\r" for i in range(100))
+   def parse():
+      reader.reopen = False
+      reader.read_port(FakeSerial(data, reader))
+   return measure(parse, 1000)
+
+def bench_get_pH_driver(): # Quality gated pH from a full reader
+   AGsensors.pH_reader.start()
+   deadline = time.monotonic() + 10
+   while (AGsensors.pH_reader.estimator.count < 3 and time.monotonic() < deadline): # Sim probe sends one a second
+      time.sleep(.1)
+   return measure(AGsensors.get_pH_driver, 20000)
+
+def bench_update_parms(): # Full config with a few changed keys each call
+   configs = [dict(run_parms), dict(run_parms)]
+   configs[1]["valve1_time"] = configs[1]["valve1_time"] + 1
+   configs[1]["ideal_ph"] = 6.4
+   configs[1]["sensor_url"] = configs[1]["sensor_url"] + "x"
+   state = [0]
+   def update():
+      state[0] = 1 - state[0]
+      update_parms(configs[state[0]])
+   result = measure(update, 2000)
+   update_parms(configs[0])
+   return result
+
+def bench_update_parms_same(): # Full config with nothing changed, the usual poll
+   same = dict(run_parms)
+   return measure(lambda: update_parms(same), 20000)
+
+def bench_agsys():
+   return measure(lambda: AGsys("Benchmark line for the system log, about as long as a normal one"), 20000)
+
+def bench_aglog():
+   return measure(lambda: AGlog("Benchmark line for the sensor log, S0: 21000 (97) WC: 343.3 pH: 6.53",SENSORS), 20000)
+
+class MockAPI(http.server.BaseHTTPRequestHandler): # Accepts every post like the web API
+   protocol_version = "HTTP/1.1"
+
+   def log_message(self, format, *args):
+      pass
+
+   def do_POST(self):
+      self.rfile.read(int(self.headers.get("Content-Length", 0)))
+      self.send_response(201)
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+
+def bench_api_sensor(): # APIsensor payload build and hand off, then the uploader drain rate
+   server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockAPI)
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   old = dict(run_parms)
+   run_parms["enable_web_api"] = 1
+   run_parms["sensor_url"] = "http://127.0.0.1:" + str(server.server_address[1]) + "/sensor"
+   values = [55, 60, 65, 70, "", 343.3, 6.53]
+   result = measure(lambda: APIsensor(values), 500)
+   start = time.perf_counter()
+   sent = AGconfig.uploader.outbox.count()
+   while (AGconfig.uploader.outbox.count() and time.perf_counter() - start < 120):
+      time.sleep(.01)
+   result["drain_per_sec"] = sent / (time.perf_counter() - start)
+   run_parms.update(old)
+   server.shutdown()
+   return result
+
+def bench_sim_day(): # A simulated day of the whole controller, CPU seconds used
+   day_dir = os.path.join(work_dir, "sim_day")
+   os.makedirs(day_dir)
+   with open(os.path.join(day_dir, "AG_Parms.txt"), "w") as file:
+      json.dump({"enable_web_api": 0}, file)
+   env = dict(os.environ, AG_HAL="sim", AG_SIM_SPEED=str(SIM_DAY_SPEED), AG_SIM_RUN_TIME="86400")
+   before = resource.getrusage(resource.RUSAGE_CHILDREN)
+   start = time.perf_counter()
+   run = subprocess.run([sys.executable, os.path.join(REPO_DIR, "AutoGro.py")], cwd=day_dir, env=env, \
+      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=600) # A timeout raises, the run failed too
+   wall = time.perf_counter() - start
+   if (run.returncode != 0): # A crashed run is no timing
+      tail = run.stderr.decode(errors="replace").strip().splitlines()[-1:]
+      raise RuntimeError("controller exited with " + str(run.returncode) + (": " + tail[0] if tail else ""))
+   after = resource.getrusage(resource.RUSAGE_CHILDREN)
+   cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+   # ru_maxrss is the high water mark of every child so far, not a tracemalloc peak, so it gets its own line
+   return {"ops": 1 / wall, "p50_us": cpu * 1e6, "p99_us": cpu * 1e6, "peak_kb": None, "blocks_per_call": None, \
+      "max_rss_kb": after.ru_maxrss}
+
+BENCHMARKS = [
+   ("adc_scan", bench_adc_scan),
+   ("soil_tds", bench_soil_tds),
+   ("sensor_pass", bench_sensor_pass),
+   ("snapshot", bench_snapshot),
+   ("ph_parse", bench_ph_parse),
+   ("get_pH_driver", bench_get_pH_driver),
+   ("update_parms", bench_update_parms),
+   ("update_parms_same", bench_update_parms_same),
+   ("agsys", bench_agsys),
+   ("aglog", bench_aglog),
+   ("api_sensor", bench_api_sensor),
+   ("sim_day", bench_sim_day) ]    # p50 / p99 are CPU microseconds for the whole day
+
+def column(value, format): # Blank for a value the benchmark does not measure
+   return "" if value is None else format % value
+
+def main():
+   args = sys.argv[1:]
+   save = "save" in args
+   check = "check" in args
+   names = [a for a in args if a not in ("save", "check")]
+   baseline = {}
+   if (os.path.exists(BASELINE_FILE)):
+      with open(BASELINE_FILE) as file:
+         baseline = json.load(file)
+   results = {}
+   regressions = []
+   failures = []
+   print("%-18s %12s %10s %10s %10s %10s  %s" % ("benchmark", "calls/s", "p50 us", "p99 us", "peak KB", "blocks", "vs baseline"))
+   for name, fn in BENCHMARKS:
+      if (names and name not in names):
+         continue
+      try:
+         result = fn()
+      except Exception as e:
+         print("%-18s FAILED: %s" % (name, e))
+         failures.append(name)
+         continue
+      results[name] = result
+      compare = ""
+      if (name in baseline):
+         ratio = result["p50_us"] / baseline[name]["p50_us"]
+         compare = "%+.0f%%" % ((ratio - 1) * 100)
+         if (ratio > 1 + TOLERANCE):
+            compare = compare + " REGRESSION"
+            regressions.append(name)
+      print("%-18s %12.1f %10.1f %10.1f %10s %10s  %s" % (name, result["ops"], result["p50_us"], result["p99_us"], \
+         column(result["peak_kb"], "%.1f"), column(result["blocks_per_call"], "%.2f"), compare))
+      if ("drain_per_sec" in result):
+         print("%-18s %12.1f   payloads/s uploader drain" % ("", result["drain_per_sec"]))
+      if ("max_rss_kb" in result):
+         print("%-18s %12d   KB max resident set of the controller process" % ("", result["max_rss_kb"]))
+   if (save):
+      baseline.update(results)
+      with open(BASELINE_FILE, "w") as file:
+         json.dump(baseline, file, indent=2)
+      print("Baseline saved to " + BASELINE_FILE)
+   log_writer.flush()
+   os.chdir(REPO_DIR)
+   shutil.rmtree(work_dir, ignore_errors=True)
+   if (failures):
+      print("Failed: " + ", ".join(failures))
+      sys.exit(1)
+   if (check and regressions):
+      print("Regressions: " + ", ".join(regressions))
+      sys.exit(1)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,157 @@
+# Tests for AGusb, the pH probe USB reset and recovery
+# V23
+#
+# Runs the reset path against a fake sysfs / dev tree in a temporary
+# directory, with a stub standing in for the USBDEVFS_RESET ioctl and a
+# stepped clock so the waits take no real time:
+#   python3 -m unittest discover tests      (or pytest)
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import AGhal
+import AGusb
+
+HUB = "2109:3431" # VIA Labs hub, the AGconfig default
+
+class StepClock: # Time only moves when something sleeps
+   speed = 1
+
+   def __init__(self):
+      self.now = 1000.0
+
+   def time(self):
+      return self.now
+
+   def monotonic(self):
+      return self.now
+
+   def sleep(self, secs):
+      if (secs > 0):
+         self.now = self.now + secs
+
+class FakeTree: # <root>/sys and <root>/dev with one USB device and the probe tty
+   def __init__(self, vendor="2109", product="3431", busnum="1", devnum="2"):
+      self.root = tempfile.mkdtemp()
+      self.sys = os.path.join(self.root, "sys")
+      self.dev = os.path.join(self.root, "dev")
+      device = os.path.join(self.sys, "bus", "usb", "devices", "1-1")
+      os.makedirs(device)
+      for name, value in (("idVendor", vendor), ("idProduct", product), ("busnum", busnum), ("devnum", devnum)):
+         with open(os.path.join(device, name), "w") as file:
+            file.write(value + "\n")
+      os.makedirs(os.path.join(self.sys, "bus", "usb", "devices", "1-1:1.0")) # Interface, no ids
+      self.tty = os.path.join(self.sys, "class", "tty", "ttyUSB0")
+      os.makedirs(self.tty)
+
+   def device(self, device=HUB):
+      return AGusb.Device(device, self.sys, self.dev, detach_time=1, settle_timeout=5, poll_interval=.1)
+
+   def remove(self):
+      shutil.rmtree(self.root)
+
+class DeviceTest(unittest.TestCase):
+   def setUp(self):
+      self.clock = AGhal.clock
+      AGhal.clock = StepClock()
+      self.tree = FakeTree()
+      self.resets = []
+
+   def tearDown(self):
+      AGhal.clock = self.clock
+      self.tree.remove()
+
+   def test_ok(self): # tty goes away on the reset and is back before the settle timeout
+      device = self.tree.device()
+      def reset(node):
+         self.resets.append(node)
+         os.rmdir(self.tree.tty)
+         back = AGhal.clock.monotonic() + 2
+         real_sleep = AGhal.clock.sleep
+         def sleep(secs):
+            real_sleep(secs)
+            if (AGhal.clock.monotonic() >= back and not os.path.exists(self.tree.tty)):
+               os.makedirs(self.tree.tty)
+         AGhal.clock.sleep = sleep
+      device.reset_fn = reset
+      self.assertEqual(device.reset("/dev/ttyUSB0"), AGusb.OK)
+      self.assertEqual(self.resets, [os.path.join(self.tree.dev, "bus", "usb", "001", "002")])
+      self.assertIsNone(device.error)
+      self.assertGreaterEqual(device.timings["reappear"], 2)
+      self.assertLess(device.timings["reappear"], 5)
+
+   def test_no_device(self): # Nothing in sysfs with the vendor:product, the reset is never sent
+      device = self.tree.device("1a86:7523")
+      device.reset_fn = self.resets.append
+      self.assertEqual(device.reset("/dev/ttyUSB0"), AGusb.NO_DEVICE)
+      self.assertEqual(self.resets, [])
+      self.assertIn("1a86:7523", device.error)
+
+   def test_timeout(self): # tty never comes back
+      device = self.tree.device()
+      def reset(node):
+         self.resets.append(node)
+         os.rmdir(self.tree.tty)
+      device.reset_fn = reset
+      self.assertEqual(device.reset("/dev/ttyUSB0"), AGusb.TIMEOUT)
+      self.assertEqual(len(self.resets), 1)
+      self.assertGreaterEqual(device.timings["reappear"], 4)
+      self.assertIn("not back", device.error)
+
+   def test_failed(self): # ioctl error
+      device = self.tree.device()
+      def reset(node):
+         raise PermissionError("Operation not permitted")
+      device.reset_fn = reset
+      self.assertEqual(device.reset("/dev/ttyUSB0"), AGusb.FAILED)
+      self.assertIn("not permitted", device.error)
+
+class RecoveryTest(unittest.TestCase):
+   def setUp(self):
+      self.clock = AGhal.clock
+      AGhal.clock = StepClock()
+      self.tree = FakeTree()
+      self.resets = []
+
+   def tearDown(self):
+      AGhal.clock = self.clock
+      self.tree.remove()
+
+   def recovery(self):
+      def reset(device, port):
+         self.resets.append(AGhal.clock.monotonic())
+         return AGusb.OK
+      return AGusb.Recovery(self.tree.device(), 150, 1200, reset)
+
+   def test_back_off_doubles_to_the_cap(self):
+      recovery = self.recovery()
+      self.assertTrue(recovery.due())
+      waits = []
+      for cnt in range(6):
+         self.assertEqual(recovery.recover("/dev/ttyUSB0"), AGusb.OK)
+         waits.append(recovery.next_time - AGhal.clock.monotonic())
+         self.assertFalse(recovery.due())
+         AGhal.clock.sleep(waits[-1] - 1)
+         self.assertFalse(recovery.due())
+         AGhal.clock.sleep(1)
+         self.assertTrue(recovery.due())
+      self.assertEqual(waits, [150, 300, 600, 1200, 1200, 1200])
+      self.assertEqual(len(self.resets), 6) # Still resets once the back off is at the cap
+
+   def test_healthy_starts_over(self):
+      recovery = self.recovery()
+      recovery.recover("/dev/ttyUSB0")
+      recovery.recover("/dev/ttyUSB0")
+      recovery.healthy()
+      AGhal.clock.sleep(10000)
+      recovery.recover("/dev/ttyUSB0")
+      self.assertEqual(recovery.next_time - AGhal.clock.monotonic(), 150)
+      self.assertEqual(recovery.last["result"], AGusb.OK)
+
+if __name__ == "__main__":
+   unittest.main()